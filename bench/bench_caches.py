@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Memory/latency benchmark of the services cache: the former cache, keyed by
+# "host/service" strings with a dict for each service, compared to caches of
+# GlpiItem entries keyed by interned (host, service) tuples or indexed by
+# interned host then service names (the module cache).
+#
+# Each cache is built in a forked process, the memory is the increase of the
+# process max. RSS (Linux) and the latency is the mean time of a check result
+# lookup (key built from the brok names, GLPI ids read), best of 3 runs.
+#
+#   python bench/bench_caches.py --services 10000,100000,500000
+
+import os
+import sys
+import time
+import resource
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from record import GlpiItem, intern_name
+
+SERVICES_PER_HOST = 10
+
+
+def names(count):
+    """(host, service) names, new strings as in the broks"""
+    for i in range(count):
+        yield ('host-%06d' % (i / SERVICES_PER_HOST), 'service-%d' % (i % SERVICES_PER_HOST))
+
+
+def build_legacy(count):
+    cache = {}
+    for (i, (host, service)) in enumerate(names(count)):
+        cache[host + "/" + service] = {'itemtype': 'Service', 'items_id': str(i)}
+    return cache
+
+
+def lookup_legacy(cache, host, service):
+    service_id = host + "/" + service
+    if service_id in cache and cache[service_id]['items_id'] is not None:
+        return (cache[service_id]['items_id'], cache[service_id]['itemtype'])
+
+
+def build_items(count):
+    cache = {}
+    for (i, (host, service)) in enumerate(names(count)):
+        cache[(intern_name(host), intern_name(service))] = GlpiItem(str(i), 'Service')
+    return cache
+
+
+def lookup_items(cache, host, service):
+    item = cache.get((host, service))
+    if item is not None:
+        return (item.items_id, item.itemtype)
+
+
+def build_index(count):
+    cache = {}
+    for (i, (host, service)) in enumerate(names(count)):
+        cache.setdefault(intern_name(host), {})[intern_name(service)] = GlpiItem(str(i), 'Service')
+    return cache
+
+
+def lookup_index(cache, host, service):
+    services = cache.get(host)
+    if services is not None:
+        item = services.get(service)
+        if item is not None:
+            return (item.items_id, item.itemtype)
+
+
+def measure(build, lookup, count, lookups):
+    """Build a cache and look up its services, in a forked process: (bytes, seconds per lookup)"""
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cache = build(count)
+        memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+
+        broks = list(names(min(count, lookups)))
+        durations = []
+        for run in range(3):
+            start = time.time()
+            for (host, service) in broks:
+                lookup(cache, host, service)
+            durations.append(time.time() - start)
+        latency = min(durations) / len(broks)
+
+        os.write(write_fd, "%d %r" % (memory, latency))
+        os._exit(0)
+
+    os.close(write_fd)
+    result = os.read(read_fd, 1024)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    (memory, latency) = result.split()
+    return (int(memory), float(latency))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--services', default='10000,100000,500000', help='numbers of services, comma separated')
+    parser.add_option('--lookups', type='int', default=200000, help='max. number of lookups')
+    (options, args) = parser.parse_args()
+
+    print "%-10s %-20s %12s %14s %14s" % ('services', 'cache', 'memory (MB)', 'bytes/service', 'lookup (ns)')
+    for count in [int(count) for count in options.services.split(',')]:
+        for (name, build, lookup) in (('host/service dicts', build_legacy, lookup_legacy),
+                                      ('tuples and slots', build_items, lookup_items),
+                                      ('index and slots', build_index, lookup_index)):
+            (memory, latency) = measure(build, lookup, count, options.lookups)
+            print "%-10d %-20s %12.1f %14d %14.0f" % (count, name, memory / 1024.0 / 1024.0,
+                                                    memory / count, latency * 1e9)
+
+
+if __name__ == '__main__':
+    main()
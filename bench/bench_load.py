@@ -0,0 +1,298 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Synthetic load benchmark of the module: check result broks of a simulated
+# fleet are managed by the broker module, with an in-process stand-in for
+# MySQLdb that counts the queries and commits instead of running them.
+#
+# Reported: broks/sec, p50/p99 latency of a brok management, queries and
+# commits per brok and the process peak memory (max. RSS). The Shinken
+# package must be importable (the module uses shinken.basemodule/log).
+#
+#   python bench/bench_load.py --hosts 1000 --services 10 --broks 200000
+#   python bench/bench_load.py --update services_events,services --change-rate 0.05 --other-broks 1
+
+import os
+import sys
+import time
+import types
+import random
+import itertools
+import resource
+import optparse
+import cPickle
+
+UPDATES = ('shinken_state', 'services_events', 'hosts', 'services', 'acknowledges', 'availability')
+
+
+class FakeError(Exception):
+    pass
+
+
+class FakeCursor(object):
+    """Cursor of the stand-in database: queries are counted, SELECT return no rows"""
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+        self.rowcount = 0
+        self.lastrowid = 1
+
+    def execute(self, query, params=None):
+        self.db.stats['queries'] += 1
+        self.rows = []
+        if '@@max_allowed_packet' in query:
+            self.rows = [(16 * 1024 * 1024,)]
+        self.rowcount = 1
+        return 1
+
+    def executemany(self, query, params):
+        self.db.stats['queries'] += 1
+        self.db.stats['rows'] += len(params)
+        self.rowcount = len(params)
+        return len(params)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        (rows, self.rows) = (self.rows, [])
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, stats):
+        self.stats = stats
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.stats['commits'] += 1
+
+    def rollback(self):
+        pass
+
+    def set_character_set(self, charset):
+        pass
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def fake_mysqldb(stats):
+    """In-process stand-in for the MySQLdb module"""
+    module = types.ModuleType('MySQLdb')
+    module.Error = FakeError
+    module.IntegrityError = type('IntegrityError', (FakeError,), {})
+    module.ProgrammingError = type('ProgrammingError', (FakeError,), {})
+    module.OperationalError = type('OperationalError', (FakeError,), {})
+    module.InternalError = type('InternalError', (FakeError,), {})
+    module.connect = lambda **kwargs: FakeConnection(stats)
+    return module
+
+
+class Brok(object):
+    """Brok with pickled data, as the broks received by the broker modules"""
+    def __init__(self, type, data):
+        self.type = type
+        self.data = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+        self.prepared = False
+
+    def prepare(self):
+        if not self.prepared:
+            self.data = cPickle.loads(self.data)
+            self.prepared = True
+
+
+class Conf(object):
+    def __init__(self, **options):
+        self.module_name = 'glpidb'
+        self.module_type = 'glpidb'
+        self.__dict__.update(options)
+
+    def get_name(self):
+        return self.module_name
+
+
+STATES = {
+    'host': ((0, 'UP'), (1, 'DOWN'), (2, 'UNREACHABLE')),
+    'service': ((0, 'OK'), (1, 'WARNING'), (2, 'CRITICAL'), (3, 'UNKNOWN')),
+}
+
+
+def check_result(kind, host, service, state, timestamp, index):
+    """Check result brok data, shaped like the samples of the module"""
+    (state_id, state_name) = STATES[kind][state]
+    data = {
+        'host_name': host, 'state': state_name, 'state_id': state_id, 'state_type': 'HARD', 'state_type_id': 1,
+        'last_state': state_name, 'last_state_id': state_id, 'last_state_type': 'HARD',
+        'last_chk': timestamp, 'last_state_change': timestamp - 3600.5, 'last_hard_state_change': timestamp - 3600,
+        'output': 'Ok : memory consumption is %d%%' % (index % 100) if kind == 'service' else 'PING OK - rta %d ms' % (index % 10),
+        'long_output': u'', 'latency': 0.2347090244293213, 'execution_time': 0.062339067459106445,
+        'perf_data': u'consumed=%d%%;80%%;90%%;0%%;100%% used=53%%;;;0%%;100%% free=46%%;;;0%%;100%%' % (index % 100),
+        'problem_has_been_acknowledged': False, 'acknowledgement_type': 1, 'in_scheduled_downtime': False,
+        'check_type': 0, 'attempt': 1, 'return_code': state_id, 'has_been_checked': 1, 'in_checking': False,
+        'current_event_id': 0, 'last_event_id': 0, 'current_problem_id': 0, 'last_problem_id': 0,
+        'percent_state_change': 0.0, 'check_interval': 5, 'retry_interval': 1, 'timeout': 0,
+        'start_time': 0, 'end_time': 0, 'early_timeout': 0, 'instance_id': 0,
+    }
+    if kind == 'service':
+        data['service_description'] = service
+    return Brok('%s_check_result' % kind, data)
+
+
+def initial_broks(options):
+    broks = []
+    for h in range(options.hosts):
+        host = 'host-%06d' % h
+        broks.append(Brok('initial_host_status', {
+            'host_name': host, 'instance_id': 0,
+            'customs': {'_HOSTID': str(h), '_ITEMTYPE': 'Computer', '_ITEMSID': str(h)}}))
+        for s in range(options.services):
+            broks.append(Brok('initial_service_status', {
+                'host_name': host, 'service_description': 'service-%d' % s, 'instance_id': 0,
+                'customs': {'_ITEMTYPE': 'Service', '_ITEMSID': str(h * options.services + s)}}))
+    broks.append(Brok('initial_broks_done', {'instance_id': 0}))
+    return broks
+
+
+def check_broks(options):
+    """
+    Check results of the fleet, each host then its services, with change_rate
+    of the checks changing state, and other_broks unmanaged broks per check
+    """
+    random.seed(options.seed)
+    items = options.hosts * (options.services + 1)
+    states = {}
+    start = int(time.time())
+    for i in range(options.broks):
+        item = i % items
+        (h, s) = divmod(item, options.services + 1)
+        # The fleet is checked every check_interval seconds
+        timestamp = start + (i / items) * options.check_interval
+        state = states.get(item, 0)
+        if random.random() < options.change_rate:
+            state = states[item] = (state + 1) % (3 if s == 0 else 4)
+        if s == 0:
+            yield check_result('host', 'host-%06d' % h, None, state, timestamp, i)
+        else:
+            yield check_result('service', 'host-%06d' % h, 'service-%d' % (s - 1), state, timestamp, i)
+        for other in range(options.other_broks):
+            yield Brok('log', {'log': '[%d] SERVICE ALERT: host-%06d;service;OK;HARD;1;Ok' % (timestamp, h)})
+
+
+def percentile(values, ratio):
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--hosts', type='int', default=1000, help='number of hosts')
+    parser.add_option('--services', type='int', default=10, help='number of services per host')
+    parser.add_option('--broks', type='int', default=100000, help='number of check result broks')
+    parser.add_option('--change-rate', type='float', default=0.01, help='ratio of check results changing state')
+    parser.add_option('--other-broks', type='int', default=0, help='unmanaged broks (logs) per check result')
+    parser.add_option('--check-interval', type='int', default=60, help='seconds between two checks of an item')
+    parser.add_option('--batch', type='int', default=100, help='broks per broks batch')
+    parser.add_option('--commit-every', type='int', default=10000, help='broks between two periodic flushes')
+    parser.add_option('--update', default=','.join(UPDATES), help='updated tables: %s' % ', '.join(UPDATES))
+    parser.add_option('--option', action='append', default=[], help='other module option, as name=value')
+    parser.add_option('--seed', type='int', default=0)
+    (options, args) = parser.parse_args()
+
+    stats = {'queries': 0, 'rows': 0, 'commits': 0}
+    sys.modules['MySQLdb'] = fake_mysqldb(stats)
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+    import module
+
+    updates = [update.strip() for update in options.update.split(',') if update.strip()]
+    conf = dict([('update_%s' % update, '1' if update in updates else '0') for update in UPDATES])
+    conf.update({'writer_thread': '0', 'commit_volume': '1000'})
+    conf.update(dict([option.split('=', 1) for option in options.option]))
+    broker = module.Glpidb_broker(Conf(**conf))
+    broker.open()
+    broker.manage_broks(initial_broks(options))
+
+    for key in stats:
+        stats[key] = 0
+    latencies = []
+    (checks, managed, batch) = (0, 0, [])
+    flush_time = 0.0
+    start = time.time()
+    broks = check_broks(options)
+    while True:
+        batch = list(itertools.islice(broks, options.batch))
+        if not batch:
+            break
+
+        # Broks batch, as in the module main loop
+        for b in batch:
+            brok_start = time.time()
+            broker.manage_broks((b,))
+            latencies.append(time.time() - brok_start)
+            if b.type != 'log':
+                checks += 1
+        broker.end_broks_batch()
+        managed += len(batch)
+
+        if managed % options.commit_every < options.batch:
+            flush_start = time.time()
+            broker.bulk_insert()
+            broker.flush_states()
+            if broker.update_availability:
+                broker.flush_availability()
+            flush_time += time.time() - flush_start
+
+    flush_start = time.time()
+    while broker.events_cache:
+        broker.bulk_insert()
+    broker.flush_states()
+    if broker.update_availability:
+        broker.flush_availability()
+    broker.connection.commit_transaction()
+    flush_time += time.time() - flush_start
+    duration = time.time() - start
+
+    latencies.sort()
+    print "fleet: %d hosts, %d services, updates: %s" % (options.hosts, options.hosts * options.services, ', '.join(updates))
+    print "broks:            %10d (%d check results), %2.2fs" % (managed, checks, duration)
+    print "throughput:       %10.0f broks/sec" % (managed / duration if duration else 0)
+    print "latency p50:      %10.1f us" % (percentile(latencies, 0.5) * 1e6)
+    print "latency p99:      %10.1f us" % (percentile(latencies, 0.99) * 1e6)
+    print "periodic flushes: %10.2f s" % flush_time
+    print "queries / check:  %10.3f (%d queries, %d rows)" % (float(stats['queries']) / checks, stats['queries'], stats['rows'])
+    print "commits / check:  %10.3f (%d commits)" % (float(stats['commits']) / checks, stats['commits'])
+    print "peak memory:      %10.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+
+if __name__ == '__main__':
+    main()
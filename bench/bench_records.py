@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Micro-benchmark of the check result broks decoding: broks/sec of the former
+# per-table decoding of the brok data compared to the CheckRecord decoded once
+# for all the tables (service events, services, Shinken state, availability).
+#
+#   python bench/bench_records.py --broks 200000
+
+import os
+import sys
+import time
+import datetime
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from record import CheckRecord
+
+
+def make_broks_data(count, services):
+    broks = []
+    now = int(time.time())
+    for i in range(count):
+        broks.append({
+            'host_name': 'host-%04d' % (i % services / 10), 'service_description': 'service-%d' % (i % 10),
+            'state': 'OK', 'state_id': 0, 'state_type': 'HARD', 'last_chk': now + i / services,
+            'output': 'Ok : memory consumption is %d%%' % (i % 100), 'long_output': u'',
+            'perf_data': u'consumed=%d%%;80%%;90%%;0%%;100%% used=53%%;;;0%%;100%%' % (i % 100),
+            'latency': 0.2347090244293213, 'execution_time': 0.062339067459106445,
+            'problem_has_been_acknowledged': False, 'in_scheduled_downtime': False,
+        })
+    return broks
+
+
+def legacy_decode(data):
+    """Former decoding of a service check result, for each table"""
+    event = (
+        1,
+        datetime.datetime.fromtimestamp( int(data['last_chk']) ).strftime('%Y-%m-%d %H:%M:%S'),
+        "%s \n %s" % (data['output'], data['long_output']) if (len(data['long_output']) > 0) else data['output'],
+        data['state'],
+        data['state_type'],
+        data['perf_data'],
+        data['latency'],
+        data['execution_time']
+    )
+    service = (
+        "%s \n %s" % (data['output'], data['long_output']) if (len(data['long_output']) > 0) else data['output'],
+        data['state'],
+        data['state_type'],
+        datetime.datetime.fromtimestamp( int(data['last_chk']) ).strftime('%Y-%m-%d %H:%M:%S'),
+        '1' if data['problem_has_been_acknowledged'] else '0'
+    )
+    shinken_state = (
+        data['state_id'],
+        data['state_type'],
+        "%s \n %s" % (data['output'], data['long_output']) if (len(data['long_output']) > 0) else data['output'],
+        datetime.datetime.fromtimestamp( int(data['last_chk']) ).strftime('%Y-%m-%d %H:%M:%S'),
+        data['perf_data'],
+        '1' if data['problem_has_been_acknowledged'] else '0'
+    )
+    availability = (data['host_name'], data['service_description'], data['state_id'],
+                    int(data['last_chk']), bool(data['in_scheduled_downtime']))
+    return (event, service, shinken_state, availability)
+
+
+def record_decode(data):
+    """Decoding of a service check result in a CheckRecord, used for each table"""
+    record = CheckRecord(data)
+    event = (1, record.date, record.event, record.state, record.state_type,
+             record.perf_data, record.latency, record.execution_time)
+    service = (record.event, record.state, record.state_type, record.date, record.acknowledged)
+    shinken_state = (record.state_id, record.state_type, record.event, record.date,
+                     record.perf_data, record.acknowledged)
+    availability = (record.hostname, record.service, record.state_id, record.last_chk, record.in_downtime)
+    return (event, service, shinken_state, availability)
+
+
+def report(name, broks, duration):
+    print "%-40s %8d broks in %2.4fs: %10.0f broks/sec" % (name, broks, duration, broks / duration if duration else 0)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--broks', type='int', default=200000, help='number of check result broks')
+    parser.add_option('--services', type='int', default=10000, help='number of services (broks per second)')
+    (options, args) = parser.parse_args()
+
+    broks = make_broks_data(options.broks, options.services)
+
+    for (name, decode) in (('per table decoding', legacy_decode), ('check records', record_decode)):
+        start = time.time()
+        for data in broks:
+            decode(data)
+        report(name, options.broks, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
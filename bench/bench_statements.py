@@ -0,0 +1,213 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Micro-benchmark of the service events insertion: rows/sec of the former
+# hand-built SQL strings compared to the statements with parameters binding,
+# and to LOAD DATA LOCAL INFILE from a tab-separated file (events_load_data).
+#
+# Without database options, only the client side encoding is measured. With
+# database options, the rows are inserted in a temporary table. The server must
+# allow LOAD DATA LOCAL INFILE (local_infile) for the LOAD DATA measure.
+#
+#   python bench/bench_statements.py --rows 100000
+#   python bench/bench_statements.py --rows 100000 --host localhost --user shinken --password shinken --database glpidb
+
+import os
+import sys
+import time
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+import MySQLdb
+import MySQLdb.converters
+
+from statements import Statement, tab_separated
+
+COLUMNS = ('plugin_monitoring_services_id', 'date', 'event', 'state', 'state_type',
+           'perf_data', 'latency', 'execution_time')
+
+
+def stringify(val):
+    """Former module.stringify"""
+    if isinstance(val, str):
+        val = val.decode('utf8', 'ignore').replace("'", "''")
+    elif isinstance(val, unicode):
+        val = val.replace("'", "''")
+    else:
+        val = unicode(str(val))
+        val = val.replace("'", "''")
+    return val
+
+
+def legacy_bulk_query(table, events):
+    """Former module.bulk_insert query builder"""
+    query = u"INSERT INTO `%s` " % table
+    first = True
+    for (count, event) in enumerate(events):
+        if first:
+            props_str = u' ('
+            i = 0
+            for prop in event:
+                i += 1
+                if i == 1:
+                    props_str = props_str + u"%s " % prop
+                else:
+                    props_str = props_str + u", %s " % prop
+            props_str = props_str + u')'
+            query = query + props_str + u' VALUES'
+            first = False
+
+        i = 0
+        values_str = u' ('
+        for prop in event:
+            i += 1
+            val = event[prop]
+            if isinstance(val, bool):
+                if val:
+                    val = 1
+                else:
+                    val = 0
+            val = stringify(val)
+            if i == 1:
+                values_str = values_str + u"'%s' " % val
+            else:
+                values_str = values_str + u", '%s' " % val
+        values_str = values_str + u')'
+
+        if count == 0:
+            query = query + values_str
+        else:
+            query = query + u"," + values_str
+    return query
+
+
+def make_events(count):
+    events = []
+    for i in range(count):
+        events.append((
+            i % 5000,
+            '2015-06-09 12:%02d:%02d' % (i / 60 % 60, i % 60),
+            "Ok : memory consumption is %d%% - it's fine" % (i % 100),
+            'OK',
+            'HARD',
+            u'consumed=%d%%;80%%;90%%;0%%;100%% used=53%%;;;0%%;100%%' % (i % 100),
+            0.2347090244293213,
+            0.062339067459106445,
+        ))
+    return events
+
+
+def report(name, rows, duration):
+    print "%-40s %8d rows in %2.4fs: %10.0f rows/sec" % (name, rows, duration, rows / duration if duration else 0)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--rows', type='int', default=100000, help='number of events')
+    parser.add_option('--volume', type='int', default=1000, help='rows per INSERT query (commit_volume)')
+    parser.add_option('--host', default=None, help='MySQL server, client side only if not set')
+    parser.add_option('--port', type='int', default=3306)
+    parser.add_option('--user', default='shinken')
+    parser.add_option('--password', default='shinken')
+    parser.add_option('--database', default='glpidb')
+    parser.add_option('--tmpdir', default=None, help='directory of the LOAD DATA files')
+    (options, args) = parser.parse_args()
+
+    events = make_events(options.rows)
+    dict_events = [dict(zip(COLUMNS, event)) for event in events]
+    chunks = range(0, options.rows, options.volume)
+
+    db = None
+    table = 'glpi_plugin_monitoring_serviceevents'
+    if options.host:
+        db = MySQLdb.connect(host=options.host, port=options.port, user=options.user,
+                             passwd=options.password, db=options.database, charset='utf8',
+                             local_infile=1)
+        table = 'bench_serviceevents'
+        db.cursor().execute("CREATE TEMPORARY TABLE `%s` (id INT AUTO_INCREMENT PRIMARY KEY, "
+                            "plugin_monitoring_services_id INT, date DATETIME, event TEXT, "
+                            "state VARCHAR(255), state_type VARCHAR(255), perf_data TEXT, "
+                            "latency VARCHAR(255), execution_time VARCHAR(255))" % table)
+    statement = Statement(table, COLUMNS)
+
+    # Former string builders
+    start = time.time()
+    queries = [legacy_bulk_query(table, dict_events[i:i + options.volume]) for i in chunks]
+    report('string builders (encoding)', options.rows, time.time() - start)
+    if db:
+        cursor = db.cursor()
+        start = time.time()
+        for query in queries:
+            cursor.execute(query)
+            db.commit()
+        report('string builders (encoding excluded)', options.rows, time.time() - start)
+
+    # Statements and parameters binding
+    if db:
+        cursor = db.cursor()
+        start = time.time()
+        for i in chunks:
+            (query, params, many) = statement.insert_many(events[i:i + options.volume])
+            cursor.executemany(query, params)
+            db.commit()
+        report('statements (encoding included)', options.rows, time.time() - start)
+    else:
+        start = time.time()
+        for i in chunks:
+            (query, params, many) = statement.insert_many(events[i:i + options.volume])
+            u",".join([u"(%s)" % u",".join(MySQLdb.escape(row, MySQLdb.converters.conversions)) for row in params])
+        report('statements (encoding)', options.rows, time.time() - start)
+
+    # LOAD DATA LOCAL INFILE, one file for each chunk
+    if db:
+        cursor = db.cursor()
+        start = time.time()
+        try:
+            for i in chunks:
+                (fd, path) = tempfile.mkstemp(suffix='.tsv', dir=options.tmpdir)
+                try:
+                    f = os.fdopen(fd, 'wb')
+                    f.write(tab_separated(events[i:i + options.volume]))
+                    f.close()
+                    (query, params, many) = statement.load_data(path, 'utf8')
+                    cursor.execute(query, params)
+                    db.commit()
+                finally:
+                    os.remove(path)
+            report('LOAD DATA (encoding included)', options.rows, time.time() - start)
+        except MySQLdb.Error as exp:
+            print "LOAD DATA LOCAL INFILE is not allowed: %s" % exp
+    else:
+        start = time.time()
+        for i in chunks:
+            tab_separated(events[i:i + options.volume])
+        report('LOAD DATA file (encoding)', options.rows, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
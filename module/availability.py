@@ -0,0 +1,253 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# This module computes the hosts/services availability stored in the
+# glpi_plugin_monitoring_availabilities table. The daily records are kept
+# in memory, updated on each check result and periodically written back
+# to the database.
+
+import time
+import datetime
+import threading
+
+
+# Database table
+# --------------
+# `hostname` varchar(255) CHARACTER SET latin1 DEFAULT NULL,
+# `service` varchar(255) CHARACTER SET latin1 DEFAULT NULL,
+# `day` DATE DEFAULT NULL,
+# `is_downtime` tinyint(1) DEFAULT '0',
+# `daily_0` int(6) DEFAULT '0',                 Up/Ok
+# `daily_1` int(6) DEFAULT '0',                 Down/Warning
+# `daily_2` int(6) DEFAULT '0',                 Unreachable/Critical
+# `daily_3` int(6) DEFAULT '0',                 Unknown
+# `daily_4` int(6) DEFAULT '86400',             Unchecked
+# `daily_9` int(6) DEFAULT '0',                 Downtime
+# --------------
+COLUMNS = ('hostname', 'service', 'day', 'is_downtime',
+           'daily_0', 'daily_1', 'daily_2', 'daily_3', 'daily_4',
+           'first_check_state', 'first_check_timestamp',
+           'last_check_state', 'last_check_timestamp')
+
+# Columns updated for an existing record
+UPDATED_COLUMNS = ('is_downtime',
+                   'daily_0', 'daily_1', 'daily_2', 'daily_3', 'daily_4',
+                   'last_check_state', 'last_check_timestamp')
+
+SECONDS_PER_DAY = 86400
+
+
+class AvailabilityRecord(object):
+    """
+    Availability of an host/service for one day
+    """
+    __slots__ = ('id', 'pending', 'day', 'is_downtime', 'daily',
+                 'first_check_state', 'first_check_timestamp',
+                 'last_check_state', 'last_check_timestamp')
+
+    def __init__(self, day, state_id, timestamp, is_downtime=False, id=None):
+        self.id = id
+        # Inserted in the database, its id is not yet known
+        self.pending = False
+        self.day = day
+        self.is_downtime = is_downtime
+        # daily_0 to daily_3 durations, daily_4 is computed
+        self.daily = [0, 0, 0, 0]
+        self.first_check_state = state_id
+        self.first_check_timestamp = timestamp
+        self.last_check_state = state_id
+        self.last_check_timestamp = timestamp
+
+    def add(self, state_id, duration):
+        if duration > 0:
+            self.daily[state_id] += duration
+
+    def unchecked(self):
+        # Unchecked state for all day duration minus all states duration
+        return max(0, SECONDS_PER_DAY - sum(self.daily))
+
+    def values(self, columns):
+        """Get the values of the columns (any columns but hostname/service)"""
+        data = {
+            'day': self.day,
+            'is_downtime': '1' if self.is_downtime else '0',
+            'daily_0': self.daily[0],
+            'daily_1': self.daily[1],
+            'daily_2': self.daily[2],
+            'daily_3': self.daily[3],
+            'daily_4': self.unchecked(),
+            'first_check_state': self.first_check_state,
+            'first_check_timestamp': self.first_check_timestamp,
+            'last_check_state': self.last_check_state,
+            'last_check_timestamp': self.last_check_timestamp,
+        }
+        return tuple([data[column] for column in columns])
+
+
+class Availability(object):
+    """
+    In-memory availability of all the hosts/services for the current day.
+
+    Records are identified by (hostname, service), service is '' for an host.
+    Each check result updates the record of the current day, and the records
+    modified since the last call to pop_dirty are returned by this method to be
+    written in the database. The records may be written by another thread.
+    """
+    def __init__(self, now=None):
+        self.lock = threading.RLock()
+        # (hostname, service) -> AvailabilityRecord of the current day
+        self.records = {}
+        # (hostname, service, day) -> AvailabilityRecord to be written
+        self.dirty = {}
+        self.set_day(now or time.time())
+
+    def set_day(self, timestamp):
+        """
+        Set the current day to the day of timestamp. Midnight timestamps are
+        only computed here, once a day.
+        """
+        today = datetime.date.fromtimestamp(timestamp)
+        tomorrow = today + datetime.timedelta(days=1)
+        self.day = today.strftime('%Y-%m-%d')
+        self.day_start = int(time.mktime(today.timetuple()))
+        self.day_end = int(time.mktime(tomorrow.timetuple()))
+
+    def load(self, rows):
+        """
+        Load the records of the current day from the database rows:
+        (id, hostname, service, is_downtime, daily_0, daily_1, daily_2, daily_3,
+         first_check_state, first_check_timestamp, last_check_state, last_check_timestamp)
+
+        Records already known in memory are more recent than the database ones,
+        only their id is updated.
+        """
+        with self.lock:
+            self._load(rows)
+
+    def _load(self, rows):
+        for row in rows:
+            key = (row[1], row[2])
+            if key in self.records:
+                self.records[key].id = row[0]
+                continue
+
+            record = AvailabilityRecord(self.day, row[8], int(row[9]), bool(row[3]), id=row[0])
+            record.daily = [int(row[4]), int(row[5]), int(row[6]), int(row[7])]
+            record.last_check_state = row[10]
+            record.last_check_timestamp = int(row[11])
+            self.records[key] = record
+
+    def set_ids(self, day, rows, records):
+        """
+        Set the database id of the records of day from the rows: (id, hostname, service)
+
+        The ids are got once the records are inserted, maybe after midnight: records
+        are the inserted records, {(hostname, service, day): AvailabilityRecord},
+        which may be closing records of a former day.
+        """
+        with self.lock:
+            for (id, hostname, service) in rows:
+                record = records.get((hostname, service, day))
+                if record is not None and record.day == day and record.id is None:
+                    record.id = id
+                    record.pending = False
+
+    def update(self, hostname, service, state_id, timestamp, is_downtime):
+        """
+        Update the availability of an host/service with a check result or a state
+        change: the last check state lasts until timestamp
+        """
+        with self.lock:
+            self._update(hostname, service, state_id, timestamp, is_downtime)
+
+    def _update(self, hostname, service, state_id, timestamp, is_downtime):
+        if timestamp >= self.day_end:
+            self._rollover(timestamp)
+        elif timestamp < self.day_start:
+            # Check result of a previous day, too late ...
+            return
+
+        # Unknown for any unexpected state
+        if state_id not in (0, 1, 2, 3):
+            state_id = 3
+
+        key = (hostname, service)
+        record = self.records.get(key)
+        if record is None:
+            # First check received today!
+            record = AvailabilityRecord(self.day, state_id, timestamp, is_downtime)
+            self.records[key] = record
+        else:
+            # The last check state lasted until this check
+            record.add(record.last_check_state, timestamp - record.last_check_timestamp)
+            record.last_check_state = state_id
+            record.last_check_timestamp = timestamp
+            record.is_downtime = record.is_downtime or is_downtime
+
+        self.dirty[(hostname, service, self.day)] = record
+
+    def rollover(self, timestamp):
+        """
+        Close the records of the current day and open the new day records
+
+        The last check state of each host/service lasts until midnight and
+        is the first state of the host/service for the new day.
+        """
+        with self.lock:
+            self._rollover(timestamp)
+
+    def _rollover(self, timestamp):
+        day_end = self.day_end
+        records = self.records
+        self.records = {}
+        self.set_day(timestamp)
+
+        for (key, record) in records.iteritems():
+            record.add(record.last_check_state, day_end - record.last_check_timestamp)
+            record.last_check_timestamp = day_end
+            self.dirty[(key[0], key[1], record.day)] = record
+
+            new_record = AvailabilityRecord(self.day, record.last_check_state, self.day_start)
+            self.records[key] = new_record
+            self.dirty[(key[0], key[1], self.day)] = new_record
+
+    def pop_dirty(self):
+        """
+        Get the records to be written in the database:
+        {(hostname, service, day): AvailabilityRecord}
+        """
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = {}
+        return dirty
+
+    def mark_dirty(self, records):
+        """
+        Records that could not be written in the database must be written later
+        """
+        with self.lock:
+            for key in records:
+                self.dirty.setdefault(key, records[key])
@@ -0,0 +1,418 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# Offline rebuild of the glpi_plugin_monitoring_availabilities table. The
+# states history of the hosts/services is read from Shinken log files (the
+# HOST/SERVICE ALERT, CURRENT/INITIAL STATE and DOWNTIME ALERT lines) or from
+# a captured brok stream (pickled broks or lists of broks, one after another
+# in a file), in time order. The daily records of a date range are computed in
+# a single pass, every day is closed with the last known states, and written
+# with multi-row INSERT/UPDATE queries, one day at a time.
+#
+# Only the records missing in the database are inserted (fill mode), or the
+# existing records are also overwritten (replace mode). The current day should
+# not be rebuilt while the broker module is updating it.
+#
+#   python module/backfill.py -c /etc/shinken/modules/glpidb.cfg --from 2015-01-01 --to 2015-03-31 \
+#       /var/log/shinken/archives/*.log
+#   python module/backfill.py --format broks --mode replace --dry-run broks.pickle
+
+import re
+import sys
+import time
+import datetime
+import optparse
+import cPickle
+
+import MySQLdb
+
+from availability import Availability, COLUMNS, UPDATED_COLUMNS
+from statements import Statement
+
+
+TABLE = 'glpi_plugin_monitoring_availabilities'
+
+HOST_STATES = {'UP': 0, 'DOWN': 1, 'UNREACHABLE': 2}
+SERVICE_STATES = {'OK': 0, 'WARNING': 1, 'CRITICAL': 2, 'UNKNOWN': 3}
+
+# [1433822140] SERVICE ALERT: host;service;CRITICAL;HARD;1;output
+# [1433822140] CURRENT HOST STATE: host;UP;HARD;1;output
+# [1433822140] HOST DOWNTIME ALERT: host;STARTED;comment
+# An optional log level may precede the message: [1433822140] INFO: HOST ALERT: ...
+LOG_LINE = re.compile(r'^\[(\d+)\] (?:[A-Z]+: )?'
+                      r'(?:(?:CURRENT|INITIAL) (HOST|SERVICE) STATE|(HOST|SERVICE) (DOWNTIME )?ALERT): (.*)$')
+
+# Default database connection, same as the broker module
+DATABASE = {
+    'host': '127.0.0.1',
+    'port': '3306',
+    'user': 'shinken',
+    'password': 'shinken',
+    'database': 'glpidb',
+    'character_set': 'utf8',
+}
+
+
+def parse_log_line(line):
+    """
+    Get the event of a Shinken log line, None if the line is not a state or
+    downtime change:
+    (timestamp, hostname, service, state_id, downtime)
+
+    For a state change, downtime is None. For a downtime change, state_id is
+    None and downtime is True (started) or False (stopped/cancelled).
+    """
+    match = LOG_LINE.match(line.rstrip('\r\n'))
+    if match is None:
+        return None
+    (timestamp, state_kind, alert_kind, downtime, args) = match.groups()
+    timestamp = int(timestamp)
+    kind = state_kind or alert_kind
+    args = args.split(';')
+
+    if kind == 'HOST':
+        (hostname, service, args) = (args[0], '', args[1:])
+        states = HOST_STATES
+    else:
+        if len(args) < 2:
+            return None
+        (hostname, service, args) = (args[0], args[1], args[2:])
+        states = SERVICE_STATES
+    if not args:
+        return None
+
+    if downtime:
+        return (timestamp, hostname, service, None, args[0] == 'STARTED')
+    return (timestamp, hostname, service, states.get(args[0], 3), None)
+
+
+def read_logs(filenames):
+    """
+    Get the events of Shinken log files, the files are read in the order of
+    their first event
+    """
+    files = []
+    for filename in filenames:
+        f = open(filename)
+        try:
+            for line in f:
+                event = parse_log_line(line)
+                if event is not None:
+                    files.append((event[0], filename))
+                    break
+        finally:
+            f.close()
+
+    for (first, filename) in sorted(files):
+        f = open(filename)
+        try:
+            for line in f:
+                event = parse_log_line(line)
+                if event is not None:
+                    yield event
+        finally:
+            f.close()
+
+
+def read_broks(filenames):
+    """
+    Get the events of captured brok streams: the host/service check results
+    and the log broks. The Shinken package must be importable to unpickle the
+    broks.
+    """
+    for filename in filenames:
+        f = open(filename, 'rb')
+        try:
+            while True:
+                try:
+                    broks = cPickle.load(f)
+                except EOFError:
+                    break
+                if not isinstance(broks, (list, tuple)):
+                    broks = [broks]
+                for brok in broks:
+                    event = brok_event(brok)
+                    if event is not None:
+                        yield event
+        finally:
+            f.close()
+
+
+def brok_event(brok):
+    """
+    Get the event of a brok, None if the brok is not a check result or a log
+    """
+    if hasattr(brok, 'prepare'):
+        brok.prepare()
+    data = brok.data
+    if brok.type == 'log':
+        return parse_log_line(data['log'])
+    if brok.type == 'host_check_result':
+        service = ''
+    elif brok.type == 'service_check_result':
+        service = data['service_description']
+    else:
+        return None
+    # A check result is a state change, with the downtime state of the host/service
+    return (int(data['last_chk']), data['host_name'], service, data['state_id'],
+            bool(data['in_scheduled_downtime']))
+
+
+def backfill(events, first_day, last_day, write):
+    """
+    Compute the availability records of the days first_day to last_day (None
+    for no limits) from the events, in time order. Once a day is closed, its
+    records are given to write(day, {(hostname, service): AvailabilityRecord}).
+    A day is closed with the last known states of the hosts/services, a day
+    without any event lasts with the states of the previous day. The days after
+    the last event are not computed.
+
+    Returns the number of events.
+    """
+    availability = None
+    # Hosts/services in a downtime
+    downtimes = set()
+    count = 0
+
+    def close_day():
+        day = availability.day
+        availability.rollover(availability.day_end)
+        # A downtime lasts on the new day
+        for key in downtimes:
+            record = availability.records.get(key)
+            if record is not None:
+                record.is_downtime = True
+        if first_day and day < first_day or last_day and day > last_day:
+            availability.pop_dirty()
+            return
+        records = {}
+        for ((hostname, service, record_day), record) in availability.pop_dirty().iteritems():
+            if record_day == day:
+                records[(hostname, service)] = record
+        if records:
+            write(day, records)
+
+    for (timestamp, hostname, service, state_id, downtime) in events:
+        count += 1
+        if availability is None:
+            availability = Availability(timestamp)
+        while timestamp >= availability.day_end:
+            close_day()
+        if last_day and availability.day > last_day:
+            break
+
+        key = (hostname, service)
+        if state_id is None:
+            # Downtime change, with the current state of the host/service
+            if downtime:
+                downtimes.add(key)
+            else:
+                downtimes.discard(key)
+            record = availability.records.get(key)
+            if record is None:
+                continue
+            state_id = record.last_check_state
+        elif downtime is not None:
+            if downtime:
+                downtimes.add(key)
+            else:
+                downtimes.discard(key)
+        availability.update(hostname, service, state_id, timestamp, key in downtimes)
+
+    if availability is None:
+        return count
+
+    # Close the day of the last event, unless it is the current day. The
+    # following days are not known from the history.
+    if availability.day_end <= time.time() and not (last_day and availability.day > last_day):
+        close_day()
+    return count
+
+
+class AvailabilityWriter(object):
+    """
+    Write the availability records of a day in the database: the existing
+    records of the day are selected once, the missing records are inserted and,
+    in replace mode, the existing records are updated, with multi-row queries of
+    max. batch rows sized to the server max_allowed_packet.
+    """
+    def __init__(self, db, mode='fill', batch=1000, dry_run=False):
+        self.db = db
+        self.cursor = db.cursor() if db is not None else None
+        self.mode = mode
+        self.batch = batch
+        self.dry_run = dry_run
+        self.insert_statement = Statement(TABLE, COLUMNS)
+        self.update_statement = Statement(TABLE, UPDATED_COLUMNS, ('id',))
+        self.max_allowed_packet = 1024 * 1024
+        if self.cursor is not None:
+            self.cursor.execute("SELECT @@max_allowed_packet")
+            row = self.cursor.fetchone()
+            if row:
+                self.max_allowed_packet = int(row[0])
+
+        # Statistics
+        self.days = 0
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.queries = 0
+
+    def execute(self, statement):
+        (query, params, many) = statement
+        self.queries += 1
+        if many:
+            self.cursor.executemany(query, params)
+        else:
+            self.cursor.execute(query, params)
+
+    def write(self, day, records):
+        self.days += 1
+        existing = {}
+        if self.cursor is not None:
+            self.cursor.execute("SELECT id, hostname, service FROM `%s` WHERE day=%%s" % TABLE, (day,))
+            for (id, hostname, service) in self.cursor.fetchall():
+                existing[(hostname, service or '')] = id
+
+        inserts = []
+        updates = {}
+        for (key, record) in records.iteritems():
+            id = existing.get(key)
+            if id is None:
+                inserts.append(key + record.values(COLUMNS[2:]))
+            elif self.mode == 'replace':
+                updates[(id,)] = record.values(UPDATED_COLUMNS)
+            else:
+                self.skipped += 1
+
+        print "%s: %d records to insert, %d records to update" % (day, len(inserts), len(updates))
+        self.inserted += len(inserts)
+        self.updated += len(updates)
+        if self.dry_run:
+            return
+
+        # Half of the max_allowed_packet for the query itself, the remaining for the protocol
+        max_length = self.max_allowed_packet // 2
+        for (rows, length) in self.insert_statement.chunks(inserts, self.batch, max_length):
+            self.execute(self.insert_statement.insert_many(rows))
+        keys = updates.keys()
+        for i in range(0, len(keys), self.batch):
+            self.execute(self.update_statement.update_many(dict([(key, updates[key]) for key in keys[i:i + self.batch]])))
+        self.db.commit()
+
+
+def read_config(filename):
+    """
+    Get the database parameters of the glpidb module definition of a Shinken
+    configuration file
+    """
+    config = {}
+    in_module = False
+    f = open(filename)
+    try:
+        for line in f:
+            line = line.split('#', 1)[0].split(';', 1)[0].strip()
+            if line.startswith('define') and line.endswith('{'):
+                in_module = line.split()[1] == 'module'
+                current = {}
+            elif line == '}':
+                if in_module and current.get('module_type') == 'glpidb':
+                    config = current
+                in_module = False
+            elif in_module and line:
+                parts = line.split(None, 1)
+                current[parts[0]] = parts[1].strip() if len(parts) > 1 else ''
+    finally:
+        f.close()
+    return config
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] FILE...")
+    parser.add_option('-f', '--format', choices=('log', 'broks'), default='log',
+                      help="input files format: Shinken log files (log) or captured broks (broks) [%default]")
+    parser.add_option('--from', dest='first_day', help="first day to rebuild, YYYY-MM-DD [first day of the input]")
+    parser.add_option('--to', dest='last_day', help="last day to rebuild, YYYY-MM-DD [yesterday]")
+    parser.add_option('-m', '--mode', choices=('fill', 'replace'), default='fill',
+                      help="fill: insert the missing records only, replace: also overwrite the existing records [%default]")
+    parser.add_option('-b', '--batch', type='int', default=1000, help="max. rows per query [%default]")
+    parser.add_option('-n', '--dry-run', action='store_true', default=False,
+                      help="compute the records without writing them")
+    parser.add_option('-c', '--config', help="Shinken configuration file of the glpidb module (database parameters)")
+    for name in ('host', 'port', 'user', 'password', 'database', 'character_set'):
+        parser.add_option('--%s' % name.replace('_', '-'), dest=name, help="database %s" % name.replace('_', ' '))
+    (options, args) = parser.parse_args(argv)
+    if not args:
+        parser.error("no input file")
+
+    for day in (options.first_day, options.last_day):
+        if day:
+            try:
+                time.strptime(day, '%Y-%m-%d')
+            except ValueError:
+                parser.error("invalid day %s, expected YYYY-MM-DD" % day)
+    today = datetime.date.today().strftime('%Y-%m-%d')
+    if not options.last_day:
+        options.last_day = (datetime.date.today() - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+    elif options.last_day >= today:
+        print "warning: the current day is not rebuilt, it is updated by the broker module"
+
+    db = None
+    if not options.dry_run:
+        database = dict(DATABASE)
+        if options.config:
+            database.update(read_config(options.config))
+        for name in DATABASE:
+            if getattr(options, name) is not None:
+                database[name] = getattr(options, name)
+        db = MySQLdb.connect(host=database['host'], user=database['user'],
+                             passwd=database['password'], db=database['database'],
+                             port=int(database['port']))
+        db.set_character_set(database['character_set'])
+        db.cursor().execute('SET NAMES %s;' % database['character_set'])
+
+    writer = AvailabilityWriter(db, options.mode, options.batch, options.dry_run)
+    if options.format == 'broks':
+        events = read_broks(args)
+    else:
+        events = read_logs(args)
+
+    start = time.time()
+    try:
+        count = backfill(events, options.first_day, options.last_day, writer.write)
+    finally:
+        if db is not None:
+            db.close()
+
+    print "%d events, %d days: %d records inserted, %d records updated, %d existing records kept, " \
+          "%d queries in %.1f seconds" % (count, writer.days, writer.inserted, writer.updated,
+                                          writer.skipped, writer.queries, time.time() - start)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,427 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# A database connection of the module, with its transactions. The write
+# operations of the module are run on a connection, by the writer thread that
+# owns it or by the broks management if there is no writer thread. Each
+# connection commits, rolls back and runs again its own operations.
+#
+# When the connection fails, it is reconnected with a jittered exponential
+# backoff: no connection is attempted before next_retry, so that an outage of
+# the database does not end in a reconnection storm.
+
+import time
+import random
+
+import MySQLdb
+from MySQLdb import IntegrityError
+from MySQLdb import ProgrammingError
+from MySQLdb import OperationalError
+from MySQLdb import InternalError
+
+from collections import deque
+
+from shinken.log import logger
+
+
+# Connection errors: server has gone away, lost connection, can't connect
+CONNECTION_ERRORS = (2002, 2003, 2006, 2013, 2055)
+
+# LOAD DATA LOCAL INFILE not allowed: by the server (1148, 3948, 4166 for
+# MariaDB) or by the client library (2068)
+LOAD_DATA_ERRORS = (1148, 2068, 3948, 4166)
+
+# Transient errors, the transaction may succeed if run again: lock wait timeout,
+# deadlock. An operation failing on these errors is run again, max. RETRY_MAX times.
+RETRY_ERRORS = (1205, 1213)
+RETRY_MAX = 3
+
+# Operation that commits the current transaction
+COMMIT = 'COMMIT'
+
+
+class Connection(object):
+    """
+    Database connection
+
+    An operation is either a statement, run with execute_query, or a callable,
+    called with the connection. The database configuration, the transaction
+    mode and the metrics are the ones of the module. on_connect is called with
+    the connection once connected.
+    """
+    def __init__(self, module, name='main', on_connect=None):
+        self.module = module
+        self.name = name
+        self.on_connect = on_connect
+
+        self.db = None
+        self.db_cursor = None
+        self.is_connected = False
+        # Server max_allowed_packet, read on connection
+        self.max_allowed_packet = 1024 * 1024
+
+        # Operations of the current transaction: (operation, on_error)
+        self.transaction = []
+        self.transaction_start = 0
+        # Operations of failed transactions, and operations buffered while not
+        # connected, to be run again one by one
+        self.transaction_replay = deque()
+        self.commits = 0
+
+        # Failed connections in a row, and time of the next connection attempt
+        self.failures = 0
+        self.next_retry = 0
+
+    def open(self):
+        """
+        Connect to the MySQL DB, unless the next connection attempt is delayed
+        by the backoff of the failed connections.
+        """
+        module = self.module
+        if time.time() < self.next_retry:
+            return False
+
+        try:
+            logger.info("[glpidb] Connecting to database %s (%s), connection %s ..." % (module.host, module.database, self.name))
+            options = {}
+            if module.events_load_data:
+                options['local_infile'] = 1
+            self.db = MySQLdb.connect(host=module.host, user=module.user,
+                                      passwd=module.password, db=module.database,
+                                      port=module.port, **options)
+            self.db.set_character_set(module.character_set)
+            self.db_cursor = self.db.cursor()
+            self.db_cursor.execute('SET NAMES %s;' % module.character_set)
+            self.db_cursor.execute('SET CHARACTER SET %s;' % module.character_set)
+            self.db_cursor.execute('SET character_set_connection=%s;' %
+                                   module.character_set)
+            try:
+                self.db_cursor.execute('SELECT @@max_allowed_packet;')
+                self.max_allowed_packet = int(self.db_cursor.fetchone()[0])
+                logger.info('[glpidb] database max_allowed_packet: %d bytes', self.max_allowed_packet)
+            except Exception as exp:
+                logger.warning("[glpidb] max_allowed_packet can not be read, using %d bytes: %s",
+                               self.max_allowed_packet, exp)
+
+            self.is_connected = True
+            self.failures = 0
+            self.next_retry = 0
+            module.metrics.incr('db.connections')
+            logger.info('[glpidb] database connection %s established', self.name)
+
+            if self.on_connect:
+                self.on_connect(self)
+        except Exception as e:
+            self.close_handle()
+            self.is_connected = False
+            self.failures += 1
+            # Exponential backoff, with a random half of the delay against synchronized retries
+            delay = min(module.reconnect_max_delay, module.reconnect_delay * 2 ** (self.failures - 1))
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            self.next_retry = time.time() + delay
+            module.metrics.incr('db.connection_errors')
+            logger.error("[glpidb] database connection %s error: %s, next attempt in %2.1f seconds",
+                         self.name, str(e), delay)
+
+        return self.is_connected
+
+    def close(self):
+        """
+        Close the connection. The operations of the current transaction are lost,
+        they will be run again once connected.
+        """
+        if self.transaction:
+            logger.warning("[glpidb] %d queries of the transaction will be run again", len(self.transaction))
+            self.transaction_replay.extendleft(reversed(self.transaction))
+            self.transaction = []
+        self.close_handle()
+        if self.is_connected:
+            self.is_connected = False
+            self.module.metrics.incr('db.disconnections')
+            logger.info('[glpidb] database connection %s closed', self.name)
+
+    def close_handle(self):
+        """
+        Close the MySQLdb cursor and connection, errors are ignored: the
+        connection may already be lost
+        """
+        for handle in (self.db_cursor, self.db):
+            if handle is None:
+                continue
+            try:
+                handle.close()
+            except Exception:
+                pass
+        self.db_cursor = None
+        self.db = None
+
+    def ping(self):
+        """
+        Check that the connection is still alive, before a batch of operations.
+        The connection is closed if not.
+        """
+        if not self.is_connected:
+            return False
+        try:
+            self.db.ping()
+            return True
+        except Exception as exp:
+            logger.error("[glpidb] database connection %s lost: %s", self.name, exp)
+            self.close()
+            return False
+
+    def buffer(self, operation, on_error=None):
+        """
+        Keep an operation to be run once connected. When more than writer_queue_size
+        operations are waiting, the oldest ones fail.
+        """
+        self.transaction_replay.append((operation, on_error))
+        while len(self.transaction_replay) > self.module.writer_queue_size:
+            (operation, on_error) = self.transaction_replay.popleft()
+            self.module.metrics.incr('db.buffer_dropped')
+            if on_error:
+                on_error()
+
+    def execute_query(self, query, params=None, many=False):
+        """Just run the query, with its parameters. If many, params is a list of
+        parameters, one for each row.
+
+        Return False if the query fails on an integrity or a programming error:
+        only this query failed. The other errors are raised, the transaction is
+        rolled back by run_operation.
+        """
+        logger.debug("[glpidb] run query %s", query)
+        metrics = self.module.metrics
+        start = time.time()
+        try:
+            if many:
+                self.db_cursor.executemany(query, params)
+            else:
+                self.db_cursor.execute(query, params)
+            if not self.transaction:
+                self.db.commit()
+            metrics.query(query, time.time() - start, len(params) if many else 1)
+            return True
+        except IntegrityError, exp:
+            metrics.query(query, time.time() - start, 0, True)
+            logger.warning("[glpidb] A query raised an integrity error: %s, %s", query, exp)
+            return False
+        except ProgrammingError, exp:
+            metrics.query(query, time.time() - start, 0, True)
+            logger.warning("[glpidb] A query raised a programming error: %s, %s", query, exp)
+            return False
+        except Exception:
+            metrics.query(query, time.time() - start, 0, True)
+            raise
+
+    def load_data(self, query, params, rows):
+        """
+        Run a LOAD DATA LOCAL INFILE query of rows rows, as execute_query. Return
+        False if LOAD DATA LOCAL INFILE is not allowed by the server or the client.
+        """
+        logger.debug("[glpidb] run query %s", query)
+        metrics = self.module.metrics
+        start = time.time()
+        try:
+            self.db_cursor.execute(query, params)
+            if not self.transaction:
+                self.db.commit()
+            metrics.query(query, time.time() - start, rows)
+            return True
+        except (OperationalError, ProgrammingError, InternalError), exp:
+            metrics.query(query, time.time() - start, 0, True)
+            if exp.args and exp.args[0] in LOAD_DATA_ERRORS:
+                logger.warning("[glpidb] LOAD DATA LOCAL INFILE is not allowed: %s", exp)
+                return False
+            raise
+        except Exception:
+            metrics.query(query, time.time() - start, 0, True)
+            raise
+
+    def execute_operation(self, operation):
+        """
+        Run a statement or a callable operation. Return False if the statement
+        failed, the callable operations handle their own failures.
+        """
+        if callable(operation):
+            return operation(self)
+        return self.execute_query(*operation)
+
+    def run_operation(self, operation, on_error=None):
+        """
+        Run an operation in the current transaction, and commit the transaction
+        according to the transaction mode. Return False if the operation failed.
+
+        If a query fails, the transaction is rolled back and its operations are run
+        again one by one, so that only the failing operations are lost. If the
+        connection is lost, the operations are run again once connected.
+        """
+        if not self.transaction:
+            self.replay_transactions()
+
+        if operation is COMMIT:
+            return self.commit_transaction()
+
+        if not self.transaction:
+            self.transaction_start = time.time()
+        self.transaction.append((operation, on_error))
+        try:
+            executed = self.execute_operation(operation) is not False
+        except Exception as exp:
+            logger.error("[glpidb] error '%s' when executing query: %s", exp, operation)
+            self.rollback_transaction(exp)
+            return False
+
+        if not executed:
+            # Integrity or programming error: only this query failed, the
+            # transaction goes on without it
+            self.transaction.pop()
+            if on_error:
+                on_error()
+
+        if len(self.transaction) >= self.module.transaction_max_queries:
+            return self.commit_transaction() and executed
+        if self.module.transaction_mode == 'period' and time.time() - self.transaction_start >= self.module.transaction_period:
+            return self.commit_transaction() and executed
+        return executed
+
+    def commit_transaction(self):
+        """
+        Commit the current transaction
+        """
+        if not self.transaction:
+            return True
+
+        try:
+            self.db.commit()
+            self.commits += 1
+            self.transaction = []
+            return True
+        except Exception as exp:
+            logger.error("[glpidb] error '%s' when committing %d queries", exp, len(self.transaction))
+            self.rollback_transaction(exp)
+            return False
+
+    def idle_transaction(self):
+        """
+        Called when no operation is waiting: commit an expired transaction and
+        run again the operations of failed transactions.
+        """
+        if self.module.transaction_mode == 'period' and self.transaction:
+            if time.time() - self.transaction_start >= self.module.transaction_period:
+                self.commit_transaction()
+        if not self.transaction:
+            self.replay_transactions()
+
+    def rollback_transaction(self, exp):
+        """
+        Roll back the current transaction, its operations will be run again one by one
+        """
+        operations = self.transaction
+        self.transaction = []
+        lost = is_error(exp, CONNECTION_ERRORS)
+        if lost:
+            self.close()
+        else:
+            self.rollback()
+
+        if len(operations) == 1 and not lost and not is_error(exp, RETRY_ERRORS):
+            # Nothing to split, the operation failed by itself
+            (operation, on_error) = operations[0]
+            if on_error:
+                on_error()
+            return
+
+        logger.warning("[glpidb] %d queries of the transaction will be run again", len(operations))
+        self.transaction_replay.extendleft(reversed(operations))
+
+    def rollback(self):
+        """
+        Roll back the current transaction of the server, the connection is closed
+        if it fails
+        """
+        try:
+            self.db.rollback()
+        except Exception as exp:
+            logger.error("[glpidb] error '%s' when rolling back transaction", exp)
+            self.close()
+
+    def replay_transactions(self):
+        """
+        Run again, one by one and each in its own transaction, the operations of
+        the failed transactions. An operation failing on a lock wait timeout or a
+        deadlock is run again, max. RETRY_MAX times.
+        """
+        while self.transaction_replay and self.is_connected:
+            (operation, on_error) = self.transaction_replay.popleft()
+            # Runs of the operation since it failed
+            runs = 1
+            while True:
+                self.transaction = [(operation, on_error)]
+                try:
+                    executed = self.execute_operation(operation) is not False
+                    self.db.commit()
+                    self.commits += 1
+                    self.transaction = []
+                    if not executed and on_error:
+                        on_error()
+                    break
+                except Exception as exp:
+                    self.transaction = []
+                    if not is_error(exp, CONNECTION_ERRORS):
+                        self.rollback()
+                    if is_error(exp, CONNECTION_ERRORS) or not self.is_connected:
+                        logger.error("[glpidb] database error '%s', %d queries waiting for connection",
+                                     exp, len(self.transaction_replay) + 1)
+                        self.transaction_replay.appendleft((operation, on_error))
+                        self.close()
+                        return
+                    if is_error(exp, RETRY_ERRORS) and runs < RETRY_MAX:
+                        runs += 1
+                        self.module.metrics.incr('db.retries')
+                        logger.warning("[glpidb] error '%s' when executing query, run again (%d/%d): %s",
+                                       exp, runs, RETRY_MAX, operation)
+                        continue
+                    logger.error("[glpidb] error '%s' when executing query: %s", exp, operation)
+                    if on_error:
+                        on_error()
+                    break
+
+    def fetchone(self):
+        """Just get an entry"""
+        return self.db_cursor.fetchone()
+
+    def fetchall(self):
+        """Get all entry"""
+        return self.db_cursor.fetchall()
+
+
+def is_error(exp, codes):
+    """
+    Is exp a MySQL error of one of the error codes?
+    """
+    return isinstance(exp, OperationalError) and bool(exp.args) and exp.args[0] in codes
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# Approximate memory accounting of the module caches. Sizes are computed with
+# sys.getsizeof, they do not account for shared objects (interned strings,
+# small integers) so they are an upper bound of the memory really used.
+
+import sys
+
+from shinken.log import logger
+
+
+# Overflow policies, applied in the configured order until the memory used
+# is back under the budget:
+# - drop_perfdata: the perf_data of the queued events is dropped, oldest first
+# - drop_ok_oldest: the oldest queued OK events are dropped
+# - spill: the oldest queued events are moved to the on-disk spool
+# - refuse: new events are not queued while the budget is exceeded
+POLICIES = ('drop_perfdata', 'drop_ok_oldest', 'spill', 'refuse')
+
+
+def row_size(row):
+    """
+    Approximate size of a row (tuple of values) in bytes
+    """
+    size = sys.getsizeof(row)
+    for value in row:
+        size += sys.getsizeof(value)
+    return size
+
+
+def object_size(value):
+    """
+    Approximate size of a value in bytes, with the values of a tuple, a dict
+    (recursively) or a __slots__ object
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, tuple):
+        for item in value:
+            size += sys.getsizeof(item)
+    elif isinstance(value, dict):
+        for (key, item) in value.iteritems():
+            size += sys.getsizeof(key) + object_size(item)
+    elif hasattr(value, '__slots__'):
+        for name in value.__slots__:
+            size += sys.getsizeof(getattr(value, name, None))
+    return size
+
+
+def cache_size(cache):
+    """
+    Approximate size of a cache in bytes: a dict of {key: item}
+    """
+    size = sys.getsizeof(cache)
+    for (key, item) in cache.iteritems():
+        size += object_size(key) + object_size(item)
+    return size
+
+
+class MemoryBudget(object):
+    """
+    Memory budget of the module, in bytes (0 for no budget)
+
+    When the budget is exceeded, the overflow policies are applied until the
+    memory used is back under low_watermark * budget, so that the policies
+    are not applied again for each new event. The shed counters count the
+    events affected by each policy.
+    """
+    def __init__(self, budget=0, policies=('spill', 'drop_ok_oldest', 'refuse'), low_watermark=0.9):
+        self.budget = budget
+        self.target = int(budget * low_watermark)
+        self.policies = []
+        for policy in policies:
+            if policy not in POLICIES:
+                logger.warning("[glpidb] unknown memory overflow policy '%s', ignored", policy)
+                continue
+            self.policies.append(policy)
+        self.refuse = 'refuse' in self.policies
+        self.shed = dict([(policy, 0) for policy in POLICIES])
+
+    def exceeded(self, used):
+        return self.budget and used > self.budget
+
+    def get_stats(self):
+        """
+        Get the shed counters, as a copy
+        """
+        return dict(self.shed)
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# Runtime metrics of the module: counters, gauges and latency histograms,
+# periodically written in a JSON stats file for the monitoring tools.
+#
+# Queries metrics are named <table>.<operation> (operation is select, insert,
+# update or delete). Metrics may be updated by the writer thread.
+
+import os
+import time
+import bisect
+import threading
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+# Upper bounds (seconds) of the latency histograms buckets, the last bucket is unbounded
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Names of the queries, the module only runs a few different queries
+QUERIES_CACHE_SIZE = 10000
+_queries = {}
+
+
+def query_name(query):
+    """
+    Get the <table>.<operation> name of a query: INSERT INTO `table` ...
+    """
+    try:
+        return _queries[query]
+    except KeyError:
+        parts = query.split('`', 2)
+        table = parts[1] if len(parts) == 3 else 'unknown'
+        name = '%s.%s' % (table, query.lstrip().split(None, 1)[0].lower())
+        if len(_queries) < QUERIES_CACHE_SIZE:
+            _queries[query] = name
+        return name
+
+
+class Histogram(object):
+    """
+    Latency histogram: count of values in each bucket, sum and max. of the values
+    """
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def get_stats(self):
+        buckets = [[bound, count] for (bound, count) in zip(BUCKETS, self.counts)]
+        buckets.append(['inf', self.counts[-1]])
+        return {'count': self.count, 'sum': self.total, 'max': self.max, 'buckets': buckets}
+
+
+class Metrics(object):
+    """
+    Counters and histograms, the gauges are given when the stats are read
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def query(self, query, duration, rows=1, error=False):
+        """
+        Count a query of rows rows, that lasted duration seconds
+        """
+        name = query_name(query)
+        with self.lock:
+            self.counters['queries.' + name] = self.counters.get('queries.' + name, 0) + 1
+            self.counters['rows.' + name] = self.counters.get('rows.' + name, 0) + rows
+            if error:
+                self.counters['errors.' + name] = self.counters.get('errors.' + name, 0) + 1
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(duration)
+
+    def get_stats(self, gauges=None):
+        now = time.time()
+        with self.lock:
+            return {
+                'time': now,
+                'uptime': now - self.started,
+                'counters': dict(self.counters),
+                'gauges': gauges or {},
+                'histograms': dict([(name, histogram.get_stats())
+                                    for (name, histogram) in self.histograms.iteritems()]),
+            }
+
+
+def merge_stats(stats_list, max_gauges=(), min_gauges=()):
+    """
+    Merge the stats of several processes: the counters, the gauges and the
+    histograms are summed, except the max_gauges (max.) and min_gauges (min.)
+    """
+    merged = {'time': time.time(), 'uptime': 0.0, 'counters': {}, 'gauges': {}, 'histograms': {}}
+    for stats in stats_list:
+        merged['uptime'] = max(merged['uptime'], stats['uptime'])
+        counters = merged['counters']
+        for (name, value) in stats['counters'].iteritems():
+            counters[name] = counters.get(name, 0) + value
+
+        gauges = merged['gauges']
+        for (name, value) in stats['gauges'].iteritems():
+            if name not in gauges:
+                gauges[name] = value
+            elif name in max_gauges:
+                gauges[name] = max(gauges[name], value)
+            elif name in min_gauges:
+                gauges[name] = min(gauges[name], value)
+            else:
+                gauges[name] += value
+
+        histograms = merged['histograms']
+        for (name, histogram) in stats['histograms'].iteritems():
+            if name not in histograms:
+                histograms[name] = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                                    'buckets': [[bound, 0] for (bound, count) in histogram['buckets']]}
+            total = histograms[name]
+            total['count'] += histogram['count']
+            total['sum'] += histogram['sum']
+            total['max'] = max(total['max'], histogram['max'])
+            for (bucket, (bound, count)) in zip(total['buckets'], histogram['buckets']):
+                bucket[1] += count
+    return merged
+
+
+def write_stats(path, stats):
+    """
+    Write the stats in a JSON file, replaced atomically
+    """
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'w')
+    try:
+        json.dump(stats, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
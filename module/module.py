@@ -31,14 +31,12 @@
 # The managed_brok function is called by Broker for manage the broks. It calls
 # the manage_*_brok functions that create queries, and then run queries.
 
-import copy
+import os
 import time
-import datetime
+import tempfile
 import sys
-
-import MySQLdb
-from MySQLdb import IntegrityError
-from MySQLdb import ProgrammingError
+import threading
+import Queue
 
 
 from shinken.basemodule import BaseModule
@@ -46,12 +44,64 @@ from shinken.log import logger
 
 from collections import deque
 
+from availability import Availability
+from availability import COLUMNS as AVAILABILITY_COLUMNS
+from availability import UPDATED_COLUMNS as AVAILABILITY_UPDATED_COLUMNS
+from connection import Connection, COMMIT
+from writer import DBWriter
+from statements import Statement, tab_separated
+from spool import Spool
+from memory import MemoryBudget, row_size, object_size, cache_size
+from record import CheckRecord, GlpiItem, intern_name, format_date
+from snapshot import save_caches, load_caches
+from metrics import Metrics, write_stats
+from shards import Shards, shard_of
+from purge import Purger
+
 properties = {
     'daemons': ['broker'],
     'type': 'glpidb',
     'external': True,
 }
 
+# Updated tables: (columns identifying a row, other columns)
+TABLES = {
+    'glpi_plugin_monitoring_serviceevents': (
+        (), ('plugin_monitoring_services_id', 'date', 'event', 'state', 'state_type',
+             'perf_data', 'latency', 'execution_time')),
+    'glpi_plugin_monitoring_hosts': (
+        ('items_id', 'itemtype'), ('event', 'state', 'state_type', 'last_check',
+                                   'perf_data', 'latency', 'execution_time', 'is_acknowledged')),
+    'glpi_plugin_monitoring_services': (
+        ('id',), ('event', 'state', 'state_type', 'last_check', 'is_acknowledged')),
+    'glpi_plugin_monitoring_servicescatalogs': (
+        ('id',), ('event', 'state', 'state_type', 'last_check', 'is_acknowledged')),
+    'glpi_plugin_monitoring_acknowledges': (
+        ('items_id', 'itemtype'), ('end_time', 'expired')),
+    'glpi_plugin_monitoring_shinkenstates': (
+        ('hostname', 'service'), ('state', 'state_type', 'last_output', 'last_check',
+                                  'last_perfdata', 'is_ack')),
+    'glpi_plugin_monitoring_availabilities': (
+        ('id',), AVAILABILITY_UPDATED_COLUMNS),
+}
+
+# Rows updated in the tables, if not all the rows identified by the columns:
+# only the current acknowledge of an item is expired, not the former ones
+UPDATE_CONDITIONS = {
+    'glpi_plugin_monitoring_acknowledges': 'expired=0',
+}
+
+# Tables groups, the groups are shared by the writer connections in this order
+TABLES_GROUPS = {
+    'glpi_plugin_monitoring_serviceevents': 0,
+    'glpi_plugin_monitoring_services': 1,
+    'glpi_plugin_monitoring_servicescatalogs': 1,
+    'glpi_plugin_monitoring_hosts': 2,
+    'glpi_plugin_monitoring_shinkenstates': 3,
+    'glpi_plugin_monitoring_acknowledges': 4,
+    'glpi_plugin_monitoring_availabilities': 5,
+}
+
 
 # Called by the plugin manager to get a broker
 def get_instance(plugin):
@@ -66,6 +116,8 @@ class Glpidb_broker(BaseModule):
     def __init__(self, modconf):
         BaseModule.__init__(self, modconf)
 
+        # GLPI ids of the hosts/services defined in GLPI:
+        # hostname -> GlpiItem and hostname -> {service: GlpiItem}
         self.hosts_cache = {}
         self.services_cache = {}
 
@@ -92,502 +144,1290 @@ class Glpidb_broker(BaseModule):
         logger.info("[glpidb] updating services states: %s", self.update_services)
         logger.info("[glpidb] updating acknowledges states: %s", self.update_acknowledges)
 
-        self.db = None
-        self.db_cursor = None
-        self.is_connected = False
-
+        # Broks management functions, for the updated tables only. The other broks
+        # are dropped before being prepared (unpickled).
+        glpi_tables = self.update_hosts or self.update_services or self.update_services_events or self.update_acknowledges
+        self.brok_handlers = {}
+        if glpi_tables:
+            self.brok_handlers['clean_all_my_instance_id'] = self.manage_clean_all_my_instance_id_brok
+            self.brok_handlers['initial_host_status'] = self.manage_initial_host_status_brok
+            self.brok_handlers['update_host_status'] = self.manage_update_host_status_brok
+            self.brok_handlers['initial_broks_done'] = self.manage_initial_broks_done_brok
+        if self.update_services or self.update_services_events or self.update_acknowledges:
+            self.brok_handlers['initial_service_status'] = self.manage_initial_service_status_brok
+            self.brok_handlers['update_service_status'] = self.manage_update_service_status_brok
+        if self.update_acknowledges:
+            self.brok_handlers['acknowledge_raise'] = self.manage_acknowledge_raise_brok
+            self.brok_handlers['acknowledge_expire'] = self.manage_acknowledge_expire_brok
+        if glpi_tables or self.update_shinken_state or self.update_availability:
+            self.brok_handlers['host_check_result'] = self.manage_host_check_result_brok
+            self.brok_handlers['service_check_result'] = self.manage_service_check_result_brok
+        logger.info("[glpidb] managed broks: %s", ', '.join(sorted(self.brok_handlers)))
+        # Brok type -> count of managed/dropped broks
+        self.broks_managed = {}
+        self.broks_dropped = {}
+
+        # Sharded mode: the broks are managed by worker_processes processes, each one with
+        # its own caches and database connections, the broks of a host always go to the
+        # same process. shard is the shard of this process (None if not sharded).
+        self.worker_processes = int(getattr(modconf, 'worker_processes', '1'))
+        if self.worker_processes > 1:
+            logger.info('[glpidb] sharded mode: %d worker processes', self.worker_processes)
+        self.shard = None
+        # Queue of the stats of a shard, read by the module process
+        self.stats_queue = None
+
+        # Runtime metrics, written in stats_file (JSON) every stats_period seconds
+        self.metrics = Metrics()
+        self.stats_file = getattr(modconf, 'stats_file', '')
+        self.stats_period = int(getattr(modconf, 'stats_period', '10'))
+        if self.stats_file:
+            logger.info('[glpidb] stats file: %s (period: %ds)', self.stats_file, self.stats_period)
+
+        # Statements of the updated tables
+        self.statements = dict([(table, Statement(table, columns, keys, UPDATE_CONDITIONS.get(table)))
+                                for (table, (keys, columns)) in TABLES.iteritems()])
+        # New availability records
+        self.availability_insert = Statement('glpi_plugin_monitoring_availabilities', AVAILABILITY_COLUMNS)
+
+        # Service events to insert, values in the serviceevents statement columns order
         self.events_cache = deque()
 
         self.commit_period = int(getattr(modconf, 'commit_period', '60'))
         self.commit_volume = int(getattr(modconf, 'commit_volume', '1000'))
+        self.commit_time_budget = float(getattr(modconf, 'commit_time_budget', '5'))
         self.db_test_period = int(getattr(modconf, 'db_test_period', '0'))
         logger.info('[glpidb] periodical commit period: %ds', self.commit_period)
         logger.info('[glpidb] periodical commit volume: %d lines', self.commit_volume)
+        logger.info('[glpidb] periodical commit time budget: %ss', self.commit_time_budget)
+        # The events may be inserted with LOAD DATA LOCAL INFILE, from a tab-separated
+        # temporary file in events_load_data_dir (a tmpfs is best). The INSERT queries are
+        # used again if the server does not allow it.
+        self.events_load_data = bool(getattr(modconf, 'events_load_data', '0')=='1')
+        self.events_load_data_dir = getattr(modconf, 'events_load_data_dir', '')
+        if self.events_load_data:
+            logger.info('[glpidb] events inserted with LOAD DATA LOCAL INFILE (directory: %s)',
+                        self.events_load_data_dir or tempfile.gettempdir())
+        # Server max_allowed_packet, read on connection, the insert queries are sized to fit in
+        self.max_allowed_packet = 1024 * 1024
+        # Events insertion statistics: chunks, events, time, max_time
+        self.insert_stats = {'chunks': 0, 'events': 0, 'time': 0.0, 'max_time': 0.0}
+        self.insert_lock = threading.Lock()
         logger.info('[glpidb] periodical DB connection test period: %ds', self.db_test_period)
+        # Reconnection backoff: the delay between connection attempts is doubled after
+        # each failed attempt, from reconnect_delay up to reconnect_max_delay seconds
+        self.reconnect_delay = float(getattr(modconf, 'reconnect_delay', '1'))
+        self.reconnect_max_delay = float(getattr(modconf, 'reconnect_max_delay', '60'))
+        logger.info('[glpidb] reconnection delay: %ss to %ss', self.reconnect_delay, self.reconnect_max_delay)
+
+        # On-disk spool of the service events, used when the database is not available
+        # or when more than spool_threshold events are waiting in memory
+        self.spool = None
+        self.spool_dir = getattr(modconf, 'spool_dir', '')
+        self.spool_threshold = int(getattr(modconf, 'spool_threshold', '100000'))
+        self.spool_segment_size = int(getattr(modconf, 'spool_segment_size', '16'))
+        if self.spool_dir:
+            logger.info('[glpidb] events spool: %s (threshold: %d events, segments: %d MB)',
+                        self.spool_dir, self.spool_threshold, self.spool_segment_size)
+
+        # Snapshot of the GLPI ids caches (empty to disable), loaded on start. The items
+        # of the snapshot are replaced by the initial broks, and the items of a scheduler
+        # that were not received again are removed when its initial broks are done.
+        self.cache_snapshot = getattr(modconf, 'cache_snapshot', '')
+        if self.cache_snapshot:
+            logger.info('[glpidb] caches snapshot: %s', self.cache_snapshot)
+        self.caches_modified = False
+        # Scheduler instance_id -> generation of its configuration, increased on each new
+        # configuration. The items of a scheduler older than its generation are removed
+        # when its initial broks are done. Snapshot items are of generation 0.
+        self.generations = {}
+
+        # Memory budget (MB, 0 for no budget) of the events, hosts and services caches,
+        # the overflow policies are applied in the configured order when it is exceeded
+        memory_budget = int(getattr(modconf, 'memory_budget', '0'))
+        policies = getattr(modconf, 'memory_overflow_policy', 'spill,drop_ok_oldest,refuse')
+        self.memory = MemoryBudget(memory_budget * 1024 * 1024,
+                                   [policy.strip() for policy in policies.split(',') if policy.strip()])
+        logger.info('[glpidb] memory budget: %d MB, overflow policies: %s',
+                    memory_budget, ', '.join(self.memory.policies))
+        # Approximate size of the events cache, and of the hosts/services caches (None when modified)
+        self.events_bytes = 0
+        self.caches_bytes = None
+
+        # Write-behind for hosts/services states: only the latest state of each item is kept
+        # and all the modified items are updated every state_flush_period seconds.
+        # 0 to update the tables on each check result.
+        self.state_flush_period = int(getattr(modconf, 'state_flush_period', '0'))
+        logger.info('[glpidb] periodical states flush period: %ds', self.state_flush_period)
+        # table -> {item key: values}
+        self.states_cache = {}
+
+        # Change detection: the hosts/services states are not updated if they did not change
+        # since the last update (state, state type, acknowledge, output and optionally
+        # perf_data), unless the last update is older than state_max_staleness seconds.
+        self.state_change_detection = bool(getattr(modconf, 'state_change_detection', '0')=='1')
+        self.state_max_staleness = int(getattr(modconf, 'state_max_staleness', '300'))
+        self.state_fingerprint_perfdata = bool(getattr(modconf, 'state_fingerprint_perfdata', '0')=='1')
+        logger.info('[glpidb] states change detection: %s (max. staleness: %ds, perf_data: %s)',
+                    self.state_change_detection, self.state_max_staleness, self.state_fingerprint_perfdata)
+        # (table, item key) -> (fingerprint, last check timestamp) of the last update
+        self.fingerprints = {}
+        self.states_writes = {'emitted': 0, 'suppressed': 0}
+
+        # Services events sampling: the state changes and the non-OK results are always
+        # recorded, the steady OK results only every events_sampling_period seconds and/or
+        # every events_sampling_count checks (0 for all the results). The perf_data of the
+        # sampled OK results are kept, dropped or truncated to events_perfdata_max_length.
+        self.events_sampling_period = int(getattr(modconf, 'events_sampling_period', '0'))
+        self.events_sampling_count = int(getattr(modconf, 'events_sampling_count', '0'))
+        self.events_sampling = self.events_sampling_period > 0 or self.events_sampling_count > 1
+        self.events_sampled_perfdata = getattr(modconf, 'events_sampled_perfdata', 'keep')
+        if self.events_sampled_perfdata not in ('keep', 'drop', 'truncate'):
+            logger.warning("[glpidb] unknown sampled perf_data policy '%s', using 'keep'", self.events_sampled_perfdata)
+            self.events_sampled_perfdata = 'keep'
+        self.events_perfdata_max_length = int(getattr(modconf, 'events_perfdata_max_length', '255'))
+        if self.events_sampling:
+            logger.info('[glpidb] services events sampling: every %ds / %d checks, perf_data: %s',
+                        self.events_sampling_period, self.events_sampling_count, self.events_sampled_perfdata)
+        # Service id -> [(state, state type), timestamp of the last recorded event, steady
+        # OK results since the last recorded event]
+        self.events_sampling_states = {}
+        self.events_writes = {'recorded': 0, 'sampled': 0, 'skipped': 0}
+
+        # hostname/service of the records existing in the Shinken state table
+        self.shinken_states = set()
+
+        # (items_id, itemtype) of the items with an open acknowledge, loaded when the
+        # module connects to the database and maintained from the broks. Only the
+        # acknowledges of the items that recover are expired, with the states updates.
+        self.acknowledges = set()
+
+        # Every availability_flush_period seconds, the availability records modified
+        # since the last flush are written in the database.
+        self.availability_flush_period = int(getattr(modconf, 'availability_flush_period', '60'))
+        logger.info('[glpidb] periodical availability flush period: %ds', self.availability_flush_period)
+        self.availability = Availability()
+
+        # Retention of the service events and availability records (days, 0 to keep
+        # them forever). The expired rows are deleted by a background thread, every
+        # purge_period seconds, by chunks of purge_chunk_size rows with a pause of
+        # purge_pause seconds after each chunk.
+        self.events_retention = int(getattr(modconf, 'events_retention', '0'))
+        self.availability_retention = int(getattr(modconf, 'availability_retention', '0'))
+        self.purge_period = int(getattr(modconf, 'purge_period', '3600'))
+        self.purge_chunk_size = int(getattr(modconf, 'purge_chunk_size', '1000'))
+        self.purge_pause = float(getattr(modconf, 'purge_pause', '0.5'))
+        logger.info('[glpidb] retention: events %d days, availability %d days (0: no purge)',
+                    self.events_retention, self.availability_retention)
+        self.purger = None
+
+        # Database writer threads: the queries are run by dedicated threads that own
+        # the database connections, so that the broks management is never blocked
+        # by the database. When a queue is full, the writer_queue_policy is:
+        # block (wait for the writer), drop_new or drop_old (drop queued queries)
+        self.writers = []
+        self.writer_thread = bool(getattr(modconf, 'writer_thread', '1')=='1')
+        self.writer_queue_size = int(getattr(modconf, 'writer_queue_size', '10000'))
+        self.writer_queue_policy = getattr(modconf, 'writer_queue_policy', 'block')
+        logger.info('[glpidb] database writer thread: %s', self.writer_thread)
+        logger.info('[glpidb] database writer queue: %d queries, policy: %s', self.writer_queue_size, self.writer_queue_policy)
+
+        # Database transactions, the queries are committed:
+        # - statement: after each query
+        # - batch: after all the queries of a broks batch
+        # - period: every transaction_period seconds
+        # and at least every transaction_max_queries queries
+        self.transaction_mode = getattr(modconf, 'transaction_mode', 'statement')
+        if self.transaction_mode not in ('statement', 'batch', 'period'):
+            logger.warning("[glpidb] unknown transaction mode '%s', using 'statement'", self.transaction_mode)
+            self.transaction_mode = 'statement'
+        self.transaction_period = float(getattr(modconf, 'transaction_period', '1'))
+        self.transaction_max_queries = int(getattr(modconf, 'transaction_max_queries', '1000'))
+        if self.transaction_mode == 'statement':
+            self.transaction_max_queries = 1
+        logger.info('[glpidb] transaction mode: %s (period: %ss, max. %d queries)',
+                    self.transaction_mode, self.transaction_period, self.transaction_max_queries)
+
+        # Database connections, each one owned by a writer thread. The operations on an
+        # item are always run by the same connection, so that they are run in order:
+        # - table: the tables groups are shared by the connections
+        # - item: the items of each table are shared by the connections (hash of the item key)
+        # The availability records are always written by a single connection.
+        self.writer_connections = max(1, int(getattr(modconf, 'writer_connections', '1')))
+        self.writer_partition = getattr(modconf, 'writer_partition', 'table')
+        if self.writer_partition not in ('table', 'item'):
+            logger.warning("[glpidb] unknown writer partition '%s', using 'table'", self.writer_partition)
+            self.writer_partition = 'table'
+        if not self.writer_thread:
+            self.writer_connections = 1
+        logger.info('[glpidb] database writer connections: %d, partition: %s',
+                    self.writer_connections, self.writer_partition)
+        # The main connection loads the tables records when connected
+        self.connections = [Connection(self, '0', self.connected)]
+        for i in range(1, self.writer_connections):
+            self.connections.append(Connection(self, str(i)))
+        self.connection = self.connections[0]
 
     def init(self):
         return True
 
     def open(self):
         """
-        Connect to the MySQL DB.
+        Connect to the MySQL DB, with the main connection.
         """
+        return self.connection.open()
+
+    def connected(self, connection):
+        """
+        Called when the main connection is established
+        """
+        self.max_allowed_packet = connection.max_allowed_packet
+        if self.update_shinken_state:
+            self.load_shinken_states(connection)
+        if self.update_acknowledges:
+            self.load_acknowledges(connection)
+        if self.update_availability:
+            self.load_availability(connection)
+
+    def load_shinken_states(self, connection):
+        """
+        Load the hostname/service of all the records of the Shinken state table.
+        Called on each connection, the records may have changed while disconnected.
+        """
+        query = "SELECT hostname, service FROM `glpi_plugin_monitoring_shinkenstates`;"
         try:
-            logger.info("[glpidb] Connecting to database %s (%s) ..." % (self.host, self.database))
-            self.db = MySQLdb.connect(host=self.host, user=self.user,
-                                      passwd=self.password, db=self.database,
-                                      port=self.port)
-            self.db.set_character_set(self.character_set)
-            self.db_cursor = self.db.cursor()
-            self.db_cursor.execute('SET NAMES %s;' % self.character_set)
-            self.db_cursor.execute('SET CHARACTER SET %s;' % self.character_set)
-            self.db_cursor.execute('SET character_set_connection=%s;' %
-                                   self.character_set)
-
-            self.is_connected = True
-            logger.info('[glpidb] database connection established')
-        except Exception as e:
-            logger.error("[glpidb] database connection error: %s", str(e))
-            self.is_connected = False
-
-        return self.is_connected
-
-    def close(self):
-        self.is_connected = False
-        logger.info('[glpidb] database connection closed')
-
-    def stringify(self, val):
-        """Get a unicode from a value"""
-        # If raw string, go in unicode
-        if isinstance(val, str):
-            val = val.decode('utf8', 'ignore').replace("'", "''")
-        elif isinstance(val, unicode):
-            val = val.replace("'", "''")
-        else:  # other type, we can str
-            val = unicode(str(val))
-            val = val.replace("'", "''")
-        return val
-
-    def create_insert_query(self, table, data):
-        """Create a INSERT query in table with all data of data (a dict)"""
-        query = u"INSERT INTO %s " % (table)
-        props_str = u' ('
-        values_str = u' ('
-        i = 0  # f or the ',' problem... look like C here...
-        for prop in data:
-            i += 1
-            val = data[prop]
-            # Boolean must be catch, because we want 0 or 1, not True or False
-            if isinstance(val, bool):
-                if val:
-                    val = 1
-                else:
-                    val = 0
-
-            # Get a string of the value
-            val = self.stringify(val)
-
-            if i == 1:
-                props_str = props_str + u"%s " % prop
-                values_str = values_str + u"'%s' " % val
-            else:
-                props_str = props_str + u", %s " % prop
-                values_str = values_str + u", '%s' " % val
-
-        # Ok we've got data, let's finish the query
-        props_str = props_str + u' )'
-        values_str = values_str + u' )'
-        query = query + props_str + u' VALUES' + values_str
-        return query
-
-    def create_update_query(self, table, data, where_data):
-        """Create a update query of table with data, and use where data for
-        the WHERE clause
-        """
-        query = u"UPDATE %s set " % (table)
-
-        # First data manage
-        query_follow = ''
-        i = 0  # for the , problem...
-        for prop in data:
-            # Do not need to update a property that is in where
-            # it is even dangerous, will raise a warning
-            if prop not in where_data:
-                i += 1
-                val = data[prop]
-                # Boolean must be catch, because we want 0 or 1, not True or False
-                if isinstance(val, bool):
-                    if val:
-                        val = 1
-                    else:
-                        val = 0
-
-                # Get a string of the value
-                val = self.stringify(val)
-
-                if i == 1:
-                    query_follow += u"%s='%s' " % (prop, val)
-                else:
-                    query_follow += u", %s='%s' " % (prop, val)
-
-        # Ok for data, now WHERE, same things
-        where_clause = u" WHERE "
-        i = 0  # For the 'and' problem
-        for prop in where_data:
-            i += 1
-            val = where_data[prop]
-            # Boolean must be catch, because we want 0 or 1, not True or False
-            if isinstance(val, bool):
-                if val:
-                    val = 1
-                else:
-                    val = 0
-
-            # Get a string of the value
-            val = self.stringify(val)
-
-            if i == 1:
-                where_clause += u"%s='%s' " % (prop, val)
-            else:
-                where_clause += u"and %s='%s' " % (prop, val)
+            connection.db_cursor.execute(query)
+            self.shinken_states = set([(intern_name(hostname), intern_name(service))
+                                       for (hostname, service) in connection.db_cursor.fetchall()
+                                       if self.owns(hostname)])
+            logger.info("[glpidb] loaded %d Shinken states records", len(self.shinken_states))
+        except Exception as exp:
+            # No more table update because table does not exist or is bad formed ...
+            self.update_shinken_state = False
+            logger.error("[glpidb] error '%s' when executing query: %s", exp, query)
 
-        query = query + query_follow + where_clause
-        return query
+    def load_acknowledges(self, connection):
+        """
+        Load the items of the open acknowledges.
+        Called on each connection, the acknowledges may have changed while disconnected.
+        """
+        query = "SELECT items_id, itemtype FROM `glpi_plugin_monitoring_acknowledges` WHERE expired=0;"
+        try:
+            connection.db_cursor.execute(query)
+            self.acknowledges = set([(str(items_id), itemtype)
+                                     for (items_id, itemtype) in connection.db_cursor.fetchall()])
+            logger.info("[glpidb] loaded %d open acknowledges", len(self.acknowledges))
+        except Exception as exp:
+            # No more table update because table does not exist or is bad formed ...
+            self.update_acknowledges = False
+            logger.error("[glpidb] error '%s' when executing query: %s", exp, query)
 
-    def execute_query(self, query, do_debug=False):
-        """Just run the query
-        TODO: finish catch
+    def load_availability(self, connection):
+        """
+        Load the availability records of the current day.
+        Called on each connection, the records known in memory are kept.
         """
-        logger.debug("[glpidb] run query %s", query)
+        query = """SELECT id, hostname, service, is_downtime,
+                    daily_0, daily_1, daily_2, daily_3,
+                    first_check_state, first_check_timestamp,
+                    last_check_state, last_check_timestamp
+                    FROM `glpi_plugin_monitoring_availabilities`
+                    WHERE day=%s;"""
         try:
-            self.db_cursor.execute(query)
-            self.db.commit()
+            connection.db_cursor.execute(query, (self.availability.day,))
+            rows = [row for row in connection.db_cursor.fetchall() if self.owns(row[1])]
+            self.availability.load(rows)
+            logger.info("[glpidb] loaded %d availability records for %s", len(rows), self.availability.day)
+        except Exception as exp:
+            # No more table update because table does not exist or is bad formed ...
+            self.update_availability = False
+            logger.error("[glpidb] error '%s' when executing query: %s", exp, query)
+
+    def owns(self, hostname):
+        """
+        Is a host managed by this process? Always, unless in sharded mode
+        """
+        return self.shard is None or shard_of(hostname, self.worker_processes) == self.shard
+
+    def db_available(self, ping=False):
+        """
+        Is the database available for write queries? Without a writer thread,
+        check that the connection is still alive if ping (before a batch of queries)
+        or try to connect now, unless the next connection attempt is delayed. Else
+        the writer threads manage the connections.
+        """
+        if self.writers:
+            return all([connection.is_connected for connection in self.connections])
+        if self.connection.is_connected and (not ping or self.connection.ping()):
             return True
-        except IntegrityError, exp:
-            logger.warning("[glpidb] A query raised an integrity error: %s, %s", query, exp)
-            return False
-        except ProgrammingError, exp:
-            logger.warning("[glpidb] A query raised a programming error: %s, %s", query, exp)
-            return False
+        return self.open()
 
-    def fetchone(self):
-        """Just get an entry"""
-        return self.db_cursor.fetchone()
+    def partition(self, table, key=None):
+        """
+        Index of the connection that runs the operations on the item (key) of a table,
+        or on several items of a table if key is None (and the items are not partitioned)
+        """
+        if len(self.connections) == 1:
+            return 0
+        if self.writer_partition == 'item' and key is not None and table != 'glpi_plugin_monitoring_availabilities':
+            return hash(key) % len(self.connections)
+        return TABLES_GROUPS.get(table, 0) % len(self.connections)
+
+    def partitions(self, table, items, key=None):
+        """
+        Split items (rows or keys) of a table in lists of items of the same connection,
+        keeping their order. key gets the key of an item, the item itself by default.
+        """
+        if len(self.connections) == 1 or self.writer_partition != 'item':
+            return [items]
+        parts = {}
+        for item in items:
+            parts.setdefault(self.partition(table, key(item) if key else item), []).append(item)
+        return parts.values()
+
+    def submit_query(self, operation, on_error=None, table=None, key=None):
+        """
+        Run a write operation (a statement or a callable) in the writer thread of the
+        item (key) of table if enabled, else run it now. If the operation fails,
+        on_error is called. COMMIT is run by all the writer threads.
+        """
+        if self.writers:
+            if operation is COMMIT:
+                for writer in self.writers:
+                    writer.put(COMMIT)
+            else:
+                self.writers[self.partition(table, key)].put(operation, on_error)
+            return
 
-    def fetchall(self):
-        """Get all entry"""
-        return self.db_cursor.fetchall()
+        if self.db_available():
+            self.connection.run_operation(operation, on_error)
+        elif operation is not COMMIT:
+            self.connection.buffer(operation, on_error)
 
     def bulk_insert(self):
         """
-        Peridically called (commit_period), this method prepares a bunch of queued
-        insertions (max. commit_volume) to insert them in the DB.
+        Peridically called (commit_period), this method inserts the queued events
+        in chunks of max. commit_volume rows, sized to fit in the max_allowed_packet
+        of the server, until all the events are inserted or the commit_time_budget
+        is elapsed. The writer queue is not filled more than half, the remaining
+        events are inserted on next call.
         """
-        logger.info("[glpidb] bulk insertion ... %d events in cache (max insertion is %d lines)", len(self.events_cache), self.commit_volume)
-
         if not self.events_cache:
-            logger.info("[glpidb] bulk insertion ... nothing to insert.")
+            logger.debug("[glpidb] bulk insertion ... nothing to insert.")
             return
 
-        if not self.is_connected:
-            if not self.open():
-                logger.warning("[glpidb] database is not connected and connection failed")
-                logger.warning("[glpidb] %d events to insert in database", len(self.events_cache))
-                return
+        if not self.db_available(True):
+            logger.warning("[glpidb] database is not connected")
+            logger.warning("[glpidb] %d events to insert in database", len(self.events_cache))
+            if self.spool is not None:
+                self.spool_events()
+            return
+
+        start = time.time()
+        table = 'glpi_plugin_monitoring_serviceevents'
+        statement = self.statements[table]
+        max_length = self.max_allowed_packet / 2 - len(statement.insert_query)
+        # Chunk being built for each connection: [rows, length]. The events of a
+        # chunk are of the same partition, the key of the first event routes the chunk.
+        pending = {}
+        (events, chunks) = (0, 0)
+        while self.events_cache:
+            row = self.events_cache[0]
+            index = self.partition(table, row[0])
+            values_length = statement.values_length(row)
+            chunk = pending.get(index)
+            if chunk is not None and (len(chunk[0]) >= self.commit_volume or chunk[1] + values_length > max_length):
+                self.submit_chunk(chunk[0], chunk[1])
+                events += len(chunk[0])
+                chunks += 1
+                chunk = pending[index] = None
+
+            if chunk is None:
+                if time.time() - start >= self.commit_time_budget:
+                    break
+                if self.writers and self.writers[index].qsize() >= self.writer_queue_size / 2:
+                    break
+                chunk = pending[index] = [[], 0]
+            chunk[0].extend(self.pop_events(1))
+            chunk[1] += values_length
 
-        logger.info("[glpidb] %d lines to insert in database (max insertion is %d lines)", len(self.events_cache), self.commit_volume)
+        for chunk in pending.values():
+            if chunk is not None:
+                self.submit_chunk(chunk[0], chunk[1])
+                events += len(chunk[0])
+                chunks += 1
 
-        # Flush all the stored log lines
-        events_to_commit = 1
-        now = time.time()
-        some_events = []
+        logger.info("[glpidb] bulk insertion ... %d events in %d chunks (%2.4f), %d events in cache",
+                    events, chunks, time.time() - start, len(self.events_cache))
+        self.metrics.observe('flush.events', time.time() - start)
 
-        # Prepare a query as:
-        # INSERT INTO tbl_name (a,b,c)
-        # VALUES (1,2,3), (4,5,6), (7,8,9);
-        query = u"INSERT INTO `glpi_plugin_monitoring_serviceevents` "
+    def submit_chunk(self, rows, length):
+        """
+        Submit the insertion of a chunk of events, the events are spooled if the
+        insertion fails and the spool is enabled
+        """
+        on_error = self.keep_spooled(rows) if self.spool is not None else None
+        self.submit_query(self.insert_chunk(rows, length, on_error), on_error,
+                          'glpi_plugin_monitoring_serviceevents', rows[0][0])
 
-        first = True
-        while True:
+    def insert_chunk(self, rows, length, on_error=None):
+        """
+        Get an operation that inserts a chunk of events and times the insertion
+        """
+        statement = self.statements['glpi_plugin_monitoring_serviceevents'].insert_many(rows)
+
+        def operation(connection):
+            start = time.time()
+            if not self.events_load_data or not self.load_events(connection, rows):
+                if not connection.execute_query(*statement) and on_error:
+                    on_error()
+            duration = time.time() - start
+            logger.debug("[glpidb] inserted %d events (%d bytes) in %2.4f", len(rows), length, duration)
+
+            with self.insert_lock:
+                self.insert_stats['chunks'] += 1
+                self.insert_stats['events'] += len(rows)
+                self.insert_stats['time'] += duration
+                self.insert_stats['max_time'] = max(self.insert_stats['max_time'], duration)
+        return operation
+
+    def load_events(self, connection, rows):
+        """
+        Insert events with LOAD DATA LOCAL INFILE, from a tab-separated temporary file.
+        Return False if the events are to be inserted with an INSERT query: LOAD DATA
+        LOCAL INFILE is disabled if it is not allowed by the server.
+        """
+        statement = self.statements['glpi_plugin_monitoring_serviceevents']
+        encoding = 'utf-8' if self.character_set.startswith('utf8') else self.character_set
+        try:
+            (fd, path) = tempfile.mkstemp(prefix='glpidb-events-', suffix='.tsv',
+                                          dir=self.events_load_data_dir or None)
+        except (IOError, OSError) as exp:
+            logger.error("[glpidb] events file can not be created: %s", exp)
+            return False
+        try:
+            f = os.fdopen(fd, 'wb')
             try:
-                event = self.events_cache.popleft()
-
-                if first:
-                    props_str = u' ('
-                    i = 0
-                    for prop in event:
-                        i += 1
-                        if i == 1:
-                            props_str = props_str + u"%s " % prop
-                        else:
-                            props_str = props_str + u", %s " % prop
-                    props_str = props_str + u')'
-                    query = query + props_str + u' VALUES'
-                    first = False
-
-                i = 0
-                values_str = u' ('
-                for prop in event:
-                    i += 1
-                    val = event[prop]
-                    # Boolean must be catched, because we want 0 or 1, not True or False
-                    if isinstance(val, bool):
-                        if val:
-                            val = 1
-                        else:
-                            val = 0
-
-                    # Get a string for the value
-                    val = self.stringify(val)
-
-                    if i == 1:
-                        values_str = values_str + u"'%s' " % val
-                    else:
-                        values_str = values_str + u", '%s' " % val
-                values_str = values_str + u')'
-
-                if events_to_commit == 1:
-                    query = query + values_str
-                else:
-                    query = query + u"," + values_str
-
-                events_to_commit = events_to_commit + 1
-                if events_to_commit >= self.commit_volume:
-                    break
-            except IndexError:
-                logger.debug("[glpidb] prepared all available events for commit")
+                f.write(tab_separated(rows, encoding))
+            finally:
+                f.close()
+            (query, params, many) = statement.load_data(path, self.character_set)
+            if connection.load_data(query, params, len(rows)):
+                return True
+            logger.warning("[glpidb] events are inserted with INSERT queries")
+            self.events_load_data = False
+            return False
+        except (IOError, OSError) as exp:
+            logger.error("[glpidb] events file %s can not be written: %s", path, exp)
+            return False
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get_insert_stats(self):
+        """
+        Get the events insertion statistics, they are reset on each call
+        """
+        with self.insert_lock:
+            stats = self.insert_stats
+            self.insert_stats = {'chunks': 0, 'events': 0, 'time': 0.0, 'max_time': 0.0}
+        return stats
+
+    def queue_event(self, row):
+        """
+        Queue a service event to be inserted, unless the memory budget is exceeded
+        and the refuse overflow policy is set
+        """
+        if self.memory.refuse and self.memory.budget and self.memory.exceeded(self.memory_used()):
+            self.memory.shed['refuse'] += 1
+            return False
+
+        self.events_cache.append(row)
+        self.events_bytes += row_size(row)
+        return True
+
+    def pop_events(self, count=None):
+        """
+        Get the oldest events of the events cache (max. count)
+        """
+        rows = []
+        while self.events_cache and (count is None or len(rows) < count):
+            row = self.events_cache.popleft()
+            self.events_bytes -= row_size(row)
+            rows.append(row)
+        return rows
+
+    def requeue_events(self, rows):
+        """
+        Put back events at the head of the events cache
+        """
+        self.events_cache.extendleft(reversed(rows))
+        for row in rows:
+            self.events_bytes += row_size(row)
+
+    def memory_used(self):
+        """
+        Approximate memory used by the events, hosts and services caches. The caches
+        are only walked once, their size is then updated with each item change.
+        """
+        if self.caches_bytes is None:
+            self.caches_bytes = cache_size(self.hosts_cache) + cache_size(self.services_cache)
+        return self.events_bytes + self.caches_bytes
+
+    def set_cache_item(self, cache, key, item):
+        """
+        Set the item of key in a cache (hosts cache or services of an host), or remove
+        it if item is None, and update the size of the caches. Returns the former item.
+        """
+        size = sys.getsizeof(cache)
+        if item is None:
+            old = cache.pop(key, None)
+        else:
+            old = cache.get(key)
+            cache[key] = item
+        if self.caches_bytes is not None:
+            self.caches_bytes += sys.getsizeof(cache) - size
+            if old is not None:
+                self.caches_bytes -= object_size(key) + object_size(old)
+            if item is not None:
+                self.caches_bytes += object_size(key) + object_size(item)
+        return old
+
+    def enforce_memory_budget(self):
+        """
+        Apply the overflow policies if the memory budget is exceeded
+        """
+        if not self.memory.budget:
+            return
+        used = self.memory_used()
+        if not self.memory.exceeded(used):
+            return
+
+        start = used
+        for policy in self.memory.policies:
+            if policy == 'refuse':
+                continue
+            used -= getattr(self, 'shed_' + policy)(used - self.memory.target)
+            if used <= self.memory.target:
                 break
-            except Exception, exp:
-                logger.error("[glpidb] exception: %s", str(exp))
-        logger.info("[glpidb] time to prepare %s events for commit (%2.4f)", events_to_commit-1, time.time() - now)
-        logger.info("[glpidb] query: %s", query)
+        logger.warning("[glpidb] memory budget exceeded: %d bytes used, %d bytes after overflow policies "
+                       "(budget: %d bytes)", start, used, self.memory.budget)
+
+    def shed_drop_perfdata(self, excess):
+        """
+        Drop the perf_data of the oldest events, until excess bytes are freed
+        """
+        freed = 0
+        count = 0
+        rows = list(self.events_cache)
+        for (index, row) in enumerate(rows):
+            if freed >= excess:
+                break
+            if not row[5]:
+                continue
+            rows[index] = row[:5] + ('',) + row[6:]
+            freed += row_size(row) - row_size(rows[index])
+            count += 1
+
+        if count:
+            self.events_cache = deque(rows)
+            self.events_bytes -= freed
+            self.memory.shed['drop_perfdata'] += count
+        return freed
+
+    def shed_drop_ok_oldest(self, excess):
+        """
+        Drop the oldest OK events, until excess bytes are freed
+        """
+        freed = 0
+        count = 0
+        rows = deque()
+        for row in self.events_cache:
+            if freed < excess and row[3] == 'OK':
+                freed += row_size(row)
+                count += 1
+            else:
+                rows.append(row)
+
+        if count:
+            self.events_cache = rows
+            self.events_bytes -= freed
+            self.memory.shed['drop_ok_oldest'] += count
+        return freed
+
+    def shed_spill(self, excess):
+        """
+        Move the oldest events to the spool, until excess bytes are freed
+        """
+        if self.spool is None:
+            return 0
+
+        size = 0
+        count = 0
+        for row in self.events_cache:
+            if size >= excess:
+                break
+            size += row_size(row)
+            count += 1
+
+        (events, used) = (len(self.events_cache), self.events_bytes)
+        self.spool_events(count)
+        self.memory.shed['spill'] += events - len(self.events_cache)
+        return used - self.events_bytes
+
+    def open_spool(self):
+        """
+        Open the events spool, events spooled before a restart will be inserted
+        """
+        try:
+            self.spool = Spool(self.spool_dir, self.spool_segment_size * 1024 * 1024)
+        except (IOError, OSError) as exp:
+            logger.error("[glpidb] events spool %s can not be opened: %s", self.spool_dir, exp)
+            self.spool = None
+
+    def spool_events(self, count=None):
+        """
+        Move the oldest events of the events cache (max. count) to the spool
+        """
+        rows = self.pop_events(count)
+        if not rows:
+            return
 
-        now = time.time()
         try:
-            self.execute_query(query)
-        except Exception as e:
-            logger.error("[glpidb] error '%s' when executing query: %s", e, query)
-            self.close()
-        logger.info("[glpidb] time to insert %s line (%2.4f)", events_to_commit-1, time.time() - now)
+            self.spool.append(rows)
+            logger.info("[glpidb] %d events written in the spool, %d events spooled", len(rows), len(self.spool))
+        except (IOError, OSError) as exp:
+            logger.error("[glpidb] events can not be written in the spool: %s", exp)
+            self.requeue_events(rows)
+
+    def replay_spool(self):
+        """
+        Insert the events of the oldest spool segment, if the database is available
+        and the writer thread is not too busy
+        """
+        if self.spool is None or not len(self.spool) or not self.db_available(True):
+            return
+        if self.writers and max([writer.qsize() for writer in self.writers]) > self.writer_queue_size / 2:
+            return
+
+        now = time.time()
+        rows = self.spool.pop_segment()
+        table = 'glpi_plugin_monitoring_serviceevents'
+        statement = self.statements[table]
+        max_length = self.max_allowed_packet / 2 - len(statement.insert_query)
+        for part in self.partitions(table, rows, lambda row: row[0]):
+            for (chunk, length) in statement.chunks(part, self.commit_volume, max_length):
+                on_error = self.keep_spooled(chunk)
+                self.submit_query(self.insert_chunk(chunk, length, on_error), on_error, table, chunk[0][0])
+        logger.info("[glpidb] %d spooled events to insert (%2.4f), %d events still spooled",
+                    len(rows), time.time() - now, len(self.spool))
+
+    def keep_spooled(self, rows):
+        """
+        Get a function that writes back rows in the spool
+        """
+        def on_error():
+            try:
+                self.spool.append(rows)
+            except (IOError, OSError) as exp:
+                logger.error("[glpidb] %d events lost, they can not be written in the spool: %s", len(rows), exp)
+        return on_error
+
+    def state_changed(self, table, key, record):
+        """
+        Has the state of an item changed since its last update in table, or is the
+        last update too old? The fingerprint of the state is stored if so.
+        """
+        if not self.state_change_detection:
+            return True
+
+        if record.fingerprint is None:
+            if self.state_fingerprint_perfdata:
+                record.fingerprint = hash((record.state, record.state_type, record.acknowledged,
+                                           record.event, record.perf_data))
+            else:
+                record.fingerprint = hash((record.state, record.state_type, record.acknowledged, record.event))
+
+        last = self.fingerprints.get((table, key))
+        if last is not None and last[0] == record.fingerprint and record.last_chk - last[1] < self.state_max_staleness:
+            self.states_writes['suppressed'] += 1
+            return False
+
+        self.fingerprints[(table, key)] = (record.fingerprint, record.last_chk)
+        self.states_writes['emitted'] += 1
+        return True
+
+    def forget_state(self, table, key):
+        """
+        Get a function that forgets the fingerprint of an item, when its update failed
+        """
+        def on_error():
+            self.fingerprints.pop((table, key), None)
+        return on_error
+
+    def record_state(self, table, key, values):
+        """
+        Update the state of an item identified by key (values of the table keys).
+        If write-behind is enabled, the state is only stored in the states cache,
+        replacing any former state of the same item, else the table is updated now.
+        """
+        if self.state_flush_period:
+            self.states_cache.setdefault(table, {})[key] = values
+            return
+
+        self.submit_query(self.statements[table].update(key, values), self.forget_state(table, key), table, key)
+
+    def flush_states(self):
+        """
+        Peridically called (state_flush_period, or commit_period for the acknowledges
+        only), this method updates all the items stored in the states cache with
+        multi-row queries (max. commit_volume rows).
+        """
+        if not self.states_cache:
+            return
+
+        if not self.db_available(True):
+            logger.warning("[glpidb] database is not connected")
+            logger.warning("[glpidb] %d states tables to update in database", len(self.states_cache))
+            return
+
+        start = time.time()
+        states_cache = self.states_cache
+        self.states_cache = {}
+        for table in states_cache:
+            rows = states_cache[table]
+            logger.info("[glpidb] %d states to update in %s", len(rows), table)
+
+            now = time.time()
+            for items in self.partitions(table, rows.keys()):
+                for i in range(0, len(items), self.commit_volume):
+                    chunk = dict([(key, rows[key]) for key in items[i:i + self.commit_volume]])
+                    self.submit_query(self.statements[table].update_many(chunk), self.keep_states(table, chunk),
+                                      table, items[i])
+            logger.info("[glpidb] time to prepare %d states update in %s (%2.4f)", len(rows), table, time.time() - now)
+        self.metrics.observe('flush.states', time.time() - start)
+
+    def keep_states(self, table, rows):
+        """
+        Get a function that stores back rows in the states cache, for the next flush
+        """
+        def on_error():
+            # Keep not updated states for next flush, unless a newer state arrived
+            pending = self.states_cache.setdefault(table, {})
+            for key in rows:
+                pending.setdefault(key, rows[key])
+        return on_error
 
     # Get a brok, parse it, and put in in database
     def manage_brok(self, b):
-        # Build initial host state cache
-        if b.type == 'initial_host_status':
-            host_name = b.data['host_name']
-            logger.debug("[glpidb] initial host status : %s", host_name)
+        """
+        Manage a prepared brok with the function of its type, if any
+        """
+        handler = self.brok_handlers.get(b.type)
+        if handler is None:
+            self.broks_dropped[b.type] = self.broks_dropped.get(b.type, 0) + 1
+            return
+        self.broks_managed[b.type] = self.broks_managed.get(b.type, 0) + 1
+        handler(b)
 
-            try:
-                logger.debug("[glpidb] initial host status : %s : %s", host_name, b.data['customs'])
-                self.hosts_cache[host_name] = {'hostsid': b.data['customs']['_HOSTID'], 'itemtype': b.data['customs']['_ITEMTYPE'], 'items_id': b.data['customs']['_ITEMSID'] }
-            except:
-                self.hosts_cache[host_name] = {'items_id': None}
-                logger.debug("[glpidb] no custom _HOSTID and/or _ITEMTYPE and/or _ITEMSID for %s", host_name)
-
-            logger.info("[glpidb] initial host status : %s is %s", host_name, self.hosts_cache[host_name]['items_id'])
-
-        # Build initial service state cache
-        if b.type == 'initial_service_status':
-            host_name = b.data['host_name']
-            service_description = b.data['service_description']
-            service_id = host_name+"/"+service_description
-            logger.debug("[glpidb] initial service status : %s", service_id)
-
-            if not host_name in self.hosts_cache or self.hosts_cache[host_name]['items_id'] is None:
-                logger.debug("[glpidb] initial service status, host is not defined in Glpi : %s.", host_name)
-                return
+    def manage_broks(self, broks):
+        """
+        Manage a list of broks, the broks that are not managed are dropped
+        before being prepared
+        """
+        for b in broks:
+            handler = self.brok_handlers.get(b.type)
+            if handler is None:
+                self.broks_dropped[b.type] = self.broks_dropped.get(b.type, 0) + 1
+                continue
+            self.broks_managed[b.type] = self.broks_managed.get(b.type, 0) + 1
+            b.prepare()
+            handler(b)
+
+    def set_host_item(self, data):
+        """
+        Set the GLPI ids of an host from the data of an host status brok,
+        return True if the cache is modified
+        """
+        host_name = intern_name(data['host_name'])
+        instance_id = data.get('instance_id', 0)
+        generation = self.generations.get(instance_id, 1)
 
-            try:
-                logger.debug("[glpidb] initial service status : %s : %s", service_id, b.data['customs'])
-                self.services_cache[service_id] = {'itemtype': b.data['customs']['_ITEMTYPE'], 'items_id': b.data['customs']['_ITEMSID'] }
-            except:
-                self.services_cache[service_id] = {'items_id': None}
-                logger.debug("[glpidb] no custom _ITEMTYPE and/or _ITEMSID for %s", service_id)
+        try:
+            customs = data['customs']
+            ids = (customs['_ITEMSID'], customs['_ITEMTYPE'], customs['_HOSTID'])
+        except (KeyError, TypeError):
+            logger.debug("[glpidb] no custom _HOSTID and/or _ITEMTYPE and/or _ITEMSID for %s", host_name)
+            return self.set_cache_item(self.hosts_cache, host_name, None) is not None
+
+        item = self.hosts_cache.get(host_name)
+        if item is not None and (item.items_id, item.itemtype, item.hostsid, item.instance_id) == ids + (instance_id,):
+            item.generation = generation
+            return False
+        self.set_cache_item(self.hosts_cache, host_name, GlpiItem(ids[0], ids[1], ids[2], instance_id, generation))
+        return True
 
-            logger.info("[glpidb] initial service status : %s is %s", service_id, self.services_cache[service_id]['items_id'])
+    def set_service_item(self, data):
+        """
+        Set the GLPI ids of a service from the data of a service status brok,
+        return True if the cache is modified
+        """
+        key = (intern_name(data['host_name']), intern_name(data['service_description']))
+        instance_id = data.get('instance_id', 0)
+        generation = self.generations.get(instance_id, 1)
 
-        # Manage host check result if host is defined in Glpi DB
-        if b.type == 'host_check_result':
-            host_name = b.data['host_name']
-            logger.debug("[glpidb] host check result: %s: %s", host_name)
+        if key[0] not in self.hosts_cache:
+            logger.debug("[glpidb] service status, host is not defined in Glpi : %s.", key[0])
+            return False
 
-            # Update Shinken state table
-            if self.update_shinken_state:
-                self.record_shinken_state(host_name, '', b)
+        try:
+            customs = data['customs']
+            ids = (customs['_ITEMSID'], customs['_ITEMTYPE'])
+        except (KeyError, TypeError):
+            logger.debug("[glpidb] no custom _ITEMTYPE and/or _ITEMSID for %s/%s", key[0], key[1])
+            items = self.services_cache.get(key[0])
+            return items is not None and self.set_cache_item(items, key[1], None) is not None
+
+        items = self.services_cache.get(key[0])
+        if items is None:
+            items = {}
+            self.set_cache_item(self.services_cache, key[0], items)
+        item = items.get(key[1])
+        if item is not None and (item.items_id, item.itemtype, item.instance_id) == ids + (instance_id,):
+            item.generation = generation
+            return False
+        self.set_cache_item(items, key[1], GlpiItem(ids[0], ids[1], None, instance_id, generation))
+        return True
 
-            # Update availability
-            if self.update_availability:
-                self.record_availability(host_name, '', b)
+    def caches_changed(self):
+        self.caches_modified = True
 
-            if host_name in self.hosts_cache and self.hosts_cache[host_name]['items_id'] is not None:
-                start = time.time()
-                self.record_host_check_result(b)
-                logger.debug("[glpidb] host check result: %s, %d seconds", host_name, time.time() - start)
+    # New configuration of a scheduler: its items will be received again
+    def manage_clean_all_my_instance_id_brok(self, b):
+        instance_id = b.data['instance_id']
+        self.generations[instance_id] = self.generations.get(instance_id, 1) + 1
+        logger.info("[glpidb] new configuration for scheduler %s, generation %d",
+                    instance_id, self.generations[instance_id])
+
+    def get_stats(self):
+        """
+        Get the runtime metrics, with the current queues/caches sizes and the
+        counters of the broks, states, memory and writer
+        """
+        gauges = {
+            'broks_queue': self.to_q.qsize() if getattr(self, 'to_q', None) else 0,
+            'events_cache': len(self.events_cache),
+            'events_bytes': self.events_bytes,
+            'memory_used': self.memory_used(),
+            'memory_budget': self.memory.budget,
+            'states_cache': sum([len(rows) for rows in self.states_cache.values()]),
+            'hosts_cache': len(self.hosts_cache),
+            'acknowledges': len(self.acknowledges),
+            'services_cache': sum([len(items) for items in self.services_cache.values()]),
+            'transaction': sum([len(connection.transaction) for connection in self.connections]),
+            'transaction_replay': sum([len(connection.transaction_replay) for connection in self.connections]),
+            'spool': len(self.spool) if self.spool is not None else 0,
+            'connected': int(all([connection.is_connected for connection in self.connections])),
+        }
+        if self.writers:
+            gauges['writer_queue'] = sum([writer.qsize() for writer in self.writers])
+            gauges['writer_lag'] = max([writer.lag for writer in self.writers])
+
+        stats = self.metrics.get_stats(gauges)
+        counters = stats['counters']
+        counters['db.commits'] = sum([connection.commits for connection in self.connections])
+        for (brok_type, count) in self.broks_managed.items():
+            counters['broks.managed.' + brok_type] = count
+        for (brok_type, count) in self.broks_dropped.items():
+            counters['broks.dropped.' + brok_type] = count
+        for (name, count) in self.states_writes.items():
+            counters['states.' + name] = count
+        for (name, count) in self.events_writes.items():
+            counters['events.' + name] = count
+        for (policy, count) in self.memory.shed.items():
+            counters['memory.shed.' + policy] = count
+        if self.writers:
+            counters['writer.executed'] = sum([writer.executed for writer in self.writers])
+            counters['writer.dropped'] = sum([writer.dropped for writer in self.writers])
+            counters['writer.errors'] = sum([writer.errors for writer in self.writers])
+        return stats
+
+    def publish_stats(self):
+        """
+        Write the runtime metrics in the stats file, or send them to the module
+        process in sharded mode
+        """
+        stats = self.get_stats()
+        if self.stats_queue is not None:
+            self.stats_queue.put((self.shard, stats))
+            return
 
-        # Manage service check result if service is defined in Glpi DB
-        if b.type == 'service_check_result':
-            host_name = b.data['host_name']
-            service_description = b.data['service_description']
-            service_id = host_name+"/"+service_description
-            logger.debug("[glpidb] service check result: %s", service_id)
+        try:
+            write_stats(self.stats_file, stats)
+        except (IOError, OSError) as exp:
+            logger.error("[glpidb] stats file %s can not be written: %s", self.stats_file, exp)
 
-            # Update Shinken state table
-            if self.update_shinken_state:
-                self.record_shinken_state(host_name, service_description, b)
+    def end_broks_batch(self):
+        """
+        Called after each broks batch
+        """
+        # One transaction for all the queries of the broks batch
+        if self.transaction_mode == 'batch':
+            self.submit_query(COMMIT)
 
-            # Update availability
-            if self.update_availability:
-                self.record_availability(host_name, service_description, b)
+        # Memory budget exceeded?
+        self.enforce_memory_budget()
+
+        # Too many events in memory, or spooled events to insert
+        if self.spool is not None:
+            if len(self.events_cache) > self.spool_threshold:
+                self.spool_events(len(self.events_cache) - self.spool_threshold)
+            else:
+                self.replay_spool()
+
+    # Build initial host state cache
+    def manage_initial_host_status_brok(self, b):
+        if self.set_host_item(b.data):
+            self.caches_changed()
+        host = self.hosts_cache.get(b.data['host_name'])
+        logger.info("[glpidb] initial host status : %s is %s", b.data['host_name'], host.items_id if host else None)
+
+    # Build initial service state cache
+    def manage_initial_service_status_brok(self, b):
+        if self.set_service_item(b.data):
+            self.caches_changed()
+        service = self.services_cache.get(b.data['host_name'], {}).get(b.data['service_description'])
+        logger.info("[glpidb] initial service status : %s/%s is %s", b.data['host_name'],
+                    b.data['service_description'], service.items_id if service else None)
+
+    # Update host state cache, if the GLPI ids changed
+    def manage_update_host_status_brok(self, b):
+        if 'customs' in b.data and self.set_host_item(b.data):
+            logger.info("[glpidb] updated host status : %s", b.data['host_name'])
+            self.caches_changed()
+
+    # Update service state cache, if the GLPI ids changed
+    def manage_update_service_status_brok(self, b):
+        if 'customs' in b.data and self.set_service_item(b.data):
+            logger.info("[glpidb] updated service status : %s/%s", b.data['host_name'], b.data['service_description'])
+            self.caches_changed()
+
+    # Remove the items of a scheduler that were not received again
+    def manage_initial_broks_done_brok(self, b):
+        instance_id = b.data['instance_id']
+        (hosts, services) = self.sweep_caches(instance_id)
+        logger.info("[glpidb] initial broks done for scheduler %s, %d hosts and %d services removed from the caches",
+                    instance_id, hosts, services)
+        if self.cache_snapshot and self.caches_modified:
+            self.save_snapshot()
+
+    def sweep_caches(self, instance_id):
+        """
+        Remove the items of a scheduler older than its current generation
+        """
+        generation = self.generations.get(instance_id, 1)
+        hosts = [hostname for (hostname, item) in self.hosts_cache.iteritems()
+                 if item.instance_id == instance_id and item.generation < generation]
+        for hostname in hosts:
+            del self.hosts_cache[hostname]
+
+        services = 0
+        for (hostname, items) in self.services_cache.items():
+            stale = [service for (service, item) in items.iteritems()
+                     if item.instance_id == instance_id and item.generation < generation]
+            for service in stale:
+                del items[service]
+            if not items:
+                del self.services_cache[hostname]
+            services += len(stale)
+
+        if hosts or services:
+            self.caches_bytes = None
+            self.caches_changed()
+        return (len(hosts), services)
+
+    def load_snapshot(self):
+        """
+        Load the caches snapshot, the items already received are kept
+        """
+        if not os.path.exists(self.cache_snapshot):
+            return
 
-            if host_name in self.hosts_cache and self.hosts_cache[host_name]['items_id'] is not None:
-                if service_id in self.services_cache and self.services_cache[service_id]['items_id'] is not None:
-                    start = time.time()
-                    self.record_service_check_result(b)
-                    logger.debug("[glpidb] service check result: %s, %d seconds", service_id, time.time() - start)
+        start = time.time()
+        try:
+            (hosts_cache, services_cache) = load_caches(self.cache_snapshot)
+        except Exception as exp:
+            logger.error("[glpidb] caches snapshot %s can not be loaded: %s", self.cache_snapshot, exp)
+            return
 
-        return
+        for (hostname, item) in hosts_cache.iteritems():
+            self.hosts_cache.setdefault(hostname, item)
+        services = 0
+        for (hostname, items) in services_cache.iteritems():
+            known = self.services_cache.setdefault(hostname, {})
+            for (service, item) in items.iteritems():
+                known.setdefault(service, item)
+            services += len(items)
+        self.caches_bytes = None
+        logger.info("[glpidb] caches snapshot loaded: %d hosts, %d services (%2.4f)",
+                    len(hosts_cache), services, time.time() - start)
+
+    def save_snapshot(self):
+        """
+        Save the caches snapshot
+        """
+        start = time.time()
+        try:
+            (hosts, services) = save_caches(self.cache_snapshot, self.hosts_cache, self.services_cache)
+            self.caches_modified = False
+            logger.info("[glpidb] caches snapshot saved: %d hosts, %d services (%2.4f)",
+                        hosts, services, time.time() - start)
+        except (IOError, OSError) as exp:
+            logger.error("[glpidb] caches snapshot %s can not be saved: %s", self.cache_snapshot, exp)
+
+    # Manage host check result if host is defined in Glpi DB
+    def manage_host_check_result_brok(self, b):
+        record = CheckRecord(b.data)
+        logger.debug("[glpidb] host check result: %s", record.hostname)
+
+        # Update Shinken state table
+        if self.update_shinken_state:
+            self.record_shinken_state(record)
+
+        # Update availability
+        if self.update_availability:
+            self.record_availability(record)
+
+        host = self.hosts_cache.get(record.hostname)
+        if host is not None:
+            record.items_id = host.items_id
+            record.itemtype = host.itemtype
+            start = time.time()
+            self.record_host_check_result(record)
+            logger.debug("[glpidb] host check result: %s, %d seconds", record.hostname, time.time() - start)
+
+    # Manage service check result if service is defined in Glpi DB
+    def manage_service_check_result_brok(self, b):
+        record = CheckRecord(b.data)
+        logger.debug("[glpidb] service check result: %s/%s", record.hostname, record.service)
+
+        # Update Shinken state table
+        if self.update_shinken_state:
+            self.record_shinken_state(record)
+
+        # Update availability
+        if self.update_availability:
+            self.record_availability(record)
+
+        services = self.services_cache.get(record.hostname)
+        if services is not None and record.hostname in self.hosts_cache:
+            service = services.get(record.service)
+            if service is not None:
+                record.items_id = service.items_id
+                record.itemtype = service.itemtype
+                start = time.time()
+                self.record_service_check_result(record)
+                logger.debug("[glpidb] service check result: %s/%s, %d seconds",
+                             record.hostname, record.service, time.time() - start)
 
     ## Host result
-    def record_host_check_result(self, b):
-        host_name = b.data['host_name']
-        host_cache = self.hosts_cache[host_name]
-        logger.debug("[glpidb] record host check result: %s: %s", host_name, b.data)
-
-        # Escape SQL fields ...
-        # b.data['output'] = MySQLdb.escape_string(b.data['output'])
-        # b.data['long_output'] = MySQLdb.escape_string(b.data['long_output'])
-        # b.data['perf_data'] = MySQLdb.escape_string(b.data['perf_data'])
-
-        if self.update_hosts:
-            data = {}
-            data['event'] = ("%s \n %s", b.data['output'], b.data['long_output']) if (len(b.data['long_output']) > 0) else b.data['output']
-            data['state'] = b.data['state']
-            data['state_type'] = b.data['state_type']
-            data['last_check'] = datetime.datetime.fromtimestamp( int(b.data['last_chk']) ).strftime('%Y-%m-%d %H:%M:%S')
-            data['perf_data'] = b.data['perf_data']
-            data['latency'] = b.data['latency']
-            data['execution_time'] = b.data['execution_time']
-            data['is_acknowledged'] = '1' if b.data['problem_has_been_acknowledged'] else '0'
-
-            where_clause = {'items_id': host_cache['items_id'], 'itemtype': host_cache['itemtype']}
-            query = self.create_update_query('glpi_plugin_monitoring_hosts', data, where_clause)
-            try:
-                self.execute_query(query)
-            except Exception as exp:
-                logger.error("[glpidb] error '%s' when executing query: %s", exp, query)
-
-        # Update acknowledge table if host becomes UP
-        #if self.update_acknowledges and b.data['state_id'] == 0 and b.data['last_state_id'] != 0:
-        # Update acknowledge table if host is UP
-        if self.update_acknowledges and b.data['state_id'] == 0:
-            data = {}
-            data['end_time'] = datetime.datetime.fromtimestamp( int(b.data['last_chk']) ).strftime('%Y-%m-%d %H:%M:%S')
-            data['expired'] = '1'
-
-            where_clause = {'items_id': host_cache['items_id'], 'itemtype': "PluginMonitoringHost"}
-            query = self.create_update_query('glpi_plugin_monitoring_acknowledges', data, where_clause)
-            logger.debug("[glpidb] acknowledge query: %s", query)
-            try:
-                self.execute_query(query)
-            except Exception as exp:
-                logger.error("[glpidb] error '%s' when executing query: %s", exp, query)
+    def record_host_check_result(self, record):
+        logger.debug("[glpidb] record host check result: %s", record.hostname)
+
+        key = (record.items_id, record.itemtype)
+        if self.update_hosts and self.state_changed('glpi_plugin_monitoring_hosts', key, record):
+            data = (
+                record.event,
+                record.state,
+                record.state_type,
+                record.date,
+                record.perf_data,
+                record.latency,
+                record.execution_time,
+                record.acknowledged
+            )
+
+            self.record_state('glpi_plugin_monitoring_hosts', key, data)
+
+        # Update acknowledge table if an acknowledged host becomes UP
+        if self.update_acknowledges:
+            self.record_acknowledge(record, "PluginMonitoringHost")
 
     ## Service result
-    def record_service_check_result(self, b):
-        host_name = b.data['host_name']
-        service_description = b.data['service_description']
-        service_id = host_name+"/"+service_description
-        service_cache = self.services_cache[service_id]
-        logger.debug("[glpidb] service check result: %s: %s", service_id, b.data)
-
-        # Escape SQL fields ...
-        # b.data['output'] = MySQLdb.escape_string(b.data['output'])
-        # b.data['long_output'] = MySQLdb.escape_string(b.data['long_output'])
-        # b.data['perf_data'] = MySQLdb.escape_string(b.data['perf_data'])
+    def record_service_check_result(self, record):
+        logger.debug("[glpidb] record service check result: %s/%s", record.hostname, record.service)
 
         # Insert into serviceevents log table
-        if self.update_services_events:
-            logger.info("[glpidb] append data to events_cache for service: %s", service_id)
-            data = {}
-            data['plugin_monitoring_services_id'] = service_cache['items_id']
-            data['date'] = datetime.datetime.fromtimestamp( int(b.data['last_chk']) ).strftime('%Y-%m-%d %H:%M:%S')
-            data['event'] = ("%s \n %s", b.data['output'], b.data['long_output']) if (len(b.data['long_output']) > 0) else b.data['output']
-            data['state'] = b.data['state']
-            data['state_type'] = b.data['state_type']
-            data['perf_data'] = b.data['perf_data']
-            data['latency'] = b.data['latency']
-            data['execution_time'] = b.data['execution_time']
+        perf_data = self.sample_event(record) if self.update_services_events else None
+        if perf_data is not None:
+            data = (
+                record.items_id,
+                record.date,
+                record.event,
+                record.state,
+                record.state_type,
+                perf_data,
+                record.latency,
+                record.execution_time
+            )
 
             # Append to bulk insert queue ...
-            self.events_cache.append(data)
+            self.queue_event(data)
 
         # Update service state table
-        if self.update_services:
-            data = {}
-            data['event'] = ("%s \n %s", b.data['output'], b.data['long_output']) if (len(b.data['long_output']) > 0) else b.data['output']
-            data['state'] = b.data['state']
-            data['state_type'] = b.data['state_type']
-            data['last_check'] = datetime.datetime.fromtimestamp( int(b.data['last_chk']) ).strftime('%Y-%m-%d %H:%M:%S')
-            data['is_acknowledged'] = '1' if b.data['problem_has_been_acknowledged'] else '0'
-
-            where_clause = {'id': service_cache['items_id']}
-            table = 'glpi_plugin_monitoring_services'
-            if service_cache['itemtype'] == 'ServiceCatalog':
-                table = 'glpi_plugin_monitoring_servicescatalogs'
-            query = self.create_update_query(table, data, where_clause)
-            try:
-                self.execute_query(query)
-            except Exception as exp:
-                logger.error("[glpidb] error '%s' when executing query: %s", exp, query)
-
-        # Update acknowledge table if service becomes OK
-        #if self.update_acknowledges and b.data['state_id'] == 0 and b.data['last_state_id'] != 0:
-        # Update acknowledge table if service is OK
-        if self.update_acknowledges and b.data['state_id'] == 0:
-            data = {}
-            data['end_time'] = datetime.datetime.fromtimestamp( int(b.data['last_chk']) ).strftime('%Y-%m-%d %H:%M:%S')
-            data['expired'] = '1'
-
-            where_clause = {'items_id': service_cache['items_id'], 'itemtype': "PluginMonitoringService"}
-            query = self.create_update_query('glpi_plugin_monitoring_acknowledges', data, where_clause)
-            logger.debug("[glpidb] acknowledge query: %s", query)
-            try:
-                self.execute_query(query)
-            except Exception as exp:
-                logger.error("[glpidb] error '%s' when executing query: %s", exp, query)
+        table = 'glpi_plugin_monitoring_services'
+        if record.itemtype == 'ServiceCatalog':
+            table = 'glpi_plugin_monitoring_servicescatalogs'
+        key = (record.items_id,)
+        if self.update_services and self.state_changed(table, key, record):
+            data = (
+                record.event,
+                record.state,
+                record.state_type,
+                record.date,
+                record.acknowledged
+            )
+            self.record_state(table, key, data)
+
+        # Update acknowledge table if an acknowledged service becomes OK
+        if self.update_acknowledges:
+            self.record_acknowledge(record, "PluginMonitoringService")
+
+    def sample_event(self, record):
+        """
+        Is the service event of a check result to be recorded? The state changes and
+        the non-OK results are always recorded, the steady OK results are sampled.
+        Returns None if the event is skipped, else the perf_data to record.
+        """
+        if not self.events_sampling:
+            return record.perf_data
+
+        state = (record.state, record.state_type)
+        last = self.events_sampling_states.get(record.items_id)
+        if last is None or last[0] != state or record.state != 'OK':
+            self.events_sampling_states[record.items_id] = [state, record.last_chk, 0]
+            self.events_writes['recorded'] += 1
+            return record.perf_data
+
+        last[2] += 1
+        if ((self.events_sampling_period and record.last_chk - last[1] >= self.events_sampling_period) or
+                (self.events_sampling_count > 1 and last[2] >= self.events_sampling_count)):
+            last[1] = record.last_chk
+            last[2] = 0
+            self.events_writes['recorded'] += 1
+            self.events_writes['sampled'] += 1
+            if self.events_sampled_perfdata == 'drop':
+                return ''
+            perf_data = record.perf_data
+            if self.events_sampled_perfdata == 'truncate' and len(perf_data) > self.events_perfdata_max_length:
+                # Whole metrics only, if possible
+                perf_data = perf_data[:self.events_perfdata_max_length + 1]
+                perf_data = perf_data[:perf_data.rfind(' ')] if ' ' in perf_data else perf_data[:-1]
+            return perf_data
+
+        self.events_writes['skipped'] += 1
+        return None
+
+    ## Acknowledges
+    def record_acknowledge(self, record, itemtype):
+        """
+        Track the acknowledge of an item from its check result: a problem may be
+        acknowledged, and the acknowledge of an item that recovers is expired
+        """
+        key = (str(record.items_id), itemtype)
+        if record.state_id != 0:
+            if record.acknowledged == '1':
+                self.acknowledges.add(key)
+        elif key in self.acknowledges:
+            self.expire_acknowledge(key, record.date)
+
+    def expire_acknowledge(self, key, date):
+        """
+        Expire the acknowledge of an item, the acknowledges table is updated with
+        the states (write-behind), or on next commit_period
+        """
+        self.acknowledges.discard(key)
+        self.states_cache.setdefault('glpi_plugin_monitoring_acknowledges', {})[key] = (date, '1')
+        self.metrics.incr('acknowledges.expired')
+
+    def get_acknowledge_key(self, data):
+        """
+        Get the (items_id, itemtype) of the item of an acknowledge brok, None if
+        the item is not defined in GLPI
+        """
+        host_name = data.get('host_name', data.get('host'))
+        service = data.get('service_description', data.get('service'))
+        if service:
+            item = self.services_cache.get(host_name, {}).get(service)
+            itemtype = "PluginMonitoringService"
+        else:
+            item = self.hosts_cache.get(host_name)
+            itemtype = "PluginMonitoringHost"
+        if item is None:
+            return None
+        return (str(item.items_id), itemtype)
+
+    def manage_acknowledge_raise_brok(self, b):
+        key = self.get_acknowledge_key(b.data)
+        if key is not None:
+            logger.debug("[glpidb] acknowledge raised: %s", key)
+            self.acknowledges.add(key)
+
+    def manage_acknowledge_expire_brok(self, b):
+        key = self.get_acknowledge_key(b.data)
+        if key is not None and key in self.acknowledges:
+            logger.debug("[glpidb] acknowledge expired: %s", key)
+            self.expire_acknowledge(key, format_date(int(time.time())))
 
     ## Update Shinken all hosts/services state
-    def record_shinken_state(self, hostname, service, b):
+    def record_shinken_state(self, record):
         # Insert/update in shinken state table
-        logger.debug("[glpidb] record shinken state: %s/%s: %s", hostname, service, b.data)
+        logger.debug("[glpidb] record shinken state: %s/%s", record.hostname, record.service)
 
         # Test if record still exists
-        exists = None
-        query = "SELECT COUNT(*) AS nbRecords FROM `glpi_plugin_monitoring_shinkenstates` WHERE hostname='%s' AND service='%s';" % (hostname, service)
-        try:
-            self.execute_query(query)
-            res = self.fetchone()
-            exists = True if res[0] > 0 else False
-        except Exception as exp:
-            # No more table update because table does not exist or is bad formed ...
-            self.update_shinken_state = False
-            logger.error("[glpidb] error '%s' when executing query: %s", exp, query)
-
-        # Escape SQL fields ...
-        # b.data['output'] = MySQLdb.escape_string(b.data['output'])
-        # b.data['long_output'] = MySQLdb.escape_string(b.data['long_output'])
-        # b.data['perf_data'] = MySQLdb.escape_string(b.data['perf_data'])
-
-        data = {}
-        data['hostname'] = hostname
-        data['service'] = service
-        data['state'] = b.data['state_id']
-        data['state_type'] = b.data['state_type']
-        data['last_output'] = ("%s \n %s", b.data['output'], b.data['long_output']) if (len(b.data['long_output']) > 0) else b.data['output']
-        data['last_check'] = datetime.datetime.fromtimestamp( int(b.data['last_chk']) ).strftime('%Y-%m-%d %H:%M:%S')
-        data['last_perfdata'] = b.data['perf_data']
-        data['is_ack'] = '1' if b.data['problem_has_been_acknowledged'] else '0'
+        key = (intern_name(record.hostname), intern_name(record.service))
+        exists = key in self.shinken_states
+        if not self.state_changed('glpi_plugin_monitoring_shinkenstates', key, record) and exists:
+            return
 
+        data = (
+            record.state_id,
+            record.state_type,
+            record.event,
+            record.date,
+            record.perf_data,
+            record.acknowledged
+        )
+
+        table = 'glpi_plugin_monitoring_shinkenstates'
+        statement = self.statements[table]
+        forget_state = self.forget_state(table, key)
         if exists:
-            where_clause = {'hostname': hostname, 'service': service}
-            query = self.create_update_query('glpi_plugin_monitoring_shinkenstates', data, where_clause)
-            try:
-                self.execute_query(query)
-            except Exception as exp:
-                logger.error("[glpidb] error '%s' when executing query: %s", exp, query)
-        else:
-            query = self.create_insert_query('glpi_plugin_monitoring_shinkenstates', data)
-            try:
-                self.execute_query(query)
-            except Exception as exp:
-                logger.error("[glpidb] error '%s' when executing query: %s", exp, query)
+            self.submit_query(statement.update(key, data), forget_state, table, key)
+            return
+
+        # The record will exist, unless the insertion fails
+        self.shinken_states.add(key)
+
+        def insert(connection):
+            if not connection.execute_query(*statement.insert(data, key)):
+                # Integrity error: the record was created by someone else ...
+                connection.execute_query(*statement.update(key, data))
+
+        def on_error():
+            self.shinken_states.discard(key)
+            forget_state()
+
+        self.submit_query(insert, on_error, table, key)
 
     ## Update hosts/services availability
-    def record_availability(self, hostname, service, b):
+    def record_availability(self, record):
         # Insert/update in shinken state table
-        logger.debug("[glpidb] record availability: %s/%s: %s", hostname, service, b.data)
-        # if hostname.startswith('sim'):
-            # logger.warning("[glpidb] record availability: %s/%s: %s", hostname, service, b.data)
+        logger.debug("[glpidb] record availability: %s/%s", record.hostname, record.service)
+        # if record.hostname.startswith('sim'):
+            # logger.warning("[glpidb] record availability: %s/%s", record.hostname, record.service)
 
         # Host check brok:
         # ----------------
@@ -612,181 +1452,256 @@ class Glpidb_broker(BaseModule):
         # 'in_scheduled_downtime': False
 
         # Only for simulated hosts ...
-        # if not hostname.startswith('sim'):
+        # if not record.hostname.startswith('sim'):
             # return
 
         # Only for host check ...
-        # if not service is '':
+        # if not record.service is '':
             # return
 
         # Ignoring SOFT states ...
-        # if b.data['state_type_id']==0:
-            # logger.warning("[glpidb] record availability for: %s/%s, but no HARD state, ignoring ...", hostname, service)
-
-
-        midnight = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
-        midnight_timestamp = time.mktime (midnight.timetuple())
-        # Number of seconds today ...
-        seconds_today = int(b.data['last_chk']) - midnight_timestamp
-        # Number of seconds since state changed
-        since_last_state = int(b.data['last_state_change']) - seconds_today
-        # Scheduled downtime
-        scheduled_downtime = bool(b.data['in_scheduled_downtime'])
-        # Day
-        day = datetime.date.today().strftime('%Y-%m-%d')
-
-        # Database table
-        # --------------
-        # `hostname` varchar(255) CHARACTER SET latin1 DEFAULT NULL,
-        # `service` varchar(255) CHARACTER SET latin1 DEFAULT NULL,
-        # `day` DATE DEFAULT NULL,
-        # `is_downtime` tinyint(1) DEFAULT '0',
-        # `daily_0` int(6) DEFAULT '0',                 Up/Ok
-        # `daily_1` int(6) DEFAULT '0',                 Down/Warning
-        # `daily_2` int(6) DEFAULT '0',                 Unreachable/Critical
-        # `daily_3` int(6) DEFAULT '0',                 Unknown
-        # `daily_4` int(6) DEFAULT '86400',             Unchecked
-        # `daily_9` int(6) DEFAULT '0',                 Downtime
-        # --------------
-
-        # Test if record for current day still exists
-        exists = False
-        res = None
-        query = """SELECT id, hostname, service, day, is_downtime,
-                    daily_0, daily_1, daily_2, daily_3, daily_4,
-                    first_check_state, first_check_timestamp,
-                    last_check_state, last_check_timestamp
-                    FROM `glpi_plugin_monitoring_availabilities`
-                    WHERE hostname='%s' AND service='%s' AND day='%s';""" % (hostname, service, day)
-        try:
-            self.execute_query(query)
-            res = self.fetchone()
-            logger.debug("[glpidb] record availability, select query result: %s", res)
-                # (9L, 'sim-0001', '', datetime.date(2015, 6, 9), 0, 0L, 0L, 0L, 0L, 86400L, 1, 1433854693L, 1, 1433854693L)
-            exists = True if res is not None else False
-        except Exception as exp:
-            # No more table update because table does not exist or is bad formed ...
-            self.update_shinken_state = False
-            logger.error("[glpidb] error '%s' when executing query: %s", exp, query)
+        # if record.state_type != 'HARD':
+            # logger.warning("[glpidb] record availability for: %s/%s, but no HARD state, ignoring ...", record.hostname, record.service)
 
-        # Configure recorded data
-        data = {}
-        data['hostname'] = hostname
-        data['service'] = service
-        data['day'] = day
-        data['is_downtime'] = '1' if bool(b.data['in_scheduled_downtime']) else '0'
-        # All possible states are 0 seconds duration.
-        data['daily_0'] = 0
-        data['daily_1'] = 0
-        data['daily_2'] = 0
-        data['daily_3'] = 0
-        data['daily_4'] = 0
-
-        current_state = b.data['state']
-        current_state_id = b.data['state_id']
-        last_state = b.data['last_state']
-        last_check_state = res[12] if res else 3
-        last_check_timestamp = res[13] if res else midnight_timestamp
-        since_last_state = 0
-        logger.debug("[glpidb] current state: %s, last state: %s", current_state, last_state)
-
-        # Host check
-        if service=='':
-            last_time_unreachable = b.data['last_time_unreachable']
-            last_time_up = b.data['last_time_up']
-            last_time_down = b.data['last_time_down']
-            last_state_change = b.data['last_state_change']
-            last_state_change = int(time.time())
-
-            if current_state == 'UP':
-                since_last_state = int(last_state_change - last_check_timestamp)
-
-            elif current_state== 'UNREACHABLE':
-                since_last_state = int(last_state_change - last_check_timestamp)
-
-            elif current_state == 'DOWN':
-                since_last_state = int(last_state_change - last_check_timestamp)
-        # Service check
-        else:
-            last_state_change = int(time.time())
-            since_last_state = int(last_state_change - last_check_timestamp)
 
-        # Update existing record
-        if exists:
-            data = {
-                    'is_downtime': res[4],
-                    'daily_0': res[5], 'daily_1': res[6], 'daily_2': res[7], 'daily_3': res[8], 'daily_4': res[9]
-                    }
+        # Daily records are computed in memory and periodically written in the database
+        self.availability.update(record.hostname, record.service, record.state_id, record.last_chk,
+                                 record.in_downtime)
 
-            logger.debug("[glpidb] current data: %s", data)
+    def flush_availability(self):
+        """
+        Peridically called (availability_flush_period), this method writes the
+        availability records modified since the last flush, with multi-row queries
+        (max. commit_volume rows per query).
+        """
+        # Close the day even if no check result was received since midnight
+        now = time.time()
+        if now >= self.availability.day_end:
+            self.availability.rollover(now)
 
-            # Update record
-            if since_last_state > seconds_today:
-                # Last state changed before today ...
+        records = self.availability.pop_dirty()
+        if not records:
+            return
 
-                # Current state duration for all seconds of today
-                data["daily_%d" % current_state_id] = seconds_today
-            else:
-                # Increase current state duration with seconds since last state
-                data["daily_%d" % b.data['state_id']] += (since_last_state)
+        if not self.db_available(True):
+            logger.warning("[glpidb] database is not connected")
+            logger.warning("[glpidb] %d availability records to write in database", len(records))
+            self.availability.mark_dirty(records)
+            return
 
-            # Unchecked state for all day duration minus all states duration
-            data['daily_4'] = 86400
-            for value in [ data['daily_0'], data['daily_1'], data['daily_2'], data['daily_3'] ]:
-                data['daily_4'] -= value
+        now = time.time()
+        updates = [key for key in records if records[key].id is not None]
+        inserts = [key for key in records if records[key].id is None and not records[key].pending]
+        # Records inserted by a former flush, not yet written by the writer: they
+        # are updated on a next flush, once their id is known
+        pending = dict([(key, records[key]) for key in records if records[key].id is None and records[key].pending])
+        if pending:
+            self.availability.mark_dirty(pending)
+        logger.info("[glpidb] availability: %d records to update, %d records to insert, %d records pending",
+                    len(updates), len(inserts), len(pending))
+
+        table = 'glpi_plugin_monitoring_availabilities'
+        for i in range(0, len(updates), self.commit_volume):
+            keys = updates[i:i + self.commit_volume]
+            rows = dict([((records[key].id,), records[key].values(AVAILABILITY_UPDATED_COLUMNS)) for key in keys])
+            self.submit_query(self.statements[table].update_many(rows), self.keep_availability(records, keys), table)
+
+        if not inserts:
+            logger.info("[glpidb] time to prepare %d availability records (%2.4f)", len(records), time.time() - now)
+            self.metrics.observe('flush.availability', time.time() - now)
+            return
 
-            # Last check state and timestamp
-            data['last_check_state'] = current_state_id
-            data['last_check_timestamp'] = int(b.data['last_chk'])
+        # Id of the first inserted record, all the availability records are
+        # written by the same connection
+        first_id = []
+
+        def insert(statement, on_error):
+            def operation(connection):
+                if not connection.execute_query(*statement):
+                    on_error()
+                    return
+                if not first_id:
+                    first_id.append(connection.db_cursor.lastrowid)
+            return operation
+
+        for i in range(0, len(inserts), self.commit_volume):
+            keys = inserts[i:i + self.commit_volume]
+            rows = [(key[0], key[1]) + records[key].values(AVAILABILITY_COLUMNS[2:]) for key in keys]
+            for key in keys:
+                records[key].pending = True
+            on_error = self.keep_availability(records, keys)
+            self.submit_query(insert(self.availability_insert.insert_many(rows), on_error), on_error, table)
+
+        # Get the id of the new records for the next updates, per day: the closing
+        # records of the former day may be inserted with those of the current day
+        inserted = dict([(key, records[key]) for key in inserts])
+        days = sorted(set([key[2] for key in inserts]))
+
+        def get_ids(connection):
+            if not first_id:
+                return
+            query = "SELECT id, hostname, service FROM `%s` WHERE day=%%s AND id >= %%s;" % (table)
+            for day in days:
+                if connection.execute_query(query, (day, first_id[0])):
+                    self.availability.set_ids(day, connection.fetchall(), inserted)
 
-            where_clause = {'hostname': hostname, 'service': service, 'day': day}
-            query = self.create_update_query('glpi_plugin_monitoring_availabilities', data, where_clause)
-            logger.debug("[glpidb] record availability, update query: %s", query)
-            try:
-                self.execute_query(query)
-            except Exception as exp:
-                logger.error("[glpidb] error '%s' when executing query: %s", exp, query)
+        self.submit_query(get_ids, None, table)
+        logger.info("[glpidb] time to prepare %d availability records (%2.4f)", len(records), time.time() - now)
+        self.metrics.observe('flush.availability', time.time() - now)
 
-        # Create record
+    def keep_availability(self, records, keys):
+        """
+        Get a function that marks records as still to be written, for the next flush
+        """
+        def on_error():
+            for key in keys:
+                records[key].pending = False
+            self.availability.mark_dirty(dict([(key, records[key]) for key in keys]))
+        return on_error
+
+    def main(self):
+        self.set_proctitle(self.name)
+        self.set_exit_handler()
+
+        if self.worker_processes > 1:
+            self.run_shards()
         else:
-            # First check state and timestamp
-            data['first_check_state'] = current_state_id
-            data['first_check_timestamp'] = int(b.data['last_chk'])
+            self.run_broks()
 
-            # Last check state and timestamp
-            data['last_check_state'] = current_state_id
-            data['last_check_timestamp'] = int(b.data['last_chk'])
+    def run_shards(self):
+        """
+        Sharded mode: the broks are managed by the shards processes, this process
+        only routes them and aggregates the stats of the shards
+        """
+        shards = Shards(self.worker_processes, self.run_shard)
+        shards.start()
 
-            # Ignore computed values because it is the first check received today!
-            data['daily_4'] = 86400
+        check_next_time = time.time() + self.commit_period
+        stats_next_time = time.time() + self.stats_period
+        while not self.interrupted:
+            start = time.time()
+            shards.collect()
+
+            if check_next_time < start:
+                check_next_time = start + self.commit_period
+                shards.check()
+                logger.info("[glpidb] broks queue: %d, shards queues: %s, routed broks: %s, broadcast broks: %d",
+                            self.to_q.qsize(), ', '.join([str(size) for size in shards.qsizes()]),
+                            ', '.join([str(count) for count in shards.routed]), shards.broadcast)
+                logger.info("[glpidb] broks managed: %s, dropped: %s",
+                            ', '.join(['%s: %d' % (t, self.broks_managed[t]) for t in sorted(self.broks_managed)]),
+                            ', '.join(['%s: %d' % (t, self.broks_dropped[t]) for t in sorted(self.broks_dropped)]))
+
+            if self.stats_file and stats_next_time < start:
+                stats_next_time = start + self.stats_period
+                self.write_shards_stats(shards)
 
-            query = self.create_insert_query('glpi_plugin_monitoring_availabilities', data)
-            logger.debug("[glpidb] record availability, insert query: %s", query)
             try:
-                self.execute_query(query)
-            except Exception as exp:
-                logger.error("[glpidb] error '%s' when executing query: %s", exp, query)
+                broks = self.to_q.get(timeout=1)
+            except Queue.Empty:
+                continue
+            self.route_broks(shards, broks)
 
-    def main(self):
-        self.set_proctitle(self.name)
-        self.set_exit_handler()
+        shards.stop()
+        if self.stats_file:
+            self.write_shards_stats(shards)
 
-        # Open database connection
-        self.open()
+    def route_broks(self, shards, broks):
+        """
+        Sharded mode: send the managed broks to the shards, the other broks are
+        dropped. The broks are prepared by the shards.
+        """
+        managed = []
+        for b in broks:
+            if b.type not in self.brok_handlers:
+                self.broks_dropped[b.type] = self.broks_dropped.get(b.type, 0) + 1
+                continue
+            self.broks_managed[b.type] = self.broks_managed.get(b.type, 0) + 1
+            managed.append(b)
+        shards.route(managed)
+
+    def write_shards_stats(self, shards):
+        """
+        Sharded mode: write the stats of all the shards in the stats file. The broks
+        counters are the ones of this process, the shards get the broadcast broks.
+        """
+        stats = shards.get_stats()
+        counters = stats['counters']
+        for name in [name for name in counters if name.startswith('broks.')]:
+            del counters[name]
+        for (brok_type, count) in self.broks_managed.items():
+            counters['broks.managed.' + brok_type] = count
+        for (brok_type, count) in self.broks_dropped.items():
+            counters['broks.dropped.' + brok_type] = count
+
+        try:
+            write_stats(self.stats_file, stats)
+        except (IOError, OSError) as exp:
+            logger.error("[glpidb] stats file %s can not be written: %s", self.stats_file, exp)
+
+    def run_shard(self, shard, queue, stats_queue):
+        """
+        Sharded mode: run the broks management of a shard, in its own process.
+        The shards have their own caches snapshot and spool directory, the first
+        shard uses the spool directory of the module, so that the events spooled
+        before the sharded mode are inserted.
+        """
+        self.shard = shard
+        self.to_q = queue
+        self.stats_queue = stats_queue
+        if self.cache_snapshot:
+            self.cache_snapshot = '%s.%d' % (self.cache_snapshot, shard)
+        if self.spool_dir and shard:
+            self.spool_dir = os.path.join(self.spool_dir, 'shard-%d' % shard)
+        self.set_proctitle('%s-shard-%d' % (self.name, shard))
+        logger.info("[glpidb] shard %d: managing its broks", shard)
+        self.run_broks()
+
+    def run_broks(self):
+        """
+        Manage the broks until the module is stopped
+        """
+        if self.spool_dir:
+            self.open_spool()
+        if self.cache_snapshot:
+            self.load_snapshot()
+
+        # Open database connections, in the writer threads if enabled
+        if self.writer_thread:
+            self.writers = [DBWriter(connection, self.writer_queue_size, self.writer_queue_policy)
+                            for connection in self.connections]
+            for writer in self.writers:
+                writer.start()
+        else:
+            self.open()
+
+        # Retention purge, by a single process in sharded mode
+        tables = []
+        if self.events_retention:
+            tables.append(('glpi_plugin_monitoring_serviceevents', 'date', self.events_retention))
+        if self.availability_retention:
+            tables.append(('glpi_plugin_monitoring_availabilities', 'day', self.availability_retention))
+        if tables and not self.shard:
+            self.purger = Purger(Connection(self, 'purge'), tables,
+                                 self.purge_period, self.purge_chunk_size, self.purge_pause)
+            self.purger.start()
 
         db_commit_next_time = time.time()
         db_test_connection = time.time()
+        db_states_next_time = time.time() + self.state_flush_period
+        db_availability_next_time = time.time() + self.availability_flush_period
+        stats_next_time = time.time() + self.stats_period
 
         while not self.interrupted:
             logger.debug("[glpidb] queue length: %s", self.to_q.qsize())
             start = time.time()
 
             # DB connection test ?
-            if self.db_test_period and db_test_connection < start:
+            if not self.writers and self.db_test_period and db_test_connection < start:
                 logger.debug("[glpidb] Testing database connection ...")
                 # Test connection every N seconds ...
                 db_test_connection = start + self.db_test_period
-                if not self.is_connected:
+                if not self.connection.ping():
                     logger.info("[glpidb] Trying to connect database ...")
                     self.open()
 
@@ -797,9 +1712,102 @@ class Glpidb_broker(BaseModule):
                 db_commit_next_time = start + self.commit_period
                 self.bulk_insert()
 
-            l = self.to_q.get()
-            for b in l:
-                b.prepare()
-                self.manage_brok(b)
+                # Acknowledges to expire, when the states are not written-behind
+                if not self.state_flush_period:
+                    self.flush_states()
+
+                if self.cache_snapshot and self.caches_modified:
+                    self.save_snapshot()
+
+                for writer in self.writers:
+                    # Broks queue and writer queue: is Shinken or the database the slowest?
+                    stats = writer.get_stats()
+                    logger.info("[glpidb] broks queue: %d, writer %s queue: %d/%d, lag: %2.4f (max %2.4f), "
+                                "executed: %d, dropped: %d, errors: %d", self.to_q.qsize(), writer.connection.name,
+                                stats['queue'], stats['queue_size'], stats['lag'], stats['max_lag'],
+                                stats['executed'], stats['dropped'], stats['errors'])
+
+                stats = self.get_insert_stats()
+                if stats['chunks']:
+                    logger.info("[glpidb] inserted %d events in %d chunks, %2.4f seconds (max. %2.4f per chunk)",
+                                stats['events'], stats['chunks'], stats['time'], stats['max_time'])
+
+                logger.info("[glpidb] broks managed: %s, dropped: %s",
+                            ', '.join(['%s: %d' % (t, self.broks_managed[t]) for t in sorted(self.broks_managed)]),
+                            ', '.join(['%s: %d' % (t, self.broks_dropped[t]) for t in sorted(self.broks_dropped)]))
+
+                if self.state_change_detection:
+                    logger.info("[glpidb] states updates: %d emitted, %d suppressed",
+                                self.states_writes['emitted'], self.states_writes['suppressed'])
+
+                if self.events_sampling:
+                    logger.info("[glpidb] services events: %d recorded (%d sampled OK results), %d skipped",
+                                self.events_writes['recorded'], self.events_writes['sampled'],
+                                self.events_writes['skipped'])
+
+                # Memory used by the caches and events shed by the overflow policies
+                shed = self.memory.get_stats()
+                logger.info("[glpidb] memory: %d bytes used (%d events: %d bytes), budget: %d bytes, shed events: %s",
+                            self.memory_used(), len(self.events_cache), self.events_bytes, self.memory.budget,
+                            ', '.join(['%s: %d' % (policy, shed[policy]) for policy in sorted(shed)]))
+
+            # States update
+            if self.state_flush_period and db_states_next_time < start:
+                logger.debug("[glpidb] States flush time ...")
+                db_states_next_time = start + self.state_flush_period
+                self.flush_states()
+
+            # Availability update
+            if self.update_availability and db_availability_next_time < start:
+                logger.debug("[glpidb] Availability flush time ...")
+                db_availability_next_time = start + self.availability_flush_period
+                self.flush_availability()
+
+            # Runtime metrics
+            if self.stats_file and stats_next_time < start:
+                stats_next_time = start + self.stats_period
+                self.publish_stats()
+
+            try:
+                l = self.to_q.get(timeout=1)
+            except Queue.Empty:
+                # No broks: do not keep a period transaction open until the next ones
+                if not self.writers and self.connection.is_connected:
+                    self.connection.idle_transaction()
+                continue
+            if l is None:
+                # Sharded mode: the module is stopped
+                break
+            self.manage_broks(l)
+            self.end_broks_batch()
 
             logger.debug("[glpidb] time to manage %s broks (%d secs)", len(l), time.time() - start)
+
+        if self.purger is not None:
+            self.purger.stop()
+
+        # Do not lose the latest states
+        self.flush_states()
+        if self.update_availability:
+            self.flush_availability()
+
+        if self.cache_snapshot and self.caches_modified:
+            self.save_snapshot()
+
+        # Do not lose the events, they will be inserted after restart
+        if self.spool is not None:
+            self.spool_events()
+
+        if self.writers:
+            for writer in self.writers:
+                writer.stop()
+        elif self.connection.is_connected:
+            self.connection.commit_transaction()
+
+        # After the writers are stopped: the events of the failed chunks are spooled
+        if self.spool is not None:
+            self.spool.close()
+
+        # Sharded mode: last stats of the shard
+        if self.stats_file and self.stats_queue is not None:
+            self.publish_stats()
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# Retention purge of the tables that are only appended to by the module (the
+# service events and the availability records). A background thread, with its
+# own database connection, periodically deletes the expired rows in small
+# chunks of consecutive ids, each one committed on its own and followed by a
+# pause, so that the purge never holds long locks nor competes with the writes
+# of the broks.
+
+import time
+import datetime
+import threading
+
+from shinken.log import logger
+
+
+class Purger(threading.Thread):
+    """
+    Retention purge thread
+
+    tables is a list of (table, date column, retention in days) tuples. Every
+    period seconds, the rows of each table older than the retention are deleted
+    by chunks of max. chunk_size rows, with a pause of pause seconds after each
+    chunk. The table primary key must be an auto-increment id: the ids are
+    walked from the oldest rows, until a chunk ends with a row to keep.
+    """
+    def __init__(self, connection, tables, period=3600, chunk_size=1000, pause=0.5):
+        threading.Thread.__init__(self, name='glpidb-purge')
+        self.daemon = True
+
+        self.connection = connection
+        self.metrics = connection.module.metrics
+        self.tables = tables
+        self.period = period
+        self.chunk_size = max(1, chunk_size)
+        self.pause = pause
+        self.stopping = threading.Event()
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        self.join(timeout)
+
+    def run(self):
+        logger.info("[glpidb] purge thread started: %s",
+                    ', '.join(['%s (%d days)' % (table, days) for (table, column, days) in self.tables]))
+        # First purge shortly after the start, then every period
+        next_run = time.time() + min(60, self.period)
+        while not self.stopping.is_set():
+            self.stopping.wait(max(0.1, min(next_run - time.time(), 1.0)))
+            if self.stopping.is_set() or time.time() < next_run:
+                continue
+            next_run = time.time() + self.period
+
+            if not self.connection.is_connected and not self.connection.open():
+                logger.warning("[glpidb] purge delayed, database is not connected")
+                continue
+            for (table, column, days) in self.tables:
+                if self.stopping.is_set():
+                    break
+                try:
+                    self.purge(table, column, days)
+                except Exception as exp:
+                    logger.error("[glpidb] purge of %s failed: %s", table, exp)
+                    self.connection.close()
+                    break
+
+        self.connection.close()
+        logger.info("[glpidb] purge thread stopped")
+
+    def purge(self, table, column, days):
+        """
+        Delete the rows of table older than days (date column), by chunks of
+        consecutive ids
+        """
+        if column == 'day':
+            cutoff = datetime.date.today() - datetime.timedelta(days=days)
+        else:
+            cutoff = datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(days=days)
+
+        connection = self.connection
+        start = time.time()
+        # Rows, chunks and time spent in the queries (pauses excluded)
+        (rows, chunks, busy) = (0, 0, 0.0)
+        # Chunk: ids from last (excluded) to the chunk_size-th next id (included)
+        last = 0
+        done = False
+        while not done and not self.stopping.is_set():
+            query_start = time.time()
+            query = "SELECT id, `%s` FROM `%s` WHERE id > %%s ORDER BY id LIMIT %d, 1" % (
+                column, table, self.chunk_size - 1)
+            if not connection.execute_query(query, (last,)):
+                break
+            row = connection.fetchone()
+            if row is None:
+                # Last rows of the table
+                query = "DELETE FROM `%s` WHERE id > %%s AND `%s` < %%s" % (table, column)
+                params = (last, cutoff)
+                done = True
+            else:
+                query = "DELETE FROM `%s` WHERE id > %%s AND id <= %%s AND `%s` < %%s" % (table, column)
+                params = (last, row[0], cutoff)
+                # The next rows are more recent
+                done = row[1] is not None and row[1] >= cutoff
+                last = row[0]
+
+            if not connection.execute_query(query, params):
+                break
+            busy += time.time() - query_start
+            count = max(0, connection.db_cursor.rowcount)
+            rows += count
+            chunks += 1
+            self.metrics.incr('purge.rows.' + table, count)
+            self.metrics.incr('purge.chunks')
+            if not done:
+                self.stopping.wait(self.pause)
+
+        self.metrics.observe('purge.' + table, busy)
+        logger.info("[glpidb] purge: %d rows of %s older than %s deleted in %d chunks, %2.4f seconds "
+                    "(%2.4f in queries)", rows, table, cutoff, chunks, time.time() - start, busy)
+        return rows
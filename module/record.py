@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# Normalization of the check result broks. Each host/service check result brok
+# is decoded once in a CheckRecord, used by all the tables writers.
+
+import datetime
+
+
+# Formatted dates memoized per second: many check results of a broks batch
+# have the same last check timestamp
+DATES_CACHE_SIZE = 3600
+_dates = {}
+
+
+def format_date(timestamp):
+    """
+    Format a timestamp (seconds) as a database DATETIME
+    """
+    try:
+        return _dates[timestamp]
+    except KeyError:
+        if len(_dates) >= DATES_CACHE_SIZE:
+            _dates.clear()
+        date = _dates[timestamp] = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        return date
+
+
+# Interned hosts/services names: the keys of the caches share the same strings
+# instead of keeping the strings of each brok
+_names = {}
+
+
+def intern_name(name):
+    """
+    Get the interned instance of a name (str or unicode)
+    """
+    return _names.setdefault(name, name)
+
+
+class GlpiItem(object):
+    """
+    GLPI ids of an host or a service, instance_id is the scheduler of the item
+    and generation tells whether the item is up to date
+    """
+    __slots__ = ('items_id', 'itemtype', 'hostsid', 'instance_id', 'generation')
+
+    def __init__(self, items_id, itemtype, hostsid=None, instance_id=0, generation=0):
+        self.items_id = items_id
+        self.itemtype = itemtype
+        self.hostsid = hostsid
+        self.instance_id = instance_id
+        self.generation = generation
+
+
+class CheckRecord(object):
+    """
+    Check result of an host (service is '') or a service. items_id and itemtype
+    are the GLPI ids of the host/service, None if it is not defined in GLPI.
+    """
+    __slots__ = ('hostname', 'service', 'state', 'state_id', 'state_type', 'last_chk', 'date',
+                 'output', 'long_output', 'event', 'perf_data', 'latency', 'execution_time',
+                 'acknowledged', 'in_downtime', 'items_id', 'itemtype', 'fingerprint')
+
+    def __init__(self, data):
+        self.hostname = data['host_name']
+        self.service = data.get('service_description', '')
+        self.state = data['state']
+        self.state_id = data['state_id']
+        self.state_type = data['state_type']
+        self.last_chk = int(data['last_chk'])
+        self.date = format_date(self.last_chk)
+        self.output = data['output']
+        self.long_output = data['long_output']
+        if self.long_output:
+            self.event = "%s \n %s" % (self.output, self.long_output)
+        else:
+            self.event = self.output
+        self.perf_data = data['perf_data']
+        self.latency = data['latency']
+        self.execution_time = data['execution_time']
+        self.acknowledged = '1' if data['problem_has_been_acknowledged'] else '0'
+        self.in_downtime = bool(data['in_scheduled_downtime'])
+        self.items_id = None
+        self.itemtype = None
+        # State fingerprint, computed on first use by the change detection
+        self.fingerprint = None
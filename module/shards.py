@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# Sharded mode: the broks management is spread over several worker processes,
+# so that it is not limited to a single CPU core. The module process only
+# routes the broks: the broks of a host, and of its services, always go to
+# the same shard (hash of the host name), the other broks go to all the
+# shards. Each shard has its own caches and database connections.
+
+import zlib
+import struct
+import multiprocessing
+import Queue
+
+from shinken.log import logger
+
+from metrics import merge_stats
+
+
+# Max. broks lists waiting in the queue of a shard
+QUEUE_SIZE = 100
+
+# The data of a brok is pickled (protocol 2) until the brok is prepared: the
+# host_name key as a str or an unicode key, and the memo opcodes that may follow
+HOST_NAME_KEYS = ('U\x09host_name', 'X\x09\x00\x00\x00host_name')
+MEMO_PUT_LENGTHS = {'q': 2, 'r': 5}
+PICKLE_LENGTH = struct.Struct('<I')
+
+
+def shard_of(host_name, shards):
+    """
+    Shard of a host, the hash does not change between runs
+    """
+    if isinstance(host_name, unicode):
+        host_name = host_name.encode('utf-8')
+    return (zlib.crc32(host_name) & 0xffffffff) % shards
+
+
+def pickled_host_name(data):
+    """
+    Host name of the pickled data of a brok, as an utf-8 str, or None if the brok
+    has no host name. Raise ValueError if the pickle can not be read so.
+    """
+    if not data.startswith('\x80\x02'):
+        raise ValueError('not a pickle of protocol 2')
+    for key in HOST_NAME_KEYS:
+        offset = data.find(key)
+        if offset >= 0:
+            break
+    else:
+        return None
+
+    offset += len(key)
+    offset += MEMO_PUT_LENGTHS.get(data[offset:offset + 1], 0)
+    opcode = data[offset:offset + 1]
+    if opcode == 'U':
+        length = ord(data[offset + 1])
+        offset += 2
+    elif opcode in ('T', 'X'):
+        (length,) = PICKLE_LENGTH.unpack_from(data, offset + 1)
+        offset += 1 + PICKLE_LENGTH.size
+    else:
+        raise ValueError('unexpected host name opcode %r' % opcode)
+    return data[offset:offset + length]
+
+
+def brok_host_name(brok):
+    """
+    Host name of a brok, read from its pickled data if the brok is not prepared:
+    the broks are unpickled by the shards. The brok is prepared if its pickled
+    data can not be read.
+    """
+    if isinstance(brok.data, str):
+        try:
+            return pickled_host_name(brok.data)
+        except (ValueError, IndexError, struct.error):
+            brok.prepare()
+    return brok.data.get('host_name')
+
+
+class Shards(object):
+    """
+    Shards processes
+
+    target(shard, queue, stats_queue) is run by the process of each shard: it
+    manages the broks lists read from queue until None is read, and puts its
+    stats in stats_queue as (shard, stats).
+    """
+    def __init__(self, count, target, queue_size=QUEUE_SIZE):
+        self.count = count
+        self.target = target
+        self.queues = [multiprocessing.Queue(queue_size) for i in range(count)]
+        self.stats_queue = multiprocessing.Queue()
+        self.processes = [None] * count
+
+        # Statistics: broks routed to each shard, broks sent to all the shards,
+        # and the last stats of each shard
+        self.routed = [0] * count
+        self.broadcast = 0
+        self.restarts = 0
+        self.stats = {}
+
+    def start(self, shard=None):
+        """
+        Start the process of a shard, or of all the shards
+        """
+        for i in ([shard] if shard is not None else range(self.count)):
+            process = multiprocessing.Process(target=self.target, name='glpidb-shard-%d' % i,
+                                              args=(i, self.queues[i], self.stats_queue))
+            process.daemon = True
+            process.start()
+            self.processes[i] = process
+            logger.info("[glpidb] shard %d started, pid: %d", i, process.pid)
+
+    def check(self):
+        """
+        Start again the shards processes that exited
+        """
+        for (i, process) in enumerate(self.processes):
+            if not process.is_alive():
+                logger.error("[glpidb] shard %d exited (code %s), starting it again", i, process.exitcode)
+                self.restarts += 1
+                self.start(i)
+
+    def route(self, broks):
+        """
+        Send broks to the shards: a brok with a host_name goes to the shard of
+        the host, the other broks go to all the shards
+        """
+        batches = [[] for i in range(self.count)]
+        for b in broks:
+            host_name = brok_host_name(b)
+            if host_name is None:
+                self.broadcast += 1
+                for batch in batches:
+                    batch.append(b)
+                continue
+            shard = shard_of(host_name, self.count)
+            self.routed[shard] += 1
+            batches[shard].append(b)
+
+        for (queue, batch) in zip(self.queues, batches):
+            if batch:
+                queue.put(batch)
+
+    def collect(self):
+        """
+        Read the stats put by the shards
+        """
+        while True:
+            try:
+                (shard, stats) = self.stats_queue.get_nowait()
+            except Queue.Empty:
+                return
+            self.stats[shard] = stats
+
+    def qsizes(self):
+        sizes = []
+        for queue in self.queues:
+            try:
+                sizes.append(queue.qsize())
+            except NotImplementedError:
+                sizes.append(0)
+        return sizes
+
+    def get_stats(self):
+        """
+        Get the stats of all the shards: the counters and gauges of the shards
+        are summed, and the routing counters are added
+        """
+        stats = merge_stats(self.stats.values(), max_gauges=('writer_lag',), min_gauges=('connected',))
+        for (i, count) in enumerate(self.routed):
+            stats['counters']['shards.routed.%d' % i] = count
+        stats['counters']['shards.broadcast'] = self.broadcast
+        stats['counters']['shards.restarts'] = self.restarts
+        for (i, size) in enumerate(self.qsizes()):
+            stats['gauges']['shards.queue.%d' % i] = size
+        stats['gauges']['shards'] = self.count
+        stats['gauges']['shards_reporting'] = len(self.stats)
+        return stats
+
+    def stop(self, timeout=60):
+        """
+        Stop the shards once they managed all the queued broks, the shards
+        that do not exit within timeout seconds are terminated
+        """
+        for queue in self.queues:
+            queue.put(None)
+        for (i, process) in enumerate(self.processes):
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("[glpidb] shard %d did not exit, terminated", i)
+                process.terminate()
+                process.join()
+        self.collect()
+        logger.info("[glpidb] shards stopped")
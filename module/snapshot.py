@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# Snapshot of the GLPI ids caches, saved on local disk so that the check results
+# are managed as soon as the broker is restarted, before the initial broks of
+# the schedulers are received again.
+#
+# The snapshot is a marshalled tuple:
+# (version, [(hostname, items_id, itemtype, hostsid, instance_id)],
+#           [(hostname, service, items_id, itemtype, instance_id)])
+
+import os
+import gc
+import marshal
+
+from record import GlpiItem, intern_name
+
+VERSION = 1
+
+
+def save_caches(path, hosts_cache, services_cache):
+    """
+    Save the hosts/services caches in path, the file is replaced atomically
+    """
+    hosts = [(hostname, item.items_id, item.itemtype, item.hostsid, item.instance_id)
+             for (hostname, item) in hosts_cache.iteritems()]
+    services = []
+    for (hostname, items) in services_cache.iteritems():
+        for (service, item) in items.iteritems():
+            services.append((hostname, service, item.items_id, item.itemtype, item.instance_id))
+
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        marshal.dump((VERSION, hosts, services), f, 2)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+    return (len(hosts), len(services))
+
+
+def load_caches(path, generation=0):
+    """
+    Load the hosts/services caches saved in path, the items get generation.
+    The garbage collector is disabled meanwhile, it would be run many times
+    for nothing while the items are created.
+    """
+    f = open(path, 'rb')
+    try:
+        (version, hosts, services) = marshal.load(f)
+    finally:
+        f.close()
+    if version != VERSION:
+        raise ValueError("unknown snapshot version %s" % version)
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        hosts_cache = {}
+        for (hostname, items_id, itemtype, hostsid, instance_id) in hosts:
+            hosts_cache[intern_name(hostname)] = GlpiItem(items_id, itemtype, hostsid, instance_id, generation)
+
+        services_cache = {}
+        for (hostname, service, items_id, itemtype, instance_id) in services:
+            hostname = intern_name(hostname)
+            items = services_cache.get(hostname)
+            if items is None:
+                items = services_cache[hostname] = {}
+            items[intern_name(service)] = GlpiItem(items_id, itemtype, None, instance_id, generation)
+    finally:
+        if enabled:
+            gc.enable()
+    return (hosts_cache, services_cache)
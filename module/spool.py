@@ -0,0 +1,162 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# On-disk spool of the service events that can not be kept in memory or
+# inserted in the database. The spool is a directory of append-only segment
+# files, each record is a marshalled row prefixed with its length. Segments
+# are read back, oldest first, when the database is available again.
+
+import os
+import glob
+import struct
+import marshal
+import threading
+
+from shinken.log import logger
+
+
+HEADER = struct.Struct('!I')
+
+
+class Spool(object):
+    """
+    Append-only spool of rows (tuples of str, unicode, int, float or None)
+    """
+    def __init__(self, path, segment_size=16 * 1024 * 1024, prefix='events'):
+        self.path = path
+        self.segment_size = segment_size
+        self.prefix = prefix
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Segments: sequence number -> number of rows
+        self.segments = {}
+        for filename in glob.glob(os.path.join(path, '%s-*.spool' % prefix)):
+            try:
+                sequence = int(os.path.basename(filename)[len(prefix) + 1:-len('.spool')])
+            except ValueError:
+                continue
+            self.segments[sequence] = len(self.read(filename))
+        self.sequence = max(self.segments.keys() or [0])
+        # Current segment file
+        self.segment = None
+        self.segment_bytes = 0
+
+        if self.segments:
+            logger.info("[glpidb] spool %s: %d rows in %d segments", path, len(self), len(self.segments))
+
+    def __len__(self):
+        return sum(self.segments.values())
+
+    def filename(self, sequence):
+        return os.path.join(self.path, '%s-%010d.spool' % (self.prefix, sequence))
+
+    def read(self, filename):
+        """
+        Read the rows of a segment file, a truncated last record is ignored
+        """
+        rows = []
+        f = open(filename, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            (size,) = HEADER.unpack_from(data, offset)
+            offset += HEADER.size
+            if offset + size > len(data):
+                logger.warning("[glpidb] spool segment %s is truncated", filename)
+                break
+            rows.append(marshal.loads(data[offset:offset + size]))
+            offset += size
+        return rows
+
+    def roll(self):
+        """
+        Close the current segment, next rows will be written in a new segment
+        """
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+    def append(self, rows):
+        """
+        Append rows to the current segment
+        """
+        if not rows:
+            return
+
+        with self.lock:
+            if self.segment is None:
+                self.sequence += 1
+                self.segment = open(self.filename(self.sequence), 'ab')
+                self.segment_bytes = 0
+                self.segments[self.sequence] = 0
+
+            records = []
+            for row in rows:
+                record = marshal.dumps(tuple(row), 2)
+                records.append(HEADER.pack(len(record)))
+                records.append(record)
+            data = ''.join(records)
+            self.segment.write(data)
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            self.segments[self.sequence] += len(rows)
+            self.segment_bytes += len(data)
+
+            if self.segment_bytes >= self.segment_size:
+                self.roll()
+
+    def pop_segment(self):
+        """
+        Get the rows of the oldest segment, the segment is deleted
+        """
+        with self.lock:
+            if not self.segments:
+                return []
+
+            sequence = min(self.segments.keys())
+            if sequence == self.sequence:
+                self.roll()
+
+            filename = self.filename(sequence)
+            del self.segments[sequence]
+            try:
+                rows = self.read(filename)
+                os.remove(filename)
+            except (IOError, OSError) as exp:
+                logger.error("[glpidb] spool segment %s can not be read: %s", filename, exp)
+                rows = []
+            return rows
+
+    def close(self):
+        with self.lock:
+            self.roll()
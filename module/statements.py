@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Statements of the tables updated by the module. The columns order of each
+# table is fixed once, the values are tuples in this order and they are sent
+# to the database with the MySQLdb parameters binding.
+#
+# A statement is a (query, params, many) tuple, to be run with:
+# cursor.executemany(query, params) if many, else cursor.execute(query, params)
+#
+# Rows may also be written in a tab-separated file, loaded with the LOAD DATA
+# statement of the table: no SQL text is built nor parsed for the values.
+
+
+class Statement(object):
+    """
+    Statements of a table. keys are the columns that identify a row (WHERE
+    clause of the updates) and columns are the other columns of a row. The
+    updates only change the rows matching condition, if any.
+    """
+    def __init__(self, table, columns, keys=(), condition=None):
+        self.table = table
+        self.columns = tuple(columns)
+        self.keys = tuple(keys)
+        self.condition = condition
+
+        # Prepare the queries as:
+        # INSERT INTO tbl_name (k,a,b) VALUES (%s,%s,%s)
+        # UPDATE tbl_name SET a=%s, b=%s WHERE k=%s
+        all_columns = self.keys + self.columns
+        self.insert_query = "INSERT INTO `%s` (%s) VALUES (%s)" % (
+            table, ", ".join(all_columns), ", ".join(["%s"] * len(all_columns)))
+        self.where_clause = " AND ".join(["%s=%%s" % key for key in self.keys])
+        self.update_query = "UPDATE `%s` SET %s WHERE %s" % (
+            table, ", ".join(["%s=%%s" % column for column in self.columns]),
+            self.where_clause + (" AND %s" % condition if condition else ""))
+
+    def insert(self, values, key=()):
+        """INSERT statement of a row"""
+        return (self.insert_query, tuple(key) + tuple(values), False)
+
+    def insert_many(self, rows):
+        """INSERT statement of several rows, rows is a list of values (key included)"""
+        return (self.insert_query, rows, True)
+
+    def load_data(self, path, character_set):
+        """LOAD DATA statement of the rows (key included) of a tab-separated client file"""
+        query = "LOAD DATA LOCAL INFILE %%s INTO TABLE `%s` CHARACTER SET %s (%s)" % (
+            self.table, character_set, ", ".join(self.keys + self.columns))
+        return (query, (path,), False)
+
+    def values_length(self, values):
+        """
+        Approximate length of the values of a row in a multi-row INSERT query:
+        (a, 'b', NULL),
+        """
+        length = 4
+        for value in values:
+            if value is None:
+                length += 6
+            elif isinstance(value, basestring):
+                length += len(value) + 4
+            else:
+                length += len(str(value)) + 2
+        return length
+
+    def chunks(self, rows, max_rows, max_length):
+        """
+        Split rows in chunks of max. max_rows rows and max. max_length bytes,
+        yield (rows, length) tuples. A chunk has at least one row.
+        """
+        chunk = []
+        length = 0
+        for values in rows:
+            values_length = self.values_length(values)
+            if chunk and (len(chunk) >= max_rows or length + values_length > max_length):
+                yield (chunk, length)
+                chunk = []
+                length = 0
+            chunk.append(values)
+            length += values_length
+        if chunk:
+            yield (chunk, length)
+
+    def update(self, key, values):
+        """UPDATE statement of the row identified by key"""
+        return (self.update_query, tuple(values) + tuple(key), False)
+
+    def update_many(self, rows):
+        """
+        UPDATE statement of several rows, rows is a dict of {key: values}:
+        UPDATE tbl_name SET a=CASE WHEN k=%s THEN %s ... ELSE a END, ...
+        WHERE (k=%s) OR ...
+        """
+        keys = rows.keys()
+        when = "WHEN %s THEN %%s" % self.where_clause
+        cases = " ".join([when] * len(keys))
+        where = " OR ".join(["(%s)" % self.where_clause] * len(keys))
+        if self.condition:
+            where = "(%s) AND %s" % (where, self.condition)
+        query = "UPDATE `%s` SET %s WHERE %s" % (
+            self.table,
+            ", ".join(["%s=CASE %s ELSE %s END" % (column, cases, column) for column in self.columns]),
+            where)
+
+        params = []
+        for (index, column) in enumerate(self.columns):
+            for key in keys:
+                params.extend(key)
+                params.append(rows[key][index])
+        for key in keys:
+            params.extend(key)
+        return (query, params, False)
+
+
+def tab_separated(rows, encoding='utf-8'):
+    """
+    Content of a LOAD DATA file of rows, in the default format: fields separated
+    by tabs, lines terminated by new lines, backslash escapes and \\N for NULL.
+    unicode values are encoded, str values are written as is.
+    """
+    lines = []
+    for values in rows:
+        fields = []
+        for value in values:
+            if value is None:
+                fields.append('\\N')
+                continue
+            if isinstance(value, unicode):
+                value = value.encode(encoding)
+            elif isinstance(value, float):
+                value = '%.15g' % value
+            elif isinstance(value, bool):
+                value = '1' if value else '0'
+            elif not isinstance(value, str):
+                value = str(value)
+            if '\\' in value or '\t' in value or '\n' in value or '\r' in value:
+                value = value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+            fields.append(value)
+        lines.append('\t'.join(fields))
+    lines.append('')
+    return '\n'.join(lines)
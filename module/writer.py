@@ -0,0 +1,223 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# A database writer thread owns a database connection of the module. The
+# broks management only prepares the write operations and queues them, the
+# writer threads run them, so that a slow database never blocks the broks loop.
+
+import time
+import threading
+import Queue
+
+from shinken.log import logger
+
+from connection import COMMIT
+
+
+# Policies when the queue is full:
+# - block: the broks management waits for the writer thread (backpressure)
+# - drop_new: the new operation is dropped
+# - drop_old: the oldest queued operation is dropped
+QUEUE_POLICIES = ('block', 'drop_new', 'drop_old')
+
+
+class DBWriter(threading.Thread):
+    """
+    Database writer thread
+
+    An operation is either a statement or a callable. Operations are run, and
+    committed, with the run_operation method of the connection. If an operation
+    fails, its on_error callback is called. While the database is not connected,
+    the queued operations are moved to the buffer of the connection (bounded, the
+    oldest operations fail first), so that a database outage never blocks the
+    broks management on a full queue.
+    """
+    def __init__(self, connection, queue_size=10000, policy='block'):
+        threading.Thread.__init__(self, name='glpidb-writer-%s' % connection.name)
+        self.daemon = True
+
+        self.connection = connection
+        self.queue = Queue.Queue(queue_size)
+        self.queue_size = queue_size
+        if policy not in QUEUE_POLICIES:
+            logger.warning("[glpidb] unknown writer queue policy '%s', using 'block'", policy)
+            policy = 'block'
+        self.policy = policy
+        self.stopped = False
+
+        # Statistics
+        self.executed = 0
+        self.dropped = 0
+        self.errors = 0
+        # Time spent by the last executed operation in the queue
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def put(self, operation, on_error=None):
+        """
+        Queue an operation, applying the queue policy if the queue is full.
+        A dropped operation fails: its on_error callback is called.
+        """
+        item = (time.time(), operation, on_error)
+        if self.policy == 'block':
+            self.queue.put(item)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except Queue.Full:
+                if self.policy == 'drop_new':
+                    self.dropped += 1
+                    if on_error:
+                        on_error()
+                    return
+                try:
+                    (queued, dropped, dropped_on_error) = self.queue.get_nowait()
+                except Queue.Empty:
+                    continue
+                self.dropped += 1
+                if dropped_on_error:
+                    dropped_on_error()
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def get_stats(self):
+        """
+        Get the writer statistics, max_lag is reset on each call
+        """
+        stats = {
+            'queue': self.queue.qsize(),
+            'queue_size': self.queue_size,
+            'lag': self.lag,
+            'max_lag': self.max_lag,
+            'executed': self.executed,
+            'dropped': self.dropped,
+            'errors': self.errors,
+        }
+        self.max_lag = 0.0
+        return stats
+
+    def stop(self, timeout=None):
+        """
+        Stop the thread once all the queued operations are executed
+        """
+        self.stopped = True
+        self.join(timeout)
+        if self.is_alive():
+            logger.warning("[glpidb] writer thread %s stopped with %d operations queued", self.name, self.queue.qsize())
+
+    def wait_connection(self):
+        """
+        Wait until the database is connected, False if the thread is stopped meanwhile.
+        The connection is attempted again after the backoff delay of the connection,
+        the operations queued meanwhile are buffered by the connection.
+        """
+        while not self.connection.is_connected:
+            if self.connection.open():
+                break
+            if self.stopped:
+                return False
+            deadline = time.time() + min(max(self.connection.next_retry - time.time(), 0.1), 1.0)
+            while time.time() < deadline:
+                try:
+                    (queued, operation, on_error) = self.queue.get(timeout=max(deadline - time.time(), 0.01))
+                except Queue.Empty:
+                    continue
+                if operation is not COMMIT:
+                    self.connection.buffer(operation, on_error)
+        return True
+
+    def fail_operations(self):
+        """
+        The thread is stopped while the database is not connected: the buffered
+        and the queued operations fail
+        """
+        operations = list(self.connection.transaction_replay)
+        self.connection.transaction_replay.clear()
+        while True:
+            try:
+                (queued, operation, on_error) = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            operations.append((operation, on_error))
+        if not operations:
+            return
+        logger.warning("[glpidb] writer thread %s stopped while database is not connected, "
+                       "%d operations dropped", self.name, len(operations))
+        for (operation, on_error) in operations:
+            if on_error:
+                on_error()
+
+    def run(self):
+        logger.info("[glpidb] writer thread %s started", self.name)
+        self.wait_connection()
+
+        # Idle since the last operation: the connection may have been closed by the server
+        idle = False
+        while not self.stopped or not self.queue.empty():
+            try:
+                (queued, operation, on_error) = self.queue.get(timeout=1)
+            except Queue.Empty:
+                idle = True
+                # Commit or run again failed transactions, even if no more operations
+                if self.connection.transaction or self.connection.transaction_replay:
+                    if self.wait_connection():
+                        self.connection.idle_transaction()
+                continue
+
+            # Check the connection before a new batch of operations
+            if idle:
+                self.connection.ping()
+                idle = False
+            if not self.connection.is_connected:
+                # Buffered before the operations queued meanwhile, to keep the order
+                if operation is not COMMIT:
+                    self.connection.buffer(operation, on_error)
+                if not self.wait_connection():
+                    self.fail_operations()
+                    return
+                continue
+
+            self.lag = time.time() - queued
+            self.max_lag = max(self.max_lag, self.lag)
+            if self.connection.run_operation(operation, on_error):
+                self.executed += 1
+            else:
+                self.errors += 1
+
+        # Commit the last transaction
+        if self.connection.is_connected:
+            self.connection.commit_transaction()
+        else:
+            self.fail_operations()
+        if self.connection.transaction_replay:
+            logger.warning("[glpidb] writer thread %s stopped with %d operations not executed",
+                           self.name, len(self.connection.transaction_replay))
+
+        logger.info("[glpidb] writer thread %s stopped", self.name)
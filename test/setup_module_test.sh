@@ -0,0 +1,14 @@
+#!/bin/bash
+
+# Test environment of the module: the tests are run from the Shinken tests
+# directory (see .travis.yml), with the module package linked as 'module'.
+
+set -e
+
+cd "$(dirname "$0")/.."
+
+git clone --depth 10 https://github.com/naparuba/shinken.git ~/shinken
+pip install MySQL-python coveralls
+
+ln -s "$PWD/module" ~/shinken/test/module
+cp test/test_*.py ~/shinken/test/
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# In-memory availability of the hosts/services
+
+import os
+import sys
+import time
+import datetime
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from module.availability import Availability
+
+
+DAY = '2015-01-10'
+NEXT_DAY = '2015-01-11'
+MIDNIGHT = int(time.mktime(datetime.date(2015, 1, 10).timetuple()))
+NEXT_MIDNIGHT = int(time.mktime(datetime.date(2015, 1, 11).timetuple()))
+HOUR = 3600
+
+
+class TestAvailability(unittest.TestCase):
+
+    def setUp(self):
+        self.availability = Availability(MIDNIGHT + HOUR)
+
+    def test_update(self):
+        self.availability.update('srv', '', 0, MIDNIGHT + HOUR, False)
+        self.availability.update('srv', '', 1, MIDNIGHT + 2 * HOUR, False)
+        self.availability.update('srv', '', 1, MIDNIGHT + 3 * HOUR, False)
+        self.availability.update('srv', '', 7, MIDNIGHT + 4 * HOUR, False)
+        record = self.availability.records[('srv', '')]
+        self.assertEqual(record.daily, [HOUR, 2 * HOUR, 0, 0])
+        self.assertEqual(record.unchecked(), 21 * HOUR)
+        self.assertEqual(record.first_check_state, 0)
+        self.assertEqual(record.first_check_timestamp, MIDNIGHT + HOUR)
+        # Unexpected state: unknown
+        self.assertEqual(record.last_check_state, 3)
+        self.assertEqual(self.availability.pop_dirty().keys(), [('srv', '', DAY)])
+        self.assertEqual(self.availability.pop_dirty(), {})
+
+    def test_check_of_previous_day(self):
+        self.availability.update('srv', '', 0, MIDNIGHT - 60, False)
+        self.assertEqual(self.availability.records, {})
+
+    def test_downtime(self):
+        self.availability.update('srv', '', 0, MIDNIGHT + HOUR, True)
+        self.availability.update('srv', '', 0, MIDNIGHT + 2 * HOUR, False)
+        self.assertTrue(self.availability.records[('srv', '')].is_downtime)
+
+    def test_rollover(self):
+        self.availability.update('srv', 'http', 2, MIDNIGHT + 23 * HOUR, False)
+        self.availability.update('srv', 'http', 0, NEXT_MIDNIGHT + HOUR, False)
+        self.assertEqual(self.availability.day, NEXT_DAY)
+
+        dirty = self.availability.pop_dirty()
+        self.assertEqual(sorted(dirty.keys()), [('srv', 'http', DAY), ('srv', 'http', NEXT_DAY)])
+        # The last state of the day lasts until midnight, and until the first check of the new day
+        closed = dirty[('srv', 'http', DAY)]
+        self.assertEqual(closed.daily, [0, 0, HOUR, 0])
+        self.assertEqual(closed.last_check_timestamp, NEXT_MIDNIGHT)
+        record = dirty[('srv', 'http', NEXT_DAY)]
+        self.assertEqual(record.day, NEXT_DAY)
+        self.assertEqual(record.first_check_state, 2)
+        self.assertEqual(record.first_check_timestamp, NEXT_MIDNIGHT)
+        self.assertEqual(record.daily, [0, 0, HOUR, 0])
+        self.assertEqual(record.last_check_state, 0)
+
+    def test_load(self):
+        self.availability.update('srv', 'http', 0, MIDNIGHT + 2 * HOUR, False)
+        self.availability.load([
+            (7, 'srv', '', 0, HOUR, 0, 0, 0, 0, MIDNIGHT, 1, MIDNIGHT + HOUR),
+            (8, 'srv', 'http', 0, 0, 0, 0, 0, 0, MIDNIGHT, 0, MIDNIGHT),
+        ])
+        record = self.availability.records[('srv', '')]
+        self.assertEqual((record.id, record.daily, record.last_check_state), (7, [HOUR, 0, 0, 0], 1))
+        # The record in memory is more recent, only its id is loaded
+        record = self.availability.records[('srv', 'http')]
+        self.assertEqual((record.id, record.first_check_timestamp), (8, MIDNIGHT + 2 * HOUR))
+
+    def test_mark_dirty(self):
+        self.availability.update('srv', '', 0, MIDNIGHT + HOUR, False)
+        dirty = self.availability.pop_dirty()
+        self.availability.update('srv', '', 0, MIDNIGHT + 2 * HOUR, False)
+        self.availability.mark_dirty(dirty)
+        self.assertEqual(self.availability.pop_dirty().keys(), [('srv', '', DAY)])
+
+    def test_set_ids(self):
+        self.availability.update('srv', '', 0, MIDNIGHT + HOUR, False)
+        inserted = self.availability.pop_dirty()
+        self.availability.set_ids(DAY, [(42, 'srv', ''), (43, 'other', '')], inserted)
+        self.assertEqual(self.availability.records[('srv', '')].id, 42)
+
+    def test_set_ids_after_midnight(self):
+        # The records are inserted, the writer lags until after midnight
+        self.availability.update('srv', '', 0, MIDNIGHT + HOUR, False)
+        inserted = self.availability.pop_dirty()
+        for record in inserted.values():
+            record.pending = True
+        self.availability.update('srv', '', 0, NEXT_MIDNIGHT + 60, False)
+
+        self.availability.set_ids(DAY, [(42, 'srv', '')], inserted)
+        # The closing record of the former day gets its id, not the record of the new day
+        closed = inserted[('srv', '', DAY)]
+        self.assertEqual((closed.id, closed.pending), (42, False))
+        self.assertEqual(self.availability.records[('srv', '')].id, None)
+
+        # The ids of the new day rows are not set on the records of the former day
+        self.availability.set_ids(NEXT_DAY, [(44, 'srv', '')], inserted)
+        self.assertEqual(closed.id, 42)
+
+
+if __name__ == '__main__':
+    unittest.main()
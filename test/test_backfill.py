@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# Availability records computed by the backfill from a states history
+
+import os
+import sys
+import time
+import datetime
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from module.availability import Availability
+from module.backfill import backfill, parse_log_line
+
+
+DAY = '2015-01-10'
+MIDNIGHT = int(time.mktime(datetime.date(2015, 1, 10).timetuple()))
+HOUR = 3600
+
+
+class TestBackfill(unittest.TestCase):
+
+    def run_backfill(self, lines, first_day=DAY, last_day=DAY):
+        """
+        Backfill the log lines (seconds since the first day midnight, message),
+        get the written records: {day: {(hostname, service): AvailabilityRecord}}
+        """
+        days = {}
+
+        def write(day, records):
+            days[day] = records
+
+        events = [parse_log_line("[%d] %s" % (MIDNIGHT + offset, message)) for (offset, message) in lines]
+        backfill(events, first_day, last_day, write)
+        return days
+
+    def test_host_outage(self):
+        days = self.run_backfill([
+            (0, "CURRENT HOST STATE: srv;UP;HARD;1;ok"),
+            (12 * HOUR, "HOST ALERT: srv;DOWN;HARD;1;down"),
+            (13 * HOUR, "HOST ALERT: srv;UP;HARD;1;up"),
+        ])
+        record = days[DAY][('srv', '')]
+        self.assertEqual(record.daily, [82800, 3600, 0, 0])
+        self.assertEqual(record.unchecked(), 0)
+        self.assertEqual(record.first_check_state, 0)
+        self.assertEqual(record.last_check_state, 0)
+
+    def test_service_outage(self):
+        days = self.run_backfill([
+            (0, "CURRENT SERVICE STATE: srv;http;OK;HARD;1;ok"),
+            (39600, "SERVICE ALERT: srv;http;CRITICAL;SOFT;1;bad"),
+            (40000, "SERVICE ALERT: srv;http;CRITICAL;HARD;3;bad"),
+            (49600, "SERVICE ALERT: srv;http;OK;HARD;1;ok"),
+        ])
+        self.assertEqual(days[DAY][('srv', 'http')].daily, [76400, 0, 10000, 0])
+
+    def test_outage_over_midnight(self):
+        next_day = '2015-01-11'
+        days = self.run_backfill([
+            (0, "CURRENT HOST STATE: srv;UP;HARD;1;ok"),
+            (23 * HOUR, "HOST ALERT: srv;DOWN;HARD;1;down"),
+            (25 * HOUR, "HOST ALERT: srv;UP;HARD;1;up"),
+            (47 * HOUR, "HOST ALERT: srv;DOWN;HARD;1;down"),
+        ], last_day=next_day)
+        self.assertEqual(days[DAY][('srv', '')].daily, [23 * HOUR, HOUR, 0, 0])
+        # The last state lasts until the end of the last day
+        self.assertEqual(days[next_day][('srv', '')].daily, [22 * HOUR, 2 * HOUR, 0, 0])
+
+    def test_unchecked_before_first_event(self):
+        days = self.run_backfill([
+            (6 * HOUR, "HOST ALERT: srv;UP;HARD;1;ok"),
+            (20 * HOUR, "HOST ALERT: srv;DOWN;HARD;1;down"),
+        ])
+        record = days[DAY][('srv', '')]
+        self.assertEqual(record.daily, [14 * HOUR, 4 * HOUR, 0, 0])
+        self.assertEqual(record.unchecked(), 6 * HOUR)
+
+    def test_downtime(self):
+        days = self.run_backfill([
+            (0, "CURRENT HOST STATE: srv;UP;HARD;1;ok"),
+            (2 * HOUR, "HOST DOWNTIME ALERT: srv;STARTED; maintenance"),
+            (3 * HOUR, "HOST ALERT: srv;DOWN;HARD;1;down"),
+            (4 * HOUR, "HOST ALERT: srv;UP;HARD;1;up"),
+            (5 * HOUR, "HOST DOWNTIME ALERT: srv;STOPPED; maintenance"),
+        ])
+        record = days[DAY][('srv', '')]
+        self.assertTrue(record.is_downtime)
+        self.assertEqual(record.daily, [23 * HOUR, HOUR, 0, 0])
+
+    def test_same_as_check_results(self):
+        # The same day computed by the module from check results every 5 minutes
+        states = [(0, 0), (10 * HOUR + 7, 2), (10 * HOUR + 600, 1), (15 * HOUR, 0)]
+        availability = Availability(MIDNIGHT)
+        for offset in sorted(set(range(0, 24 * HOUR, 300) + [offset for (offset, state) in states])):
+            state_id = [state for (start, state) in states if start <= offset][-1]
+            availability.update('srv', 'http', state_id, MIDNIGHT + offset, False)
+        availability.rollover(MIDNIGHT + 24 * HOUR)
+        live = availability.pop_dirty()[('srv', 'http', DAY)]
+
+        names = ['OK', 'WARNING', 'CRITICAL']
+        days = self.run_backfill(
+            [(0, "CURRENT SERVICE STATE: srv;http;OK;HARD;1;ok")] +
+            [(offset, "SERVICE ALERT: srv;http;%s;HARD;1;out" % names[state]) for (offset, state) in states[1:]])
+        record = days[DAY][('srv', 'http')]
+        self.assertEqual(record.daily, live.daily)
+        self.assertEqual(record.daily, [19 * HOUR + 7, 5 * HOUR - 600, 593, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# Transactions of a database connection: commits, rollbacks, operations run
+# again and operations buffered while the database is not connected
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from MySQLdb import IntegrityError, OperationalError, InternalError
+
+from module.connection import Connection, COMMIT, RETRY_MAX
+from module.metrics import Metrics
+
+
+class Database(object):
+    """
+    Stand-in for a MySQLdb connection: the queries raise the errors queued for
+    them, the executed queries are committed or rolled back
+    """
+    def __init__(self):
+        self.executed = []
+        self.committed = []
+        self.errors = {}
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        self.committed.extend(self.executed)
+        self.executed = []
+
+    def rollback(self):
+        self.executed = []
+
+    def ping(self):
+        pass
+
+    def close(self):
+        self.executed = []
+
+
+class Cursor(object):
+
+    def __init__(self, db):
+        self.db = db
+
+    def execute(self, query, params=None):
+        errors = self.db.errors.get(query)
+        if errors:
+            raise errors.pop(0)
+        self.db.executed.append(query)
+
+    def close(self):
+        pass
+
+
+class Module(object):
+    """
+    Options of the module used by the connections
+    """
+    def __init__(self, transaction_mode='batch', transaction_max_queries=1000, writer_queue_size=10):
+        self.transaction_mode = transaction_mode
+        self.transaction_period = 1.0
+        self.transaction_max_queries = transaction_max_queries
+        self.writer_queue_size = writer_queue_size
+        self.metrics = Metrics()
+
+
+def query(name):
+    return ("UPDATE `%s` SET state=%%s" % name, ('OK',))
+
+
+class TestConnection(unittest.TestCase):
+
+    def connect(self, **options):
+        self.connection = Connection(Module(**options))
+        self.db = Database()
+        self.connection.db = self.db
+        self.connection.db_cursor = self.db.cursor()
+        self.connection.is_connected = True
+        self.failed = []
+        return self.connection
+
+    def run_query(self, name):
+        return self.connection.run_operation(query(name), lambda: self.failed.append(name))
+
+    def fail_query(self, name, *errors):
+        self.db.errors[query(name)[0]] = list(errors)
+
+    def committed(self):
+        return [q.split('`')[1] for q in self.db.committed]
+
+    def test_statement_mode(self):
+        self.connect(transaction_mode='statement', transaction_max_queries=1)
+        self.assertTrue(self.run_query('a'))
+        self.assertEqual(self.committed(), ['a'])
+        self.assertTrue(self.run_query('b'))
+        self.assertEqual(self.committed(), ['a', 'b'])
+
+    def test_batch_mode(self):
+        self.connect()
+        self.run_query('a')
+        self.run_query('b')
+        self.assertEqual(self.committed(), [])
+        self.assertTrue(self.connection.run_operation(COMMIT))
+        self.assertEqual(self.committed(), ['a', 'b'])
+        self.assertEqual(self.connection.transaction, [])
+
+    def test_period_mode_idle(self):
+        self.connect(transaction_mode='period')
+        self.run_query('a')
+        self.connection.idle_transaction()
+        self.assertEqual(self.committed(), [])
+        # The transaction period is elapsed, even if no more queries are run
+        self.connection.transaction_start -= 1
+        self.connection.idle_transaction()
+        self.assertEqual(self.committed(), ['a'])
+
+    def test_callable_operation(self):
+        self.connect()
+        self.assertTrue(self.connection.run_operation(lambda connection: connection.execute_query(*query('a'))))
+        self.connection.commit_transaction()
+        self.assertEqual(self.committed(), ['a'])
+
+    def test_integrity_error(self):
+        self.connect()
+        self.fail_query('b', IntegrityError(1062, 'Duplicate entry'))
+        self.run_query('a')
+        self.assertFalse(self.run_query('b'))
+        self.run_query('c')
+        self.connection.commit_transaction()
+        # Only the failing query is lost
+        self.assertEqual(self.committed(), ['a', 'c'])
+        self.assertEqual(self.failed, ['b'])
+
+    def test_rollback_and_replay(self):
+        self.connect()
+        self.fail_query('b', InternalError(1105, 'error'), InternalError(1105, 'error'))
+        self.run_query('a')
+        self.assertFalse(self.run_query('b'))
+        self.assertEqual(len(self.connection.transaction_replay), 2)
+
+        # The queries of the transaction are run again one by one, before the next ones
+        self.run_query('c')
+        self.connection.commit_transaction()
+        self.assertEqual(self.committed(), ['a', 'c'])
+        self.assertEqual(self.failed, ['b'])
+
+    def test_deadlock_retried(self):
+        self.connect(transaction_mode='statement', transaction_max_queries=1)
+        self.fail_query('a', OperationalError(1213, 'Deadlock found'), OperationalError(1205, 'Lock wait timeout'))
+        self.assertFalse(self.run_query('a'))
+        self.connection.idle_transaction()
+        self.assertEqual(self.committed(), ['a'])
+        self.assertEqual(self.failed, [])
+
+    def test_deadlock_retries_bounded(self):
+        self.connect(transaction_mode='statement', transaction_max_queries=1)
+        self.fail_query('a', *[OperationalError(1213, 'Deadlock found')] * (RETRY_MAX + 1))
+        self.run_query('a')
+        self.connection.idle_transaction()
+        self.assertEqual(self.committed(), [])
+        self.assertEqual(self.failed, ['a'])
+        self.assertEqual(len(self.connection.transaction_replay), 0)
+
+    def test_connection_lost(self):
+        self.connect()
+        self.run_query('a')
+        self.fail_query('b', OperationalError(2006, 'MySQL server has gone away'))
+        self.assertFalse(self.run_query('b'))
+        self.assertFalse(self.connection.is_connected)
+        self.assertEqual(len(self.connection.transaction_replay), 2)
+
+        # Connected again: the queries of the lost transaction are run again
+        self.connection.db = self.db
+        self.connection.db_cursor = self.db.cursor()
+        self.connection.is_connected = True
+        self.connection.idle_transaction()
+        self.assertEqual(self.committed(), ['a', 'b'])
+        self.assertEqual(self.failed, [])
+
+    def test_buffer_bounded(self):
+        self.connect(writer_queue_size=2)
+        self.connection.close()
+        for name in ('a', 'b', 'c'):
+            self.connection.buffer(query(name), lambda name=name: self.failed.append(name))
+        # The oldest operations fail first
+        self.assertEqual(self.failed, ['a'])
+        self.assertEqual(self.connection.module.metrics.counters['db.buffer_dropped'], 1)
+
+        self.connection.db = self.db
+        self.connection.db_cursor = self.db.cursor()
+        self.connection.is_connected = True
+        self.connection.idle_transaction()
+        self.assertEqual(self.committed(), ['b', 'c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# On-disk spool of the service events
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from module.spool import Spool
+
+
+ROWS = [(100, '2015-01-10 12:00:00', u'caf\xe9', 0, 'HARD', 'rta=0.1ms', 0.1, 0.25),
+        (101, '2015-01-10 12:00:05', 'ok', 2, 'SOFT', None, 0, 1)]
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='glpidb-spool-')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.path, 'events-*.spool')))
+
+    def test_round_trip(self):
+        spool = Spool(self.path)
+        spool.append(ROWS)
+        spool.append(ROWS[:1])
+        self.assertEqual(len(spool), 3)
+        self.assertEqual(spool.pop_segment(), ROWS + ROWS[:1])
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(spool.pop_segment(), [])
+
+    def test_segments_oldest_first(self):
+        spool = Spool(self.path, segment_size=1)
+        spool.append(ROWS[:1])
+        spool.append(ROWS[1:])
+        self.assertEqual(len(self.segments()), 2)
+        self.assertEqual(spool.pop_segment(), ROWS[:1])
+        self.assertEqual(spool.pop_segment(), ROWS[1:])
+
+    def test_reopen(self):
+        spool = Spool(self.path)
+        spool.append(ROWS)
+        spool.close()
+
+        # The spooled rows are inserted after a restart, the new rows go in a new segment
+        spool = Spool(self.path)
+        self.assertEqual(len(spool), 2)
+        spool.append(ROWS[:1])
+        self.assertEqual(len(self.segments()), 2)
+        self.assertEqual(spool.pop_segment(), ROWS)
+        self.assertEqual(spool.pop_segment(), ROWS[:1])
+
+    def test_truncated_segment(self):
+        spool = Spool(self.path)
+        spool.append(ROWS)
+        spool.close()
+
+        # Crash while a row was written: the truncated last row is ignored
+        filename = self.segments()[0]
+        size = os.path.getsize(filename)
+        f = open(filename, 'r+b')
+        try:
+            f.truncate(size - 3)
+        finally:
+            f.close()
+
+        spool = Spool(self.path)
+        self.assertEqual(len(spool), 1)
+        self.assertEqual(spool.pop_segment(), ROWS[:1])
+        self.assertEqual(self.segments(), [])
+
+    def test_other_files_ignored(self):
+        open(os.path.join(self.path, 'events-x.spool'), 'w').close()
+        spool = Spool(self.path)
+        self.assertEqual(len(spool), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
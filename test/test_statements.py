@@ -0,0 +1,122 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# Statements of the tables and LOAD DATA files of the rows
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from module.statements import Statement, tab_separated
+
+
+def bind(query, params):
+    """
+    The query as run by the server, the parameters are quoted as by MySQLdb
+    """
+    return query % tuple([repr(param) for param in params])
+
+
+class TestStatement(unittest.TestCase):
+
+    def setUp(self):
+        self.statement = Statement('hosts', ('state', 'output'), ('id',))
+
+    def test_insert_update(self):
+        (query, params, many) = self.statement.insert(('UP', 'ok'), (3,))
+        self.assertEqual(bind(query, params), "INSERT INTO `hosts` (id, state, output) VALUES (3, 'UP', 'ok')")
+        self.assertFalse(many)
+        (query, params, many) = self.statement.update((3,), ('UP', 'ok'))
+        self.assertEqual(bind(query, params), "UPDATE `hosts` SET state='UP', output='ok' WHERE id=3")
+
+    def test_update_many(self):
+        (query, params, many) = self.statement.update_many({(3,): ('UP', 'ok'), (5,): ('DOWN', 'ko')})
+        self.assertFalse(many)
+        # The rows order is the one of the dict keys
+        first, second = (3, 5) if params[0] == 3 else (5, 3)
+        values = {3: ('UP', 'ok'), 5: ('DOWN', 'ko')}
+        self.assertEqual(bind(query, params),
+                         "UPDATE `hosts` SET "
+                         "state=CASE WHEN id=%d THEN %r WHEN id=%d THEN %r ELSE state END, "
+                         "output=CASE WHEN id=%d THEN %r WHEN id=%d THEN %r ELSE output END "
+                         "WHERE (id=%d) OR (id=%d)" % (
+                             first, values[first][0], second, values[second][0],
+                             first, values[first][1], second, values[second][1],
+                             first, second))
+
+    def test_update_many_composite_key(self):
+        statement = Statement('states', ('state',), ('hostname', 'service'))
+        (query, params, many) = statement.update_many({('srv', 'http'): ('OK',)})
+        self.assertEqual(bind(query, params),
+                         "UPDATE `states` SET "
+                         "state=CASE WHEN hostname='srv' AND service='http' THEN 'OK' ELSE state END "
+                         "WHERE (hostname='srv' AND service='http')")
+
+    def test_update_condition(self):
+        statement = Statement('acknowledges', ('expired',), ('items_id',), 'expired=0')
+        (query, params, many) = statement.update((3,), ('1',))
+        self.assertEqual(bind(query, params), "UPDATE `acknowledges` SET expired='1' WHERE items_id=3 AND expired=0")
+        (query, params, many) = statement.update_many({(3,): ('1',)})
+        self.assertEqual(bind(query, params),
+                         "UPDATE `acknowledges` SET expired=CASE WHEN items_id=3 THEN '1' ELSE expired END "
+                         "WHERE ((items_id=3)) AND expired=0")
+
+    def test_chunks(self):
+        rows = [(i, 'x' * 10) for i in range(10)]
+        length = self.statement.values_length(rows[0])
+        chunks = list(self.statement.chunks(rows, 4, 3 * length))
+        self.assertEqual([len(chunk) for (chunk, chunk_length) in chunks], [3, 3, 3, 1])
+        self.assertEqual(sum([chunk for (chunk, chunk_length) in chunks], []), rows)
+        # A row longer than max_length is still in a chunk
+        self.assertEqual([len(chunk) for (chunk, chunk_length) in self.statement.chunks(rows[:2], 4, 1)], [1, 1])
+
+    def test_load_data(self):
+        (query, params, many) = self.statement.load_data('/tmp/events.tsv', 'utf8')
+        self.assertEqual(query, "LOAD DATA LOCAL INFILE %s INTO TABLE `hosts` CHARACTER SET utf8 (id, state, output)")
+        self.assertEqual(params, ('/tmp/events.tsv',))
+
+
+class TestTabSeparated(unittest.TestCase):
+
+    def test_values(self):
+        self.assertEqual(tab_separated([(1, 2.5, None, True, 'ok'), (2, 0.1, u'caf\xe9', False, '')]),
+                         "1\t2.5\t\\N\t1\tok\n2\t0.1\tcaf\xc3\xa9\t0\t\n")
+
+    def test_encoding(self):
+        self.assertEqual(tab_separated([(u'caf\xe9',)], 'latin1'), "caf\xe9\n")
+
+    def test_escapes(self):
+        self.assertEqual(tab_separated([('a\tb\nc\rd\\e', 'N')]), "a\\tb\\nc\\rd\\\\e\tN\n")
+
+    def test_no_rows(self):
+        self.assertEqual(tab_separated([]), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+# Queue policies of the database writer threads
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from module.writer import DBWriter
+
+
+class Connection(object):
+    name = 'test'
+
+
+class TestWriterQueue(unittest.TestCase):
+
+    def fill(self, policy, count=4):
+        """
+        Queue count operations in a queue of 2 operations, the thread is not
+        started: get the writer and the operations that failed
+        """
+        writer = DBWriter(Connection(), 2, policy)
+        failed = []
+        for i in range(count):
+            writer.put(('query %d' % i, None), lambda i=i: failed.append(i))
+        return (writer, failed)
+
+    def queued(self, writer):
+        return [operation[0] for (queued, operation, on_error) in list(writer.queue.queue)]
+
+    def test_drop_new(self):
+        (writer, failed) = self.fill('drop_new')
+        self.assertEqual(self.queued(writer), ['query 0', 'query 1'])
+        # The dropped operations fail, so that their callers roll back their state
+        self.assertEqual(failed, [2, 3])
+        self.assertEqual(writer.get_stats()['dropped'], 2)
+
+    def test_drop_old(self):
+        (writer, failed) = self.fill('drop_old')
+        self.assertEqual(self.queued(writer), ['query 2', 'query 3'])
+        self.assertEqual(failed, [0, 1])
+        self.assertEqual(writer.get_stats()['dropped'], 2)
+
+    def test_not_full(self):
+        (writer, failed) = self.fill('drop_old', 2)
+        self.assertEqual(self.queued(writer), ['query 0', 'query 1'])
+        self.assertEqual(failed, [])
+
+    def test_unknown_policy(self):
+        (writer, failed) = self.fill('unknown', 2)
+        self.assertEqual(writer.policy, 'block')
+
+
+if __name__ == '__main__':
+    unittest.main()